@@ -0,0 +1,300 @@
+"""
+Benchmarks loading, downgrading and marshalling a corpus of Python 3.9 pyc
+files.
+
+The corpus is the 3.9 standard library plus a few generated stress modules,
+compiled with a Python 3.9 interpreter. Results are compared against a stored
+baseline, as long as it was taken over the same corpus with the same Python:
+
+    python benchmarks/run_benchmarks.py --python39 python3.9
+    python benchmarks/run_benchmarks.py --save-baseline
+
+Timings depend on the machine, so re-save the baseline before comparing on a
+different one. The baseline records the commit it was taken at, re-save and
+commit it whenever a change is meant to make a stage slower or faster.
+"""
+import argparse
+import json
+import pathlib
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from pydowngrade import pyc_io  # noqa: E402
+from pydowngrade.downgrade_transformer import downgrade_py39_code_to_py38  # noqa: E402
+
+BENCHMARKS_FOLDER = pathlib.Path(__file__).resolve().parent
+REPOSITORY_FOLDER = BENCHMARKS_FOLDER.parent
+DEFAULT_BASELINE = BENCHMARKS_FOLDER / "baseline.json"
+
+STAGES = ("load", "downgrade", "marshal")
+
+# Run by the 3.9 interpreter: compiles its standard library and the stress
+# modules into the corpus directory given as the first argument.
+COMPILE_CORPUS_SCRIPT = """
+import pathlib, py_compile, sys, sysconfig
+corpus = pathlib.Path(sys.argv[1])
+stdlib = pathlib.Path(sysconfig.get_paths()["stdlib"])
+sources = [
+    (path, path.relative_to(stdlib)) for path in stdlib.rglob("*.py")
+    if not {"test", "tests", "site-packages", "idle_test"} & set(path.parts)
+]
+sources += [
+    (path, path.relative_to(corpus)) for path in (corpus / "stress").glob("*.py")
+]
+for source, relative in sources:
+    name = ".".join(relative.with_suffix("").parts)
+    try:
+        py_compile.compile(
+            str(source), str(corpus / (name + ".pyc")), doraise=True
+        )
+    except py_compile.PyCompileError:
+        pass
+"""
+
+
+def generate_stress_modules(folder: pathlib.Path) -> None:
+    """Writes source for modules that stress the transformer's slow paths."""
+    folder.mkdir(parents=True, exist_ok=True)
+
+    # Thousands of handlers, each RERAISE is rewritten and the jumps around
+    # them need EXTENDED_ARGs.
+    handlers = "".join(
+        "    try:\n        x = y{0}\n    except NameError:\n        pass\n".format(i)
+        for i in range(3000)
+    )
+    (folder / "many_excepts.py").write_text("def f():\n" + handlers)
+
+    (folder / "huge_constants.py").write_text(
+        "NUMBERS = %r\nSTRINGS = %r\nNESTED = [%s]\n"
+        % (
+            list(range(50000)),
+            ["string %d" % i for i in range(20000)],
+            ", ".join("[%d, %d, *NUMBERS[:2]]" % (i, i + 1) for i in range(2000)),
+        )
+    )
+
+    nested_functions = "".join(
+        "    " * depth + "def f%d(a):\n" % depth for depth in range(40)
+    ) + "    " * 40 + "return a is None or a in (1, 2)\n"
+    nested_ifs = "def g(a):\n" + "".join(
+        "    " * (depth + 1) + "if a > %d:\n" % depth for depth in range(60)
+    ) + "    " * 61 + "assert a\n"
+    (folder / "deep_nesting.py").write_text(nested_functions + nested_ifs)
+
+    # A loop whose body is long enough that jumping back to its start needs
+    # several EXTENDED_ARG prefixes.
+    body = "".join("        x = x + %d\n" % i for i in range(20000))
+    (folder / "long_jumps.py").write_text(
+        "def f(x):\n    while x:\n" + body + "        if x == -1:\n"
+        "            break\n    return x\n"
+    )
+
+
+def build_corpus(python39: str, corpus: pathlib.Path) -> typing.List[pathlib.Path]:
+    generate_stress_modules(corpus / "stress")
+    subprocess.check_call([python39, "-c", COMPILE_CORPUS_SCRIPT, str(corpus)])
+    return sorted(corpus.glob("*.pyc"))
+
+
+def run_once(files: typing.List[pathlib.Path], optimize: bool = False) -> dict:
+    times = dict.fromkeys(STAGES, 0.0)
+    output_bytes = 0
+    failures = 0
+    for path in files:
+        start = time.perf_counter()
+        code = pyc_io.CompiledFile(path).code
+        loaded = time.perf_counter()
+        try:
+            code = downgrade_py39_code_to_py38(code, optimize=optimize)
+        except Exception:
+            failures += 1
+            continue
+        downgraded = time.perf_counter()
+        output_bytes += len(pyc_io.dump_py38_code(code))
+        marshalled = time.perf_counter()
+
+        times["load"] += loaded - start
+        times["downgrade"] += downgraded - loaded
+        times["marshal"] += marshalled - downgraded
+    return {"times": times, "output_bytes": output_bytes, "failures": failures}
+
+
+def peak_rss_mib() -> typing.Optional[float]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def run_benchmarks(
+    files: typing.List[pathlib.Path], repeat: int, optimize: bool = False
+) -> dict:
+    runs = [run_once(files, optimize) for _ in range(repeat)]
+    input_bytes = sum(path.stat().st_size for path in files)
+    stages = {}
+    for stage in STAGES:
+        seconds = min(run["times"][stage] for run in runs)
+        stages[stage] = {
+            "seconds": seconds,
+            "files_per_second": len(files) / seconds if seconds else None,
+            "bytes_per_second": input_bytes / seconds if seconds else None,
+        }
+    return {
+        "commit": current_commit(),
+        "python": platform.python_version(),
+        "files": len(files),
+        "input_bytes": input_bytes,
+        "output_bytes": runs[0]["output_bytes"],
+        "failures": runs[0]["failures"],
+        "peak_rss_mib": peak_rss_mib(),
+        "stages": stages,
+    }
+
+
+def current_commit() -> typing.Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=str(REPOSITORY_FOLDER),
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def baseline_mismatch(results: dict, baseline: dict) -> typing.Optional[str]:
+    """Why `baseline` can't be compared with `results`, if it can't."""
+    if (baseline.get("files"), baseline.get("input_bytes")) != (
+        results["files"],
+        results["input_bytes"],
+    ):
+        return "it was taken over a different corpus"
+    if baseline.get("python") != results["python"]:
+        return "it was taken with Python %s" % baseline.get("python")
+    return None
+
+
+def print_results(results: dict, baseline: typing.Optional[dict]) -> None:
+    print(
+        "%d files, %.1f MiB in, %.1f MiB out, %d failed to downgrade"
+        % (
+            results["files"],
+            results["input_bytes"] / 2 ** 20,
+            results["output_bytes"] / 2 ** 20,
+            results["failures"],
+        )
+    )
+    for stage in STAGES:
+        result = results["stages"][stage]
+        line = "%-10s %8.3fs %9.0f files/s %8.2f MiB/s" % (
+            stage,
+            result["seconds"],
+            result["files_per_second"] or 0,
+            (result["bytes_per_second"] or 0) / 2 ** 20,
+        )
+        if baseline is not None and stage in baseline["stages"]:
+            line += "  (%+.1f%% vs baseline)" % (
+                _change(baseline["stages"][stage]["seconds"], result["seconds"])
+            )
+        print(line)
+    if results["peak_rss_mib"] is not None:
+        print("peak RSS   %8.1f MiB" % results["peak_rss_mib"])
+
+
+def find_regressions(results: dict, baseline: dict, tolerance: float) -> list:
+    """Stages that got more than `tolerance` percent slower than baseline."""
+    regressions = []
+    for stage in STAGES:
+        if stage not in baseline["stages"]:
+            continue
+        change = _change(
+            baseline["stages"][stage]["seconds"], results["stages"][stage]["seconds"]
+        )
+        if change > tolerance:
+            regressions.append("%s is %.1f%% slower than baseline" % (stage, change))
+    return regressions
+
+
+def _change(before: float, after: float) -> float:
+    return (after - before) / before * 100 if before else 0.0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Benchmark pydowngrade over a corpus of 3.9 pyc files"
+    )
+    parser.add_argument(
+        "--python39",
+        default=sys.executable if sys.version_info[:2] == (3, 9) else "python3.9",
+        help="Python 3.9 interpreter used to compile the corpus",
+    )
+    parser.add_argument(
+        "--corpus-dir", type=pathlib.Path,
+        help="Keep the compiled corpus here instead of a temporary directory",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--optimize", action="store_true", help="Include the peephole pass"
+    )
+    parser.add_argument("--baseline", type=pathlib.Path, default=DEFAULT_BASELINE)
+    parser.add_argument(
+        "--save-baseline", action="store_true",
+        help="Store these results as the new baseline",
+    )
+    parser.add_argument(
+        "--tolerance", type=float, default=10.0,
+        help="Percent slowdown of a stage that counts as a regression",
+    )
+    parser.add_argument("--json", type=pathlib.Path, help="Also write results here")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        corpus = args.corpus_dir or pathlib.Path(temporary_dir)
+        if args.corpus_dir is not None and any(corpus.glob("*.pyc")):
+            files = sorted(corpus.glob("*.pyc"))
+        else:
+            files = build_corpus(args.python39, corpus)
+        results = run_benchmarks(files, args.repeat, args.optimize)
+
+    baseline = None
+    if args.baseline.exists() and not args.save_baseline:
+        baseline = json.loads(args.baseline.read_text())
+        mismatch = baseline_mismatch(results, baseline)
+        if mismatch is not None:
+            print("Not comparing with the baseline, %s" % mismatch)
+            baseline = None
+        else:
+            print(
+                "Comparing with the baseline taken at %s"
+                % (baseline.get("commit") or "an unknown commit")
+            )
+    print_results(results, baseline)
+
+    if args.json is not None:
+        args.json.write_text(json.dumps(results, indent=2) + "\n")
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(results, indent=2) + "\n")
+        return 0
+    if baseline is not None:
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(regression, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,11 @@
+__all__ = ["downgrade_many", "downgrade_pyc_bytes", "downgrade_pyc_bytes_into"]
+
+
+def __getattr__(name: str):
+    # The API is only imported once it's used so that the command line client
+    # starts quickly.
+    if name in __all__:
+        from . import api
+
+        return getattr(api, name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -1,11 +1,260 @@
-import time
+import argparse
+import pathlib
+import py_compile
 import sys
+import time
+import zipfile
+
+from .archive import convert_archive
+from .batch import convert_file, convert_tree
+from .cache import DEFAULT_MAX_SIZE, DowngradeCache
+from .incremental import convert_tree_incremental, watch_tree
+from .pipeline import DEFAULT_QUEUE_DEPTH
+from .sharding import Shard, convert_shard, read_input_manifest
+from .stats import DowngradeStats
+
+# The same names as compileall's --invalidation-mode.
+INVALIDATION_MODES = {
+    mode.name.lower().replace("_", "-"): mode
+    for mode in py_compile.PycInvalidationMode
+}
+
+
+def _shard(spec: str) -> Shard:
+    try:
+        return Shard.parse(spec)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def main(argv=None) -> int:
+    if argv is None:
+        argv = sys.argv[1:]
+    if "--persistent_worker" in argv:
+        # Started by Bazel as a persistent worker for its actions, which pass
+        # the rest of their arguments in the work requests.
+        from . import worker
+
+        return worker.main(argv)
+
+    parser = argparse.ArgumentParser(
+        prog="pydowngrade",
+        description="Downgrades Python 3.9 bytecode so it can run on 3.8.",
+        # Flagfiles, with one argument per line.
+        fromfile_prefix_chars="@",
+    )
+    parser.add_argument(
+        "input",
+        type=pathlib.Path,
+        help="3.9 or 3.10 pyc file, directory of them or zip archive (wheel, zipapp)",
+    )
+    parser.add_argument(
+        "output", type=pathlib.Path, help="3.8 pyc file, directory or archive"
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="number of worker processes for directories (default: CPU count)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=pathlib.Path,
+        default=None,
+        help="directory to cache downgraded code in across runs",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=DEFAULT_MAX_SIZE // (1024 * 1024),
+        help="maximum size of the cache in MiB (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-O",
+        "--optimize",
+        action="store_true",
+        help="run a peephole pass over the downgraded bytecode",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="statically check the downgraded bytecode before writing it, "
+        "files that fail are reported as failures",
+    )
+    parser.add_argument(
+        "--invalidation-mode",
+        choices=sorted(INVALIDATION_MODES),
+        default=None,
+        help="how 3.8 checks the outputs are up to date with their source "
+        "(default: the same way as the inputs)",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only convert inputs of a directory that changed since the last run",
+    )
+    parser.add_argument(
+        "--watch",
+        type=float,
+        nargs="?",
+        const=1.0,
+        default=None,
+        metavar="INTERVAL",
+        help="keep converting a directory incrementally every INTERVAL seconds "
+        "(default: %(const)s)",
+    )
+    parser.add_argument(
+        "--pipeline",
+        type=int,
+        nargs="?",
+        const=DEFAULT_QUEUE_DEPTH,
+        default=None,
+        metavar="QUEUE_DEPTH",
+        help="convert directories with separate reader, worker and writer "
+        "stages, holding at most QUEUE_DEPTH files per stage (default: "
+        "%(const)s)",
+    )
+    parser.add_argument(
+        "--shard",
+        type=_shard,
+        default=None,
+        metavar="I/N",
+        help="only convert shard I of N (counting from 1) of a directory's "
+        "files, split by size so the shards take about as long, see "
+        "pydowngrade.sharding",
+    )
+    parser.add_argument(
+        "--manifest",
+        type=pathlib.Path,
+        default=None,
+        help="input manifest of the files to convert, instead of all of the "
+        "input directory's",
+    )
+    parser.add_argument(
+        "--shard-manifest",
+        type=pathlib.Path,
+        default=None,
+        help="where to write the result manifest of a shard (default: in the "
+        "output directory)",
+    )
+    parser.add_argument(
+        "--stats",
+        type=pathlib.Path,
+        default=None,
+        help="write per-stage timings and rewrite counts to this JSON file",
+    )
+    args = parser.parse_args(argv)
+
+    cache = None
+    if args.cache_dir is not None:
+        cache = DowngradeCache(args.cache_dir, args.cache_size * 1024 * 1024)
+
+    stats = DowngradeStats() if args.stats is not None else None
+    invalidation_mode = INVALIDATION_MODES.get(args.invalidation_mode)
+    if args.pipeline is not None and args.pipeline < 1:
+        parser.error("--pipeline needs a queue depth of at least 1")
+    if (args.incremental or args.watch is not None) and not args.input.is_dir():
+        parser.error("--incremental and --watch need an input directory")
+    sharded = args.shard is not None or args.manifest is not None
+    if sharded and not args.input.is_dir():
+        parser.error("--shard and --manifest need an input directory")
+    if sharded and (args.incremental or args.watch is not None):
+        parser.error("--shard and --manifest can't be used incrementally")
+    sizes = None
+    if args.manifest is not None:
+        try:
+            sizes = read_input_manifest(args.manifest)
+        except (OSError, ValueError) as e:
+            parser.error("can't read the manifest: %s" % e)
+    if args.watch is not None:
+        try:
+            watch_tree(
+                args.input,
+                args.output,
+                args.watch,
+                lambda result: print(result.summary(), flush=True),
+                jobs=args.jobs,
+                cache=cache,
+                optimize=args.optimize,
+                queue_depth=args.pipeline,
+                invalidation_mode=invalidation_mode,
+                verify=args.verify,
+            )
+        except KeyboardInterrupt:
+            return 0
+
+    if args.input.is_dir() or zipfile.is_zipfile(args.input):
+        if sharded:
+            result = convert_shard(
+                args.input,
+                args.output,
+                args.shard or Shard(1, 1),
+                sizes,
+                args.shard_manifest,
+                args.jobs,
+                cache,
+                optimize=args.optimize,
+                queue_depth=args.pipeline,
+                invalidation_mode=invalidation_mode,
+                verify=args.verify,
+            )
+        elif args.input.is_dir() and args.incremental:
+            result = convert_tree_incremental(
+                args.input,
+                args.output,
+                args.jobs,
+                cache,
+                stats is not None,
+                optimize=args.optimize,
+                queue_depth=args.pipeline,
+                invalidation_mode=invalidation_mode,
+                verify=args.verify,
+            )
+        elif args.input.is_dir():
+            result = convert_tree(
+                args.input,
+                args.output,
+                args.jobs,
+                cache,
+                stats is not None,
+                args.optimize,
+                args.pipeline,
+                invalidation_mode,
+                args.verify,
+            )
+        else:
+            result = convert_archive(
+                args.input,
+                args.output,
+                cache=cache,
+                stats=stats,
+                optimize=args.optimize,
+                invalidation_mode=invalidation_mode,
+                verify=args.verify,
+            )
+        print(result.summary())
+        if stats is not None:
+            args.stats.write_text(result.stats.to_json() + "\n")
+        return 1 if result.failures else 0
+
+    result = convert_file(
+        args.input,
+        args.output,
+        int(time.time()),
+        cache,
+        stats,
+        args.optimize,
+        invalidation_mode,
+        args.verify,
+    )
+    if stats is not None:
+        args.stats.write_text(stats.to_json() + "\n")
+    if result.error is not None:
+        print(result.error, end="", file=sys.stderr)
+        return 1
+    return 0
 
-from .downgrade_transformer import downgrade_py39_code_to_py38
-from .pyc_io import Py39CompiledFile, output_py38_pyc_file
 
 if __name__ == '__main__':
-    pyc = Py39CompiledFile(sys.argv[1])
-    with open(sys.argv[2], 'wb') as f:
-        py38_code = downgrade_py39_code_to_py38(pyc.code)
-        output_py38_pyc_file(py38_code, f, int(time.time()))
+    sys.exit(main())
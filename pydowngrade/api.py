@@ -0,0 +1,108 @@
+"""
+Downgrading pyc files held in memory, for embedding the library in services
+that never see the files on disk:
+
+    import pydowngrade
+    py38_pyc = pydowngrade.downgrade_pyc_bytes(py39_pyc)
+
+Inputs can be any bytes-like object (`bytes`, `memoryview`, `mmap`, ...) and
+are read in place. Nothing is read from or written to the filesystem.
+"""
+import py_compile
+import typing
+
+from .batch import downgrade_pyc_data
+from .pyc_io import py38_pyc_header
+from .stats import DowngradeStats
+from .unmarshal39 import read_pyc_header
+
+
+def downgrade_pyc_bytes(
+    data,
+    optimize: bool = False,
+    verify: bool = False,
+    invalidation_mode: typing.Optional[py_compile.PycInvalidationMode] = None,
+    source: typing.Optional[bytes] = None,
+    stats: typing.Optional[DowngradeStats] = None,
+) -> bytes:
+    """
+    Downgrades the 3.9 or 3.10 pyc file in `data`, returning the 3.8 pyc
+    file, header included. A `ValueError` is raised if `data` isn't a valid
+    3.9 or 3.10 pyc file, or if `verify` is set and the downgraded code
+    doesn't pass `verify_py38_code`.
+
+    The header is built by `py38_pyc_header` from the input's. `source` is
+    only needed to recompute hashes, or to switch to a hash based
+    `invalidation_mode`.
+    """
+    header, serialized_code = _downgrade(
+        data, optimize, verify, invalidation_mode, source, stats
+    )
+    return header + serialized_code
+
+
+def downgrade_pyc_bytes_into(
+    data,
+    buffer,
+    optimize: bool = False,
+    verify: bool = False,
+    invalidation_mode: typing.Optional[py_compile.PycInvalidationMode] = None,
+    source: typing.Optional[bytes] = None,
+    stats: typing.Optional[DowngradeStats] = None,
+) -> int:
+    """
+    Like `downgrade_pyc_bytes`, but writes the 3.8 pyc file at the start of
+    the writable bytes-like object `buffer` and returns its size. A
+    `ValueError` is raised, and nothing written, if `buffer` is too small.
+    """
+    header, serialized_code = _downgrade(
+        data, optimize, verify, invalidation_mode, source, stats
+    )
+    size = len(header) + len(serialized_code)
+    with memoryview(buffer) as view, view.cast("B") as output:
+        if output.readonly:
+            raise TypeError("Can't write the pyc file to a read-only buffer")
+        if len(output) < size:
+            raise ValueError(
+                "The pyc file is %d bytes but the buffer only holds %d"
+                % (size, len(output))
+            )
+        output[: len(header)] = header
+        output[len(header) : size] = serialized_code
+    return size
+
+
+def downgrade_many(
+    datas: typing.Iterable,
+    optimize: bool = False,
+    verify: bool = False,
+    invalidation_mode: typing.Optional[py_compile.PycInvalidationMode] = None,
+    stats: typing.Optional[DowngradeStats] = None,
+) -> typing.Iterator[bytes]:
+    """
+    Lazily downgrades each of the 3.9 pyc files in `datas` with
+    `downgrade_pyc_bytes`, yielding the 3.8 pyc files in the same order.
+    Only one input is held at a time. The first invalid input stops the
+    iteration with a `ValueError`.
+    """
+    for data in datas:
+        header, serialized_code = _downgrade(
+            data, optimize, verify, invalidation_mode, None, stats
+        )
+        yield header + serialized_code
+
+
+def _downgrade(
+    data,
+    optimize: bool,
+    verify: bool,
+    invalidation_mode: typing.Optional[py_compile.PycInvalidationMode],
+    source: typing.Optional[bytes],
+    stats: typing.Optional[DowngradeStats],
+) -> typing.Tuple[bytes, bytes]:
+    with memoryview(data) as view:
+        header = py38_pyc_header(read_pyc_header(view), invalidation_mode, source)
+        serialized_code, _ = downgrade_pyc_data(
+            view, "<memory>", None, stats, optimize, verify
+        )
+    return header, serialized_code
@@ -0,0 +1,216 @@
+import base64
+import csv
+import hashlib
+import io
+import os
+import pathlib
+import py_compile
+import time
+import traceback
+import typing
+import zipfile
+
+from .batch import (
+    BatchResult,
+    FileResult,
+    downgrade_pyc_data,
+    is_py39_pyc_path,
+    needs_source,
+    py38_pyc_path,
+    source_path_for,
+)
+from .cache import DowngradeCache
+from .pyc_io import py38_pyc_header
+from .stats import DowngradeStats
+from .unmarshal39 import read_pyc_header
+
+DATA_DESCRIPTOR_FLAG = 0x08
+
+
+def convert_archive(
+    input_path: pathlib.Path,
+    output_path: pathlib.Path,
+    timestamp: typing.Optional[int] = None,
+    cache: typing.Optional[DowngradeCache] = None,
+    stats: typing.Optional[DowngradeStats] = None,
+    optimize: bool = False,
+    invalidation_mode: typing.Optional[py_compile.PycInvalidationMode] = None,
+    verify: bool = False,
+) -> BatchResult:
+    """
+    Copies the zip archive (wheel, zipapp, ...) at `input_path` to
+    `output_path`, downgrading every 3.9 pyc member in memory along the way.
+
+    Other members are copied over still compressed. If the archive has a
+    wheel `RECORD` file, its entries for the downgraded files are updated.
+    Members that fail to downgrade are copied unchanged and reported in the
+    result, which includes the ones `verify` rejects. If `stats` is given it
+    is recorded into and kept on the result. Anything before the first
+    member, like a zipapp's shebang line, is kept and so is the file's mode.
+
+    Headers are carried over as in `batch.convert_file`, with sources read
+    from the archive. `timestamp` is only used when there's no source mtime
+    to go on.
+    """
+    start = time.perf_counter()
+    if timestamp is None:
+        timestamp = int(time.time())
+
+    result = BatchResult(stats)
+    # Maps original member names to their (new name, hash, size) RECORD entry.
+    record_updates = {}
+    records = []
+    with zipfile.ZipFile(input_path) as source, open(output_path, "wb") as output:
+        # Written before the archive, the way zipapp writes the shebang.
+        prefix_size = min(
+            (info.header_offset for info in source.infolist()),
+            default=source.start_dir,
+        )
+        source.fp.seek(0)
+        output.write(source.fp.read(prefix_size))
+        with zipfile.ZipFile(output, "w") as destination:
+            for info in source.infolist():
+                name = pathlib.PurePosixPath(info.filename)
+                if name.name == "RECORD" and name.parent.suffix == ".dist-info":
+                    # Written last, once we know the hashes of every member.
+                    records.append(info)
+                    continue
+                if info.is_dir() or not is_py39_pyc_path(name):
+                    _copy_raw_member(source, destination, info)
+                    continue
+
+                input_data = source.read(info)
+                try:
+                    serialized_code, cache_hit = downgrade_pyc_data(
+                        input_data, info.filename, cache, stats, optimize, verify
+                    )
+                    header = py38_pyc_header(
+                        read_pyc_header(input_data),
+                        invalidation_mode,
+                        _read_source(source, name, input_data, invalidation_mode),
+                        timestamp,
+                    )
+                except Exception:
+                    result.add(FileResult(name, name, error=traceback.format_exc()))
+                    _copy_raw_member(source, destination, info)
+                    continue
+
+                output_data = header + serialized_code
+
+                output_name = py38_pyc_path(name)
+                output_info = _copy_info(info, str(output_name))
+                destination.writestr(output_info, output_data)
+
+                record_updates[info.filename] = (
+                    output_info.filename,
+                    _record_hash(output_data),
+                    str(len(output_data)),
+                )
+                result.add(
+                    FileResult(
+                        name,
+                        output_name,
+                        info.file_size,
+                        len(output_data),
+                        cache_hit,
+                        input_sha256=hashlib.sha256(input_data).hexdigest(),
+                        output_sha256=hashlib.sha256(output_data).hexdigest(),
+                    )
+                )
+
+            for info in records:
+                record = _rewrite_record(source.read(info), record_updates)
+                destination.writestr(_copy_info(info, info.filename), record)
+    os.chmod(output_path, os.stat(input_path).st_mode & 0o777)
+
+    result.elapsed = time.perf_counter() - start
+    return result
+
+
+def _read_source(
+    archive: zipfile.ZipFile,
+    name: pathlib.PurePosixPath,
+    input_data: bytes,
+    invalidation_mode: typing.Optional[py_compile.PycInvalidationMode],
+) -> typing.Optional[bytes]:
+    if not needs_source(input_data, invalidation_mode):
+        return None
+    try:
+        return archive.read(str(source_path_for(name)))
+    except KeyError:
+        return None
+
+
+def _copy_info(info: zipfile.ZipInfo, filename: str) -> zipfile.ZipInfo:
+    output_info = zipfile.ZipInfo(filename, info.date_time)
+    output_info.compress_type = info.compress_type
+    output_info.comment = info.comment
+    output_info.create_system = info.create_system
+    output_info.external_attr = info.external_attr
+    return output_info
+
+
+def _record_hash(data: bytes) -> str:
+    digest = hashlib.sha256(data).digest()
+    return "sha256=" + base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+
+def _rewrite_record(
+    record: bytes, updates: typing.Dict[str, typing.Tuple[str, str, str]]
+) -> bytes:
+    rows = []
+    for row in csv.reader(io.StringIO(record.decode("utf-8"))):
+        if row and row[0] in updates:
+            row = list(updates[row[0]])
+        rows.append(row)
+
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator="\n")
+    writer.writerows(rows)
+    return output.getvalue().encode("utf-8")
+
+
+def _copy_raw_member(
+    source: zipfile.ZipFile, destination: zipfile.ZipFile, info: zipfile.ZipInfo
+) -> None:
+    """
+    Copies a member from `source` to `destination` without decompressing and
+    recompressing it.
+
+    zipfile has no public API for this, so this writes the local file header
+    and compressed data itself and then does the same bookkeeping
+    `ZipFile.writestr` does.
+    """
+    # Skip over the local file header to the compressed data. Its name and
+    # extra field lengths can differ from the central directory's copy.
+    source.fp.seek(info.header_offset)
+    header = source.fp.read(zipfile.sizeFileHeader)
+    name_length = int.from_bytes(header[26:28], "little")
+    extra_length = int.from_bytes(header[28:30], "little")
+    source.fp.seek(name_length + extra_length, io.SEEK_CUR)
+
+    output_info = _copy_info(info, info.filename)
+    # Sizes and CRC go straight into the header, so no data descriptor.
+    output_info.flag_bits = info.flag_bits & ~DATA_DESCRIPTOR_FLAG
+    output_info.CRC = info.CRC
+    output_info.compress_size = info.compress_size
+    output_info.file_size = info.file_size
+
+    zip64 = (
+        info.file_size > zipfile.ZIP64_LIMIT
+        or info.compress_size > zipfile.ZIP64_LIMIT
+    )
+    output_info.header_offset = destination.fp.tell()
+    destination.fp.write(output_info.FileHeader(zip64))
+    remaining = info.compress_size
+    while remaining:
+        chunk = source.fp.read(min(remaining, 1024 * 1024))
+        if not chunk:
+            raise zipfile.BadZipFile("Truncated member %s" % info.filename)
+        destination.fp.write(chunk)
+        remaining -= len(chunk)
+
+    destination.filelist.append(output_info)
+    destination.NameToInfo[output_info.filename] = output_info
+    destination.start_dir = destination.fp.tell()
+    destination._didModify = True
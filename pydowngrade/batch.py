@@ -0,0 +1,458 @@
+import concurrent.futures
+import hashlib
+import os
+import pathlib
+import py_compile
+import time
+import traceback
+import typing
+
+from .cache import DowngradeCache
+from .downgrade_transformer import downgrade_code_to_py38
+from .pyc_io import (
+    FLAG_HASH_BASED,
+    CompiledFile,
+    dump_py38_code,
+    py38_pyc_header,
+    stream_py38_pyc_atomically,
+    write_py38_pyc_atomically,
+)
+from .stats import DowngradeStats, timed
+from .unmarshal39 import read_pyc_header
+from .verify import verify_py38_code
+
+if typing.TYPE_CHECKING:
+    import xdis
+
+PY39_CACHE_TAG = ".cpython-39"
+PY310_CACHE_TAG = ".cpython-310"
+PY38_CACHE_TAG = ".cpython-38"
+
+
+class ConversionTask(typing.NamedTuple):
+    """The arguments of one `convert_file` call in a batch."""
+
+    input_path: pathlib.Path
+    output_path: pathlib.Path
+    timestamp: typing.Optional[int] = None
+    cache: typing.Optional[DowngradeCache] = None
+    optimize: bool = False
+    collect_stats: bool = False
+    invalidation_mode: typing.Optional[py_compile.PycInvalidationMode] = None
+    verify: bool = False
+
+
+class FileResult(typing.NamedTuple):
+    input_path: pathlib.Path
+    output_path: pathlib.Path
+    input_size: int = 0
+    output_size: int = 0
+    # None if no cache was used.
+    cache_hit: typing.Optional[bool] = None
+    # Formatted exception if the file failed to convert.
+    error: typing.Optional[str] = None
+    # Only collected when the batch was asked for stats.
+    stats: typing.Optional[DowngradeStats] = None
+    # Hex SHA-256 digests of the input as read and the output as written.
+    input_sha256: typing.Optional[str] = None
+    output_sha256: typing.Optional[str] = None
+
+
+class BatchResult:
+    """Summary of a batch conversion, collected from every converted file."""
+
+    def __init__(self, stats: typing.Optional[DowngradeStats] = None) -> None:
+        self.converted: typing.List[FileResult] = []
+        self.failures: typing.List[FileResult] = []
+        # Only used by incremental conversions, inputs that were skipped
+        # because they hadn't changed and outputs deleted because their input
+        # is gone.
+        self.unchanged = 0
+        self.removed: typing.List[pathlib.Path] = []
+        self.elapsed = 0.0
+        # Totals of the stats of every added file, if collected.
+        self.stats = stats
+
+    def add(self, result: FileResult) -> None:
+        if result.stats is not None:
+            if self.stats is None:
+                self.stats = DowngradeStats()
+            self.stats.merge(result.stats)
+        if result.error is None:
+            self.converted.append(result)
+        else:
+            self.failures.append(result)
+
+    @property
+    def cache_hits(self) -> int:
+        return sum(result.cache_hit is True for result in self.converted)
+
+    @property
+    def cache_misses(self) -> int:
+        return sum(result.cache_hit is False for result in self.converted)
+
+    @property
+    def input_bytes(self) -> int:
+        return sum(result.input_size for result in self.converted)
+
+    @property
+    def output_bytes(self) -> int:
+        return sum(result.output_size for result in self.converted)
+
+    def summary(self) -> str:
+        elapsed = max(self.elapsed, 1e-9)
+        lines = [
+            "Converted %d files (%d bytes) in %.2fs: %.1f files/s, %.1f KiB/s"
+            % (
+                len(self.converted),
+                self.input_bytes,
+                self.elapsed,
+                len(self.converted) / elapsed,
+                self.input_bytes / elapsed / 1024,
+            )
+        ]
+        if self.unchanged or self.removed:
+            lines.append(
+                "Skipped %d unchanged files, removed %d stale outputs"
+                % (self.unchanged, len(self.removed))
+            )
+        if self.cache_hits or self.cache_misses:
+            lines.append(
+                "Cache: %d hits, %d misses" % (self.cache_hits, self.cache_misses)
+            )
+        if self.failures:
+            lines.append("Failed to convert %d files:" % len(self.failures))
+            for failure in self.failures:
+                last_line = failure.error.strip().splitlines()[-1]
+                lines.append("  %s: %s" % (failure.input_path, last_line))
+        return "\n".join(lines)
+
+
+def find_pyc_files(input_root: pathlib.Path) -> typing.Iterator[pathlib.Path]:
+    """
+    Walks `input_root` yielding the pyc files to convert. Inside `__pycache__`
+    directories only files tagged for CPython 3.9 or 3.10 are picked up, any
+    other pyc file is assumed to be a sourceless 3.9 or 3.10 module.
+    """
+    for directory, subdirectories, filenames in os.walk(input_root):
+        subdirectories.sort()
+        for filename in sorted(filenames):
+            path = pathlib.Path(directory, filename)
+            if is_py39_pyc_path(path):
+                yield path
+
+
+def is_py39_pyc_path(path: pathlib.PurePath) -> bool:
+    if path.suffix != ".pyc":
+        return False
+    if path.parent.name == "__pycache__":
+        return _source_cache_tag(path.name) is not None
+    return True
+
+
+def py38_pyc_path(path: pathlib.PurePath) -> pathlib.PurePath:
+    """Renames a `__pycache__` entry's 3.9 or 3.10 cache tag to the 3.8 one."""
+    if path.parent.name != "__pycache__":
+        return path
+    cache_tag = _source_cache_tag(path.name)
+    if cache_tag is None:
+        return path
+    return path.with_name(path.name.replace(cache_tag, PY38_CACHE_TAG + ".", 1))
+
+
+def _source_cache_tag(filename: str) -> typing.Optional[str]:
+    for cache_tag in (PY39_CACHE_TAG + ".", PY310_CACHE_TAG + "."):
+        if cache_tag in filename:
+            return cache_tag
+    return None
+
+
+def output_path_for(
+    input_root: pathlib.Path, output_root: pathlib.Path, input_path: pathlib.Path
+) -> pathlib.Path:
+    """
+    Maps a pyc file found under `input_root` to the same place under
+    `output_root`, renaming `__pycache__` entries to their 3.8 cache tag.
+    """
+    return output_root / py38_pyc_path(input_path.relative_to(input_root))
+
+
+def source_path_for(pyc_path: pathlib.PurePath) -> pathlib.PurePath:
+    """Where the source of a pyc file would be, the module next to the
+    `__pycache__` directory or next to a sourceless pyc file."""
+    if pyc_path.parent.name == "__pycache__":
+        module_name = pyc_path.name.partition(".")[0]
+        return pyc_path.parent.parent / (module_name + ".py")
+    return pyc_path.with_suffix(".py")
+
+
+def needs_source(
+    input_data: bytes,
+    invalidation_mode: typing.Optional[py_compile.PycInvalidationMode],
+) -> bool:
+    """Whether `py38_pyc_header` needs the source to build a faithful header
+    for this pyc, which is only the case when hashes are involved."""
+    flags = int.from_bytes(input_data[4:8], "little")
+    if invalidation_mode is None:
+        return bool(flags & FLAG_HASH_BASED)
+    return (
+        bool(flags & FLAG_HASH_BASED)
+        or invalidation_mode != py_compile.PycInvalidationMode.TIMESTAMP
+    )
+
+
+def output_header_for(
+    input_path: pathlib.Path,
+    input_data: bytes,
+    timestamp: typing.Optional[int] = None,
+    invalidation_mode: typing.Optional[py_compile.PycInvalidationMode] = None,
+) -> bytes:
+    """The header for the 3.8 pyc of the 3.9 pyc file at `input_path`, see
+    `py38_pyc_header`. Its source is read if needed and it exists."""
+    source = None
+    if needs_source(input_data, invalidation_mode):
+        source_path = source_path_for(input_path)
+        try:
+            source = source_path.read_bytes()
+            timestamp = int(source_path.stat().st_mtime)
+        except OSError:
+            pass
+    return py38_pyc_header(
+        read_pyc_header(input_data), invalidation_mode, source, timestamp
+    )
+
+
+def convert_file(
+    input_path: pathlib.Path,
+    output_path: pathlib.Path,
+    timestamp: typing.Optional[int] = None,
+    cache: typing.Optional[DowngradeCache] = None,
+    stats: typing.Optional[DowngradeStats] = None,
+    optimize: bool = False,
+    invalidation_mode: typing.Optional[py_compile.PycInvalidationMode] = None,
+    verify: bool = False,
+) -> FileResult:
+    """
+    Downgrades a single pyc file, catching any errors so one bad file doesn't
+    stop a batch. If a `cache` is given, previously downgraded code for the
+    same input is reused without loading it. With `verify`, freshly
+    downgraded code is checked by `verify_py38_code` before being written.
+
+    The output is validated against the source the same way as the input, or
+    as `invalidation_mode` says, see `output_header_for`. `timestamp` is only
+    used when there's no source mtime to go on.
+
+    Without a cache, the code is marshalled straight into the output file
+    rather than in memory first.
+    """
+    input_sha256 = None
+    try:
+        input_data = input_path.read_bytes()
+        input_sha256 = hashlib.sha256(input_data).hexdigest()
+        output_digest = hashlib.sha256()
+        if cache is None:
+            _count_input(stats, input_data)
+            code = _downgrade_pyc_code(
+                input_data, str(input_path), stats, optimize, verify
+            )
+            header = output_header_for(
+                input_path, input_data, timestamp, invalidation_mode
+            )
+            with timed(stats, "marshal"):
+                output_size = stream_py38_pyc_atomically(
+                    output_path, header, code, output_digest
+                )
+            if stats is not None:
+                stats.bytes_out += output_size - len(header)
+            cache_hit = None
+        else:
+            serialized_code, cache_hit = downgrade_pyc_data(
+                input_data, str(input_path), cache, stats, optimize, verify
+            )
+            header = output_header_for(
+                input_path, input_data, timestamp, invalidation_mode
+            )
+            output_size = write_py38_pyc_atomically(
+                output_path, header, serialized_code, output_digest
+            )
+        return FileResult(
+            input_path,
+            output_path,
+            len(input_data),
+            output_size,
+            cache_hit,
+            input_sha256=input_sha256,
+            output_sha256=output_digest.hexdigest(),
+        )
+    except Exception:
+        return FileResult(
+            input_path,
+            output_path,
+            error=traceback.format_exc(),
+            input_sha256=input_sha256,
+        )
+
+
+def downgrade_pyc_data(
+    input_data: bytes,
+    filename: str = "<unknown>",
+    cache: typing.Optional[DowngradeCache] = None,
+    stats: typing.Optional[DowngradeStats] = None,
+    optimize: bool = False,
+    verify: bool = False,
+) -> typing.Tuple[bytes, typing.Optional[bool]]:
+    """
+    Downgrades the contents of a 3.9 pyc file, returning the marshalled 3.8
+    code (without a pyc header) and whether it came from `cache`. `optimize`
+    enables the peephole pass. `verify` runs `verify_py38_code` over the
+    downgraded code, code from the cache isn't checked again.
+    """
+    _count_input(stats, input_data)
+    if cache is None:
+        serialized_code = _downgrade_pyc_data(
+            input_data, filename, stats, optimize, verify
+        )
+        cache_hit = None
+    else:
+        key = cache.key_for(input_data, optimize)
+        serialized_code = cache.get(key)
+        cache_hit = serialized_code is not None
+        if not cache_hit:
+            serialized_code = _downgrade_pyc_data(
+                input_data, filename, stats, optimize, verify
+            )
+            cache.put(key, serialized_code)
+
+    if stats is not None:
+        stats.bytes_out += len(serialized_code)
+    return serialized_code, cache_hit
+
+
+def _count_input(stats: typing.Optional[DowngradeStats], input_data: bytes) -> None:
+    if stats is not None:
+        stats.files += 1
+        stats.bytes_in += len(input_data)
+
+
+def _downgrade_pyc_data(
+    input_data: bytes,
+    filename: str,
+    stats: typing.Optional[DowngradeStats],
+    optimize: bool,
+    verify: bool,
+) -> bytes:
+    code = _downgrade_pyc_code(input_data, filename, stats, optimize, verify)
+    with timed(stats, "marshal"):
+        return dump_py38_code(code)
+
+
+def _downgrade_pyc_code(
+    input_data: bytes,
+    filename: str,
+    stats: typing.Optional[DowngradeStats],
+    optimize: bool,
+    verify: bool,
+) -> "xdis.Code38":
+    with timed(stats, "load"):
+        pyc = CompiledFile.from_bytes(input_data, filename)
+    with timed(stats, "transform"):
+        code = downgrade_code_to_py38(pyc.code, pyc.header.version, stats, optimize)
+    if verify:
+        with timed(stats, "verify"):
+            verify_py38_code(code)
+    return code
+
+
+def _convert_file_task(task: ConversionTask) -> FileResult:
+    # Each file gets its own stats so they make it back from worker processes
+    # and can be merged into the batch's.
+    stats = DowngradeStats() if task.collect_stats else None
+    result = convert_file(
+        task.input_path,
+        task.output_path,
+        task.timestamp,
+        task.cache,
+        stats,
+        task.optimize,
+        task.invalidation_mode,
+        task.verify,
+    )
+    return result._replace(stats=stats)
+
+
+def convert_tree(
+    input_root: pathlib.Path,
+    output_root: pathlib.Path,
+    jobs: typing.Optional[int] = None,
+    cache: typing.Optional[DowngradeCache] = None,
+    collect_stats: bool = False,
+    optimize: bool = False,
+    queue_depth: typing.Optional[int] = None,
+    invalidation_mode: typing.Optional[py_compile.PycInvalidationMode] = None,
+    verify: bool = False,
+) -> BatchResult:
+    """
+    Downgrades every pyc file under `input_root` into a mirrored layout under
+    `output_root`, spreading the work over `jobs` processes. Failures are
+    collected in the result rather than raised. `optimize` enables the
+    peephole pass, `invalidation_mode` and `verify` are passed on to
+    `convert_file`.
+
+    With `collect_stats`, every worker's `DowngradeStats` are merged into the
+    result's `stats`. With a `queue_depth`, the tree is converted by the
+    pipelined engine in `pipeline`, walking it as it goes.
+    """
+    start = time.perf_counter()
+    input_root = pathlib.Path(input_root)
+    output_root = pathlib.Path(output_root)
+    timestamp = int(time.time())
+    tasks = (
+        ConversionTask(
+            path,
+            output_path_for(input_root, output_root, path),
+            timestamp,
+            cache,
+            optimize,
+            collect_stats,
+            invalidation_mode,
+            verify,
+        )
+        for path in find_pyc_files(input_root)
+    )
+    if queue_depth is None:
+        tasks = list(tasks)
+
+    result = BatchResult(DowngradeStats() if collect_stats else None)
+    run_tasks(tasks, jobs, result, queue_depth)
+    result.elapsed = time.perf_counter() - start
+    return result
+
+
+def run_tasks(
+    tasks: typing.Iterable[ConversionTask],
+    jobs: typing.Optional[int],
+    result: BatchResult,
+    queue_depth: typing.Optional[int] = None,
+) -> None:
+    """
+    Runs `convert_file` for each of the tasks, over `jobs` processes, adding
+    the results to `result`. With a `queue_depth` they go through
+    `pipeline.run_pipeline` instead, otherwise `tasks` must be a list.
+    """
+    if queue_depth is not None:
+        # Imported here since the pipeline builds on this module.
+        from .pipeline import run_pipeline
+
+        run_pipeline(tasks, jobs, result, queue_depth)
+        return
+
+    if jobs == 1 or len(tasks) <= 1:
+        for task in tasks:
+            result.add(_convert_file_task(task))
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        workers = jobs or os.cpu_count() or 1
+        chunksize = max(1, min(64, len(tasks) // (workers * 4)))
+        for file_result in executor.map(_convert_file_task, tasks, chunksize=chunksize):
+            result.add(file_result)
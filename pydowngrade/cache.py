@@ -0,0 +1,151 @@
+import collections
+import hashlib
+import os
+import pathlib
+import tempfile
+import typing
+
+from .downgrade_transformer import TRANSFORM_VERSION
+
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024
+DEFAULT_MEMORY_CACHE_SIZE = 64 * 1024 * 1024
+
+
+class DowngradeCache:
+    """
+    An on-disk cache of downgraded code, keyed by a hash of the input pyc file
+    and `TRANSFORM_VERSION`. Only the marshalled 3.8 code is stored, the pyc
+    header is written fresh for every output.
+
+    Entries are written to a temporary file and renamed into place so several
+    processes can share a cache directory. Each hit touches the entry's mtime,
+    and once the cache grows past `max_size` bytes the least recently used
+    entries are removed.
+    """
+
+    def __init__(
+        self, directory: pathlib.Path, max_size: int = DEFAULT_MAX_SIZE
+    ) -> None:
+        self.directory = pathlib.Path(directory)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # Estimate of the cache's size, only rescanned when it looks like the
+        # cache has grown past max_size.
+        self._size: typing.Optional[int] = None
+
+    def key_for(self, pyc_data: bytes, optimize: bool = False) -> str:
+        digest = hashlib.sha256(
+            b"pydowngrade-%d%s:" % (TRANSFORM_VERSION, b"-O" if optimize else b"")
+        )
+        digest.update(pyc_data)
+        return digest.hexdigest()
+
+    def _path_for(self, key: str) -> pathlib.Path:
+        return self.directory / key[:2] / key
+
+    def get(self, key: str) -> typing.Optional[bytes]:
+        path = self._path_for(key)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted by another process in the meantime, we still have the
+            # data though.
+            pass
+        self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        path = self._path_for(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+        if self._size is None:
+            self._size = self._scan_size()
+        else:
+            self._size += len(data)
+        if self._size > self.max_size:
+            self.evict()
+
+    def _entries(self) -> typing.List[typing.Tuple[float, int, pathlib.Path]]:
+        entries = []
+        for directory, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.startswith(".tmp-"):
+                    continue
+                path = pathlib.Path(directory, filename)
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _scan_size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self) -> None:
+        """Removes the least recently used entries until the cache fits in
+        `max_size`."""
+        entries = sorted(self._entries())
+        size = sum(size for _, size, _ in entries)
+        for _, entry_size, path in entries:
+            if size <= self.max_size:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                # Another process got to it first.
+                pass
+            size -= entry_size
+        self._size = size
+
+
+class MemoryCache:
+    """
+    An in-memory least recently used cache of downgraded code, bounded by the
+    total size of the entries in bytes.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_MEMORY_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: typing.OrderedDict[
+            typing.Hashable, bytes
+        ] = collections.OrderedDict()
+
+    def get(self, key: typing.Hashable) -> typing.Optional[bytes]:
+        data = self._entries.get(key)
+        if data is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return data
+
+    def put(self, key: typing.Hashable, data: bytes) -> None:
+        if len(data) > self.max_size:
+            return
+        old_data = self._entries.pop(key, None)
+        if old_data is not None:
+            self.size -= len(old_data)
+        self._entries[key] = data
+        self.size += len(data)
+        while self.size > self.max_size:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted)
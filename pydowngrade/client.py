@@ -0,0 +1,65 @@
+"""
+Forwards a `python -m pydowngrade` invocation to a `pydowngrade.worker`
+listening on a Unix socket:
+
+    python -m pydowngrade.client --socket /tmp/pydowngrade.sock in.pyc out.pyc
+
+`--socket` has to come first, everything after it is passed on as is. The
+socket can also be given by the `PYDOWNGRADE_WORKER_SOCKET` environment
+variable. The client imports as little as it can, not even argparse or
+typing, so it starts quickly. Without a worker to talk to, the conversion
+runs in the client instead.
+"""
+import json
+import os
+import socket
+import sys
+
+SOCKET_ENVIRONMENT_VARIABLE = "PYDOWNGRADE_WORKER_SOCKET"
+
+
+def send_request(socket_path: str, arguments: list, cwd: str = None) -> tuple:
+    """
+    Runs `python -m pydowngrade` with `arguments` on the worker at
+    `socket_path`, from the directory `cwd` (default: the current one), and
+    returns its exit code and output. `OSError` is raised if there's no
+    worker to connect to.
+    """
+    request = {"arguments": arguments, "cwd": cwd or os.getcwd()}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        connection.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        with connection.makefile("rb") as responses:
+            line = responses.readline()
+    if not line:
+        raise ConnectionError("The worker closed the connection without responding")
+    response = json.loads(line)
+    return response["exitCode"], response["output"]
+
+
+def main(argv=None) -> int:
+    arguments = list(sys.argv[1:] if argv is None else argv)
+    socket_path = os.environ.get(SOCKET_ENVIRONMENT_VARIABLE)
+    if arguments[:1] == ["--socket"] and len(arguments) > 1:
+        socket_path = arguments[1]
+        del arguments[:2]
+    elif arguments and arguments[0].startswith("--socket="):
+        socket_path = arguments.pop(0)[len("--socket=") :]
+
+    if socket_path:
+        try:
+            exit_code, output = send_request(socket_path, arguments)
+        except (FileNotFoundError, ConnectionError):
+            # No worker, or one that went away before responding.
+            pass
+        else:
+            print(output, end="", file=sys.stderr if exit_code else sys.stdout)
+            return exit_code
+
+    from .__main__ import main as run
+
+    return run(arguments)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
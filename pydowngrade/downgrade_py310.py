@@ -0,0 +1,148 @@
+"""
+Lowers Python 3.10 code to 3.9, as the first step of downgrading it to 3.8.
+
+Besides the few new opcodes, 3.10 jump arguments count instructions rather
+than bytes and the line numbers are in a `co_linetable`, both of which are
+taken care of when the code is decoded. Function annotations are passed to
+`MAKE_FUNCTION` as a flat tuple of names and values, where 3.9 wants a dict.
+Pattern matching has no 3.9 equivalent and is rejected.
+"""
+import typing
+
+from .instructions import Instruction, attach_linetable_lines
+from .opcodes import opcode_39, opcode_310
+from .pass_manager import LoweringContext, VersionStep, register_step
+
+PY310_STEP = register_step(
+    VersionStep(
+        (3, 10),
+        (3, 9),
+        opcode_310,
+        jump_unit=2,
+        decode_lines=attach_linetable_lines,
+    )
+)
+PY310_STEP.unsupported(
+    "GET_LEN",
+    "MATCH_MAPPING",
+    "MATCH_SEQUENCE",
+    "MATCH_KEYS",
+    "MATCH_CLASS",
+    "COPY_DICT_WITHOUT_KEYS",
+)
+
+# MAKE_FUNCTION flags.
+MAKE_FUNCTION_ANNOTATIONS = 0x04
+MAKE_FUNCTION_CLOSURE = 0x08
+
+# The 3.9 rotations ROT_N can be replaced with, by the number of items.
+_ROTATIONS = {2: opcode_39.ROT_TWO, 3: opcode_39.ROT_THREE, 4: opcode_39.ROT_FOUR}
+
+
+@PY310_STEP.lowering("GEN_START")
+def _lower_gen_start(
+    instruction: Instruction, context: LoweringContext
+) -> typing.Optional[Instruction]:
+    # 3.10 pushes the value generators are first sent and pops it with
+    # GEN_START, 3.9 never pushes it.
+    next_instruction = context.next_instruction()
+    if next_instruction is not None and next_instruction.line is None:
+        next_instruction.line = instruction.line
+    return None
+
+
+@PY310_STEP.lowering("ROT_N")
+def _lower_rot_n(
+    instruction: Instruction, context: LoweringContext
+) -> typing.Optional[Instruction]:
+    opcode = _ROTATIONS.get(instruction.arg)
+    if opcode is None:
+        raise ValueError(
+            "ROT_N %d in %s isn't supported" % (instruction.arg, context.code.co_name)
+        )
+    instruction.opcode = opcode
+    instruction.arg = 0
+    return instruction
+
+
+@PY310_STEP.lowering("RERAISE")
+def _lower_reraise(
+    instruction: Instruction, context: LoweringContext
+) -> typing.Optional[Instruction]:
+    # The argument only restores the line number tracebacks show.
+    instruction.opcode = opcode_39.RERAISE
+    instruction.arg = 0
+    if context.next_instruction() is None:
+        # 3.10 puts the exception handlers of finally blocks at the very end.
+        # As far as 3.8 can tell the END_FINALLY a RERAISE becomes may carry
+        # on to the next instruction, so give it one that never runs.
+        context.instructions.append(
+            Instruction(opcode_39.LOAD_CONST, context.const_index(None))
+        )
+        context.instructions.append(Instruction(opcode_39.RETURN_VALUE, 0))
+    return instruction
+
+
+@PY310_STEP.lowering("MAKE_FUNCTION")
+def _lower_make_function(
+    instruction: Instruction, context: LoweringContext
+) -> typing.Optional[Instruction]:
+    if not instruction.arg & MAKE_FUNCTION_ANNOTATIONS:
+        return instruction
+
+    # The annotations are pushed right before the closure, the code object and
+    # the qualified name.
+    output = context.output
+    index = len(output) - 3
+    if instruction.arg & MAKE_FUNCTION_CLOSURE:
+        closure = output[index] if index >= 0 else None
+        if closure is None or closure.opcode != opcode_39.BUILD_TUPLE:
+            _annotations_not_found(context)
+        index -= closure.arg + 1
+    if index < 0 or any(
+        load.opcode != opcode_39.LOAD_CONST for load in output[-2:]
+    ):
+        _annotations_not_found(context)
+
+    annotations = output[index]
+    if annotations.opcode == opcode_39.BUILD_TUPLE and annotations.arg % 2 == 0:
+        # The names and values are already pushed in the order BUILD_MAP
+        # takes them.
+        annotations.opcode = opcode_39.BUILD_MAP
+        annotations.arg //= 2
+    elif annotations.opcode == opcode_39.LOAD_CONST:
+        # A constant tuple, as with `from __future__ import annotations`. The
+        # values are pushed one by one and the names go to
+        # BUILD_CONST_KEY_MAP as a tuple.
+        items = context.code.co_consts[annotations.arg]
+        if type(items) is not tuple or len(items) % 2:
+            _annotations_not_found(context)
+        if not items:
+            annotations.opcode = opcode_39.BUILD_MAP
+            annotations.arg = 0
+            return instruction
+        # The tuple's slot holds the first value, the rest and the names come
+        # on top of it.
+        context.grow_stack(len(items) // 2)
+        annotations.arg = context.const_index(items[1])
+        build_map = [
+            Instruction(opcode_39.LOAD_CONST, context.const_index(value))
+            for value in items[3::2]
+        ]
+        build_map.append(
+            Instruction(opcode_39.LOAD_CONST, context.const_index(items[0::2]))
+        )
+        build_map.append(
+            Instruction(opcode_39.BUILD_CONST_KEY_MAP, len(items) // 2)
+        )
+        output[index + 1 : index + 1] = build_map
+    else:
+        _annotations_not_found(context)
+    return instruction
+
+
+def _annotations_not_found(context: LoweringContext) -> typing.NoReturn:
+    raise ValueError(
+        "Can't find the annotations passed to MAKE_FUNCTION in %s"
+        % context.code.co_name
+    )
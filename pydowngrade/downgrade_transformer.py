@@ -1,239 +1,193 @@
-import bisect
-from copy import deepcopy
-
-import xdis
+import typing
+
+from . import downgrade_py310  # noqa: F401, registers the 3.10 step
+from .instructions import Instruction
+from .opcodes import opcode_38, opcode_39
+from .pass_manager import (
+    IndexedTable,
+    LoweringContext,
+    VersionStep,
+    pass_manager_for,
+    register_step,
+)
+from .stats import DowngradeStats
+
+if typing.TYPE_CHECKING:
+    import xdis
 
 # Python 3.9 specific opcodes
 SET_UPDATE_OPCODE = 163  # TODO
 JUMP_IF_NOT_EXC_MATCH_OPCODE = 121  # TODO
 
+# Bump this whenever the transform or marshaller produce different output for
+# the same input, it invalidates any cached conversions.
+TRANSFORM_VERSION = 6
+
 COMPARE_OP_IS_OPERATOR = 8
 COMPARE_OP_IN_OPERATOR = 6
 
+PY39_STEP = register_step(VersionStep((3, 9), (3, 8), opcode_39))
 
-def downgrade_py39_code_to_py38(code: xdis.Code38) -> xdis.Code38:
+
+def downgrade_py39_code_to_py38(
+    code: "xdis.Code38",
+    stats: typing.Optional[DowngradeStats] = None,
+    optimize: bool = False,
+) -> "xdis.Code38":
     """
     Transforms an xdis loaded Python 3.9 code object to a Python 3.8 code
     object. This transforms any 3.9 specific opcodes into their 3.8 equivalents.
 
     Note that xdis represents both 3.9 and 3.8 code objects with the same type.
+
+    `code` is never mutated. Code objects that don't need any changes,
+    including all of their nested code objects, are returned as-is and only
+    the ones that do change (and the ones containing them) get copied.
+
+    If `stats` is given, the rewritten opcodes and the time spent laying out
+    jumps are recorded in it. With `optimize`, the rewritten code objects also
+    go through the peephole pass in `peephole.optimize_instructions`.
     """
-    # Make a copy of the code object, we don't want to mutate it in-place.
-    code = deepcopy(code)
-    inc_offset = 0
-    absolute_offsets = [(0, inc_offset)]
-
-    code.co_consts = list(code.co_consts)
-    # Transform any nested stored code objects first.
-    for i, const in enumerate(code.co_consts):
-        if not isinstance(const, xdis.Code38):
-            continue
-        code.co_consts[i] = downgrade_py39_code_to_py38(const)
-
-    new_code = []
-    target_base = 0
-    prev_oparg = None
-    for i in range(0, len(code.co_code), 2):
-        opcode, oparg = code.co_code[i], code.co_code[i + 1]
-
-        if opcode not in (
-            xdis.opcode_39.LOAD_ASSERTION_ERROR,
-            xdis.opcode_39.IS_OP,
-            xdis.opcode_39.CONTAINS_OP,
-            xdis.opcode_39.RERAISE,
-            xdis.opcode_39.LIST_EXTEND,
-        ):
-            new_code.append(opcode)
-            new_code.append(oparg)
-        else:
-            # Transform LOAD_ASSERTION_ERROR back to
-            # LOAD_GLOBAL   n ('AssertionError')
-            if opcode == xdis.opcode_39.LOAD_ASSERTION_ERROR:
-                assertion_error_name_idx = get_or_add_name("AssertionError", code)
-                assert assertion_error_name_idx <= 255
-                new_code.append(xdis.opcode_38.LOAD_GLOBAL)
-                new_code.append(assertion_error_name_idx)
-            elif opcode == xdis.opcode_39.LIST_EXTEND:
-                list_obj = list(code.co_consts[prev_oparg])
-                eval_idx = get_or_add_name("eval", code)
-                list_repr_idx = get_or_add_const(str(list_obj), code)
-                if prev_oparg < 256:
-                    new_code[-4] = xdis.opcode_38.LOAD_NAME
-                    new_code[-3] = eval_idx
-                    new_code[-1] = list_repr_idx
-                else:
-                    new_code[-6] = xdis.opcode_38.LOAD_NAME
-                    new_code[-5] = eval_idx
-                    new_code[-3] = list_repr_idx // 256
-                    new_code[-1] = list_repr_idx % 256
-                new_code.append(xdis.opcode_38.CALL_FUNCTION)
-                new_code.append(1)
-            # Transform IS_OP, CONTAINS_OP back to COMPARE_OP.
-            elif opcode == xdis.opcode_39.IS_OP:
-                # Convert to `COMPARE_OP  8 (is)` or `COMPARE_OP  9 (is not)`
-                new_code.append(xdis.opcode_38.COMPARE_OP)
-                new_code.append(COMPARE_OP_IS_OPERATOR + bool(oparg))
-            elif opcode == xdis.opcode_39.CONTAINS_OP:
-                # Convert to `COMPARE_OP  6 (in)` or `COMPARE_OP  7 (not in)`
-                new_code.append(xdis.opcode_38.COMPARE_OP)
-                new_code.append(COMPARE_OP_IN_OPERATOR + bool(oparg))
-            elif opcode == xdis.opcode_39.RERAISE:
-                if (
-                    len(new_code) >= 6
-                    and new_code[-6] == xdis.opcode_38.POP_EXCEPT
-                    and oparg == 0
-                ):
-                    inc_offset += 2
-                    absolute_offsets.append((i + inc_offset, inc_offset))
-                    new_code = (
-                        new_code[:-4]
-                        + [
-                            xdis.opcode_38.JUMP_FORWARD,
-                            2,
-                            xdis.opcode_38.END_FINALLY,
-                            oparg,
-                        ]
-                        + new_code[-4:]
-                    )
-                elif (
-                    len(new_code) >= 8
-                    and new_code[-8] == xdis.opcode_38.POP_EXCEPT
-                    and oparg == 0
-                ):
-                    inc_offset += 2
-                    absolute_offsets.append((i + inc_offset, inc_offset))
-                    new_code = (
-                        new_code[:-6]
-                        + [
-                            xdis.opcode_38.JUMP_FORWARD,
-                            2,
-                            xdis.opcode_38.END_FINALLY,
-                            oparg,
-                        ]
-                        + new_code[-6:]
-                    )
-                elif len(new_code) >= 4 and (
-                    new_code[-4] == xdis.opcode_38.POP_EXCEPT
-                    and new_code[-2] == xdis.opcode_38.JUMP_FORWARD
-                    and new_code[-1] == 2
-                    and oparg == 0
-                ):
-                    new_code = new_code[:-2] + [
-                        xdis.opcode_38.JUMP_FORWARD,
-                        2,
-                        xdis.opcode_38.END_FINALLY,
-                        oparg,
-                    ]
-                elif (
-                    len(new_code) >= 4
-                    and new_code[-4] == xdis.opcode_38.POP_EXCEPT
-                    and oparg == 0
-                ):
-                    inc_offset += 2
-                    absolute_offsets.append((i + inc_offset, inc_offset))
-                    new_code = (
-                        new_code[:-2]
-                        + [
-                            xdis.opcode_38.JUMP_FORWARD,
-                            2,
-                            xdis.opcode_38.END_FINALLY,
-                            oparg,
-                        ]
-                        + new_code[-2:]
-                    )
-                else:
-                    new_code.append(xdis.opcode_38.END_FINALLY)
-                    new_code.append(oparg)
-        prev_oparg = target_base + oparg
-        if opcode == xdis.opcode_38.EXTENDED_ARG:
-            target_base = 256 * oparg + target_base
-        else:
-            target_base = 0
-
-    final_code = []
-    target_base = 0
-    for i in range(0, len(new_code), 2):
-        opcode, oparg = new_code[i], new_code[i + 1]
-
-        if opcode in xdis.opcode_38.JABS_OPS:
-            final_code.append(opcode)
-            target = target_base + oparg
-            add_offset = max(
-                0,
-                bisect.bisect_right(absolute_offsets, (target, target)) - 1,
-            )
-            final_code.append(oparg + absolute_offsets[add_offset][1])
-        elif opcode in xdis.opcode_38.JREL_OPS:
-            target = i + target_base + oparg + 2
-            final_code.append(opcode)
-            src_offset = max(
-                0,
-                bisect.bisect_right(absolute_offsets, (i, target)) - 1,
-            )
-            dst_offset = max(
-                0,
-                bisect.bisect_right(absolute_offsets, (target, target)) - 1,
-            )
-            if src_offset != dst_offset:
-                final_code.append(
-                    oparg
-                    + absolute_offsets[dst_offset][1]
-                    - absolute_offsets[src_offset][1]
-                )
-            else:
-                final_code.append(oparg)
-        else:
-            final_code.append(opcode)
-            final_code.append(oparg)
-
-        if final_code[-1] >= 256:
-            if target_base:
-                final_code = final_code[:-3] + [
-                    final_code[-1] // 256 - 1,
-                    final_code[-2],
-                    final_code[-1] % 256,
-                ]
-            else:
-                absolute_offsets = [
-                    (offset if offset < len(final_code) else offset + 2, inc_offset)
-                    for offset, inc_offset in absolute_offsets
-                ]
-                final_code = (
-                    final_code[:-2]
-                    + [xdis.opcode_38.EXTENDED_ARG, final_code[-1] // 256 - 1]
-                    + [final_code[-2], final_code[-1] % 256]
-                )
-
-        if opcode == xdis.opcode_38.EXTENDED_ARG:
-            target_base = 256 * oparg + target_base
-        else:
-            target_base = 0
-
-    code.co_code = bytes(final_code)
-    return code.freeze()
-
-
-def get_or_add_const(const: str, code: xdis.Code38) -> int:
-    """Retrieves the index of `name` in the `names` list. Or if it doesn't
-    exist, appends it to the end of the names and returns that index.
+    return downgrade_code_to_py38(code, (3, 9), stats, optimize)
+
+
+def downgrade_code_to_py38(
+    code: "xdis.Code38",
+    version: typing.Tuple[int, int],
+    stats: typing.Optional[DowngradeStats] = None,
+    optimize: bool = False,
+) -> "xdis.Code38":
     """
-    try:
-        return code.co_consts.index(const)
-    except ValueError:
-        existing_consts = list(code.co_consts)
-        existing_consts.append(const)
-        code.co_consts = tuple(existing_consts)
-        return len(code.co_consts) - 1
-
-
-def get_or_add_name(name: str, code: xdis.Code38) -> int:
-    """Retrieves the index of `name` in the `names` list. Or if it doesn't
-    exist, appends it to the end of the names and returns that index.
+    Like `downgrade_py39_code_to_py38`, for code from any Python `version`
+    with registered steps down to 3.8. All the steps are run in a single pass,
+    see `pass_manager`.
     """
-    try:
-        return code.co_names.index(name)
-    except ValueError:
-        existing_names = list(code.co_names)
-        existing_names.append(name)
-        code.co_names = tuple(existing_names)
-        return len(code.co_names) - 1
+    return pass_manager_for(version).downgrade(code, stats, optimize)
+
+
+@PY39_STEP.lowering("LOAD_ASSERTION_ERROR")
+def _lower_load_assertion_error(
+    instruction: Instruction, context: LoweringContext
+) -> typing.Optional[Instruction]:
+    # Transform LOAD_ASSERTION_ERROR back to
+    # LOAD_GLOBAL   n ('AssertionError')
+    instruction.opcode = opcode_38.LOAD_GLOBAL
+    instruction.arg = context.names.get_or_add("AssertionError")
+    return instruction
+
+
+@PY39_STEP.lowering("LIST_EXTEND")
+def _lower_list_extend(
+    instruction: Instruction, context: LoweringContext
+) -> typing.Optional[Instruction]:
+    # The list being extended is always freshly built, so the concatenation
+    # BUILD_LIST_UNPACK creates can stand in for it.
+    if instruction.arg != 1:
+        raise ValueError("Unsupported LIST_EXTEND %d" % instruction.arg)
+    previous = context.output[-2:]
+    if (
+        len(previous) == 2
+        and previous[0].opcode == opcode_39.BUILD_LIST
+        and previous[0].arg == 0
+        and previous[1].opcode == opcode_39.LOAD_CONST
+        and previous[1] not in context.jump_targets
+        and instruction not in context.jump_targets
+    ):
+        # A constant list literal, `BUILD_LIST 0; LOAD_CONST (...);
+        # LIST_EXTEND 1`, is built straight from the tuple instead.
+        build_list, load_const = previous
+        build_list.opcode = opcode_38.LOAD_CONST
+        build_list.arg = load_const.arg
+        load_const.opcode = opcode_38.BUILD_LIST_UNPACK
+        load_const.arg = 1
+        return None
+    instruction.opcode = opcode_38.BUILD_LIST_UNPACK
+    instruction.arg = 2
+    return instruction
+
+
+@PY39_STEP.lowering("LIST_TO_TUPLE")
+def _lower_list_to_tuple(
+    instruction: Instruction, context: LoweringContext
+) -> typing.Optional[Instruction]:
+    previous = context.output[-1] if context.output else None
+    if (
+        previous is not None
+        and previous.opcode == opcode_38.BUILD_LIST_UNPACK
+        and instruction not in context.jump_targets
+    ):
+        # 3.9 has no BUILD_LIST_UNPACK so this is a lowered LIST_EXTEND,
+        # which can build the tuple directly.
+        previous.opcode = opcode_38.BUILD_TUPLE_UNPACK
+        return None
+    instruction.opcode = opcode_38.BUILD_TUPLE_UNPACK
+    instruction.arg = 1
+    return instruction
+
+
+# Transform IS_OP, CONTAINS_OP back to COMPARE_OP.
+@PY39_STEP.lowering("IS_OP")
+def _lower_is_op(
+    instruction: Instruction, context: LoweringContext
+) -> typing.Optional[Instruction]:
+    # Convert to `COMPARE_OP  8 (is)` or `COMPARE_OP  9 (is not)`
+    instruction.opcode = opcode_38.COMPARE_OP
+    instruction.arg = COMPARE_OP_IS_OPERATOR + bool(instruction.arg)
+    return instruction
+
+
+@PY39_STEP.lowering("CONTAINS_OP")
+def _lower_contains_op(
+    instruction: Instruction, context: LoweringContext
+) -> typing.Optional[Instruction]:
+    # Convert to `COMPARE_OP  6 (in)` or `COMPARE_OP  7 (not in)`
+    instruction.opcode = opcode_38.COMPARE_OP
+    instruction.arg = COMPARE_OP_IN_OPERATOR + bool(instruction.arg)
+    return instruction
+
+
+@PY39_STEP.lowering("RERAISE")
+def _lower_reraise(
+    instruction: Instruction, context: LoweringContext
+) -> typing.Optional[Instruction]:
+    # The RERAISE itself becomes the END_FINALLY so anything jumping to it now
+    # jumps to the END_FINALLY.
+    instruction.opcode = opcode_38.END_FINALLY
+    output = context.output
+    tail_length = _count_instructions_after_pop_except(output)
+    if instruction.arg == 0 and tail_length is not None:
+        tail = output[-tail_length:]
+        if not (
+            tail_length == 1
+            and tail[0].opcode == opcode_38.JUMP_FORWARD
+            and tail[0].target is context.next_instruction()
+        ) and all(
+            # Jumps to the RERAISE would end up going backwards, the
+            # POP_EXCEPT belongs to a handler inside a finally block.
+            tail_instruction.target is not instruction
+            for tail_instruction in tail
+        ):
+            # Move the END_FINALLY to just after the POP_EXCEPT and jump over
+            # it to the code that followed.
+            jump_over = Instruction(opcode_38.JUMP_FORWARD, target=tail[0])
+            output[-tail_length:] = [jump_over, instruction] + tail
+            return None
+    return instruction
+
+
+# Opcodes that only exist in 3.9 and need to be rewritten.
+PY39_ONLY_OPCODES = frozenset(PY39_STEP.lowerings)
+
+
+def _count_instructions_after_pop_except(
+    instructions: typing.List[Instruction],
+) -> typing.Optional[int]:
+    """If one of the last few instructions is a POP_EXCEPT, returns how many
+    instructions come after it.
+    """
+    for count in (2, 3, 1):
+        if len(instructions) > count and (
+            instructions[-count - 1].opcode == opcode_38.POP_EXCEPT
+        ):
+            return count
+    return None
@@ -0,0 +1,255 @@
+"""
+An import hook that lets a Python 3.8 interpreter import sourceless Python
+3.9 bytecode, downgrading it the first time each module is imported:
+
+    import pydowngrade.import_hook
+    pydowngrade.import_hook.install()
+
+Only modules without source or extension modules next to them are picked up,
+those are left to the regular import system.
+"""
+import importlib.abc
+import importlib.machinery
+import importlib.util
+import marshal
+import os
+import sys
+import typing
+
+from .cache import DEFAULT_MEMORY_CACHE_SIZE, MemoryCache
+from .downgrade_transformer import downgrade_code_to_py38
+from .pyc_io import (
+    CompiledFile,
+    dump_py38_code,
+    py38_pyc_header,
+    write_py38_pyc_atomically,
+)
+from .unmarshal39 import PY39_MAGIC_INTS
+
+PY39_MAGIC_PREFIXES = frozenset(
+    magic_int.to_bytes(2, "little") + b"\r\n" for magic_int in PY39_MAGIC_INTS
+)
+
+# Files next to a module that mean it isn't ours to import.
+_REGULAR_SUFFIXES = tuple(
+    importlib.machinery.SOURCE_SUFFIXES + importlib.machinery.EXTENSION_SUFFIXES
+)
+
+
+def install(
+    cache_size: int = DEFAULT_MEMORY_CACHE_SIZE,
+    write_back: bool = False,
+    lazy: bool = False,
+    optimize: bool = False,
+) -> "Py39PycFinder":
+    """
+    Installs a `Py39PycFinder` in `sys.meta_path`, ahead of the regular path
+    based finder, and returns it.
+
+    Downgraded code is kept in memory, up to `cache_size` bytes of it. With
+    `write_back`, it is also saved as a 3.8 pyc in the module's `__pycache__`
+    so later interpreters can skip the downgrade. With `lazy`, modules aren't
+    executed (or downgraded) until one of their attributes is first used.
+    `optimize` enables the peephole pass.
+    """
+    if sys.version_info[:2] != (3, 8):
+        raise RuntimeError("The import hook needs to run on Python 3.8")
+
+    finder = Py39PycFinder(MemoryCache(cache_size), write_back, lazy, optimize)
+    try:
+        index = sys.meta_path.index(importlib.machinery.PathFinder)
+    except ValueError:
+        index = len(sys.meta_path)
+    sys.meta_path.insert(index, finder)
+    return finder
+
+
+def uninstall(finder: "Py39PycFinder") -> None:
+    sys.meta_path.remove(finder)
+
+
+class Py39PycFinder(importlib.abc.MetaPathFinder):
+    """
+    Finds 3.9 pyc files, either sourceless `name.pyc` files or
+    `__pycache__/name.cpython-39.pyc` entries whose source is missing.
+
+    Like the regular path finder, directory listings are cached and only
+    re-read when a directory's mtime changes, so looking up modules that
+    aren't 3.9 bytecode costs a dictionary lookup per path entry.
+    """
+
+    def __init__(
+        self,
+        cache: MemoryCache,
+        write_back: bool = False,
+        lazy: bool = False,
+        optimize: bool = False,
+    ) -> None:
+        self.cache = cache
+        self.write_back = write_back
+        self.lazy = lazy
+        self.optimize = optimize
+        # Maps directories to their mtime and the set of names in them.
+        self._listings: typing.Dict[str, typing.Tuple[int, typing.FrozenSet[str]]] = {}
+
+    def invalidate_caches(self) -> None:
+        self._listings.clear()
+
+    def find_spec(self, fullname, path=None, target=None):
+        name = fullname.rpartition(".")[2]
+        for entry in sys.path if path is None else path:
+            if not isinstance(entry, str):
+                continue
+            directory = entry or os.getcwd()
+            names = self._listing(directory)
+            if not names:
+                continue
+
+            if name in names:
+                package_directory = os.path.join(directory, name)
+                found = self._find_pyc(package_directory, "__init__")
+                if found is not None:
+                    return self._spec(fullname, found, package_directory)
+                if self._has_regular_module(package_directory, "__init__"):
+                    return None
+
+            found = self._find_pyc(directory, name)
+            if found is not None:
+                return self._spec(fullname, found)
+            if self._has_regular_module(directory, name):
+                return None
+        return None
+
+    def _spec(
+        self, fullname: str, pyc_path: str, package_directory: str = None
+    ) -> importlib.machinery.ModuleSpec:
+        loader = Py39PycLoader(fullname, pyc_path, self)
+        spec = importlib.util.spec_from_file_location(
+            fullname,
+            pyc_path,
+            loader=loader,
+            submodule_search_locations=(
+                None if package_directory is None else [package_directory]
+            ),
+        )
+        if self.lazy:
+            spec.loader = importlib.util.LazyLoader(loader)
+        return spec
+
+    def _listing(self, directory: str) -> typing.FrozenSet[str]:
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            return frozenset()
+        cached = self._listings.get(directory)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        try:
+            names = frozenset(os.listdir(directory))
+        except OSError:
+            names = frozenset()
+        self._listings[directory] = (mtime, names)
+        return names
+
+    def _has_regular_module(self, directory: str, name: str) -> bool:
+        names = self._listing(directory)
+        return any(name + suffix in names for suffix in _REGULAR_SUFFIXES) or (
+            name + ".pyc" in names
+        )
+
+    def _find_pyc(self, directory: str, name: str) -> typing.Optional[str]:
+        """The 3.9 pyc file for module `name` in `directory`, if that's the
+        only way to import it from there."""
+        names = self._listing(directory)
+        if any(name + suffix in names for suffix in _REGULAR_SUFFIXES):
+            return None
+
+        if name + ".pyc" in names:
+            path = os.path.join(directory, name + ".pyc")
+            return path if _is_py39_pyc(path) else None
+
+        if "__pycache__" in names:
+            cached_name = name + _py39_cache_suffix()
+            cache_directory = os.path.join(directory, "__pycache__")
+            if cached_name in self._listing(cache_directory):
+                return os.path.join(cache_directory, cached_name)
+        return None
+
+
+class Py39PycLoader(importlib.machinery.SourcelessFileLoader):
+    """Loads a module from a 3.9 pyc file by downgrading its code."""
+
+    def __init__(self, fullname: str, path: str, finder: Py39PycFinder) -> None:
+        super().__init__(fullname, path)
+        self.finder = finder
+
+    def is_package(self, fullname: str) -> bool:
+        return os.path.basename(self.path).partition(".")[0] == "__init__"
+
+    def get_code(self, fullname: str):
+        stat = os.stat(self.path)
+        key = (self.path, stat.st_mtime_ns, stat.st_size)
+        serialized_code = self.finder.cache.get(key)
+        if serialized_code is None:
+            serialized_code = self._read_written_back(stat)
+        if serialized_code is None:
+            pyc = CompiledFile.from_bytes(self.get_data(self.path), self.path)
+            serialized_code = dump_py38_code(
+                downgrade_code_to_py38(
+                    pyc.code, pyc.header.version, optimize=self.finder.optimize
+                )
+            )
+            if self.finder.write_back:
+                self._write_back(py38_pyc_header(pyc.header), serialized_code)
+        self.finder.cache.put(key, serialized_code)
+        return marshal.loads(serialized_code)
+
+    def _written_back_path(self) -> str:
+        directory, filename = os.path.split(self.path)
+        if os.path.basename(directory) == "__pycache__":
+            return os.path.join(
+                directory, filename.replace(".cpython-39.", ".cpython-38.", 1)
+            )
+        name = filename.rpartition(".")[0]
+        return os.path.join(
+            directory, "__pycache__", "%s.%s.pyc" % (name, sys.implementation.cache_tag)
+        )
+
+    def _read_written_back(self, stat: os.stat_result) -> typing.Optional[bytes]:
+        """The code from a previously written back 3.8 pyc, if it is newer
+        than the 3.9 one."""
+        if not self.finder.write_back:
+            return None
+        path = self._written_back_path()
+        try:
+            if os.stat(path).st_mtime_ns < stat.st_mtime_ns:
+                return None
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        if data[:4] != importlib.util.MAGIC_NUMBER:
+            return None
+        return data[16:]
+
+    def _write_back(self, header: bytes, serialized_code: bytes) -> None:
+        try:
+            write_py38_pyc_atomically(
+                self._written_back_path(), header, serialized_code
+            )
+        except OSError:
+            # Read-only locations just don't get the speed up.
+            pass
+
+
+def _py39_cache_suffix() -> str:
+    optimize = sys.flags.optimize
+    return ".cpython-39" + (".opt-%d" % optimize if optimize else "") + ".pyc"
+
+
+def _is_py39_pyc(path: str) -> bool:
+    try:
+        with open(path, "rb") as f:
+            return f.read(4) in PY39_MAGIC_PREFIXES
+    except OSError:
+        return False
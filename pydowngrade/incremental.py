@@ -0,0 +1,231 @@
+import hashlib
+import json
+import os
+import pathlib
+import py_compile
+import tempfile
+import time
+import typing
+
+from .batch import (
+    BatchResult,
+    ConversionTask,
+    find_pyc_files,
+    output_path_for,
+    run_tasks,
+)
+from .cache import DowngradeCache
+from .downgrade_transformer import TRANSFORM_VERSION
+from .stats import DowngradeStats
+
+INDEX_FILENAME = ".pydowngrade-index.json"
+
+
+class IndexEntry(typing.NamedTuple):
+    mtime_ns: int
+    size: int
+    sha256: str
+    # Relative to the output root, empty if the input failed to convert.
+    output: str
+
+
+class ConversionIndex:
+    """
+    Records, for every converted input (relative to the input root), the
+    mtime, size and hash it had when it was converted and where its output
+    went. Inputs whose mtime and size still match are assumed unchanged
+    without being read, the hash catches files that were only touched.
+    Inputs that failed to convert are recorded too, so they are only retried
+    once they change.
+
+    The index is thrown away when `TRANSFORM_VERSION` or the options the
+    outputs were converted with change.
+    """
+
+    def __init__(
+        self,
+        path: pathlib.Path,
+        optimize: bool = False,
+        invalidation_mode: typing.Optional[py_compile.PycInvalidationMode] = None,
+        verify: bool = False,
+    ) -> None:
+        self.path = pathlib.Path(path)
+        self.optimize = optimize
+        self.verify = verify
+        self.invalidation_mode = (
+            None if invalidation_mode is None else invalidation_mode.name
+        )
+        self.entries: typing.Dict[str, IndexEntry] = {}
+        try:
+            data = json.loads(self.path.read_text("utf-8"))
+        except (OSError, ValueError):
+            return
+        if (
+            data.get("transform_version") != TRANSFORM_VERSION
+            or data.get("optimize", False) != optimize
+            or data.get("invalidation_mode") != self.invalidation_mode
+            or data.get("verify", False) != verify
+        ):
+            return
+        self.entries = {
+            name: IndexEntry(*entry) for name, entry in data["entries"].items()
+        }
+
+    def save(self) -> None:
+        data = {
+            "transform_version": TRANSFORM_VERSION,
+            "optimize": self.optimize,
+            "invalidation_mode": self.invalidation_mode,
+            "verify": self.verify,
+            "entries": {name: list(entry) for name, entry in self.entries.items()},
+        }
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.path.parent, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f, separators=(",", ":"), sort_keys=True)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+
+def convert_tree_incremental(
+    input_root: pathlib.Path,
+    output_root: pathlib.Path,
+    jobs: typing.Optional[int] = None,
+    cache: typing.Optional[DowngradeCache] = None,
+    collect_stats: bool = False,
+    index_path: typing.Optional[pathlib.Path] = None,
+    optimize: bool = False,
+    queue_depth: typing.Optional[int] = None,
+    invalidation_mode: typing.Optional[py_compile.PycInvalidationMode] = None,
+    verify: bool = False,
+) -> BatchResult:
+    """
+    Like `convert_tree`, but only downgrades inputs that were added or changed
+    since the last run and deletes the outputs of inputs that are gone. What
+    was converted is tracked in a `ConversionIndex`, stored in `output_root`
+    unless `index_path` says otherwise. `queue_depth` is passed on to
+    `run_tasks`, `invalidation_mode` and `verify` to `convert_file`.
+    """
+    start = time.perf_counter()
+    input_root = pathlib.Path(input_root)
+    output_root = pathlib.Path(output_root)
+    index = ConversionIndex(
+        index_path or output_root / INDEX_FILENAME, optimize, invalidation_mode, verify
+    )
+    timestamp = int(time.time())
+
+    result = BatchResult(DowngradeStats() if collect_stats else None)
+    tasks = []
+    # Entries for the tasks, added to the index once they convert.
+    pending: typing.Dict[pathlib.Path, typing.Tuple[str, IndexEntry]] = {}
+    seen = set()
+    index_changed = False
+    for input_path in find_pyc_files(input_root):
+        name = input_path.relative_to(input_root).as_posix()
+        seen.add(name)
+        output_path = output_path_for(input_root, output_root, input_path)
+        stat = input_path.stat()
+        entry = index.entries.get(name)
+        if (
+            entry is not None
+            and entry.mtime_ns == stat.st_mtime_ns
+            and entry.size == stat.st_size
+            and _output_exists(output_root, entry)
+        ):
+            result.unchanged += 1
+            continue
+
+        digest = hashlib.sha256(input_path.read_bytes()).hexdigest()
+        new_entry = IndexEntry(
+            stat.st_mtime_ns,
+            stat.st_size,
+            digest,
+            output_path.relative_to(output_root).as_posix(),
+        )
+        if (
+            entry is not None
+            and entry.sha256 == digest
+            and _output_exists(output_root, entry)
+        ):
+            # Touched but not modified.
+            index.entries[name] = entry._replace(
+                mtime_ns=stat.st_mtime_ns, size=stat.st_size
+            )
+            index_changed = True
+            result.unchanged += 1
+            continue
+
+        pending[input_path] = (name, new_entry)
+        tasks.append(
+            ConversionTask(
+                input_path,
+                output_path,
+                timestamp,
+                cache,
+                optimize,
+                collect_stats,
+                invalidation_mode,
+                verify,
+            )
+        )
+
+    for name in set(index.entries) - seen:
+        output = index.entries.pop(name).output
+        index_changed = True
+        if not output:
+            continue
+        output_path = output_root / output
+        try:
+            output_path.unlink()
+        except FileNotFoundError:
+            continue
+        result.removed.append(output_path)
+
+    run_tasks(tasks, jobs, result, queue_depth)
+    for file_result in result.converted:
+        name, entry = pending[file_result.input_path]
+        index.entries[name] = entry
+        index_changed = True
+    for file_result in result.failures:
+        name, entry = pending[file_result.input_path]
+        old_entry = index.entries.get(name)
+        if old_entry is not None and old_entry.output:
+            # Don't leave the output of an older version of the input behind.
+            try:
+                (output_root / old_entry.output).unlink()
+            except FileNotFoundError:
+                pass
+        index.entries[name] = entry._replace(output="")
+        index_changed = True
+
+    if index_changed:
+        index.save()
+    result.elapsed = time.perf_counter() - start
+    return result
+
+
+def _output_exists(output_root: pathlib.Path, entry: IndexEntry) -> bool:
+    return not entry.output or (output_root / entry.output).exists()
+
+
+def watch_tree(
+    input_root: pathlib.Path,
+    output_root: pathlib.Path,
+    interval: float = 1.0,
+    on_result: typing.Optional[typing.Callable[[BatchResult], None]] = None,
+    **kwargs
+) -> None:
+    """
+    Runs `convert_tree_incremental` every `interval` seconds until
+    interrupted, calling `on_result` after every run that changed anything.
+    """
+    while True:
+        result = convert_tree_incremental(input_root, output_root, **kwargs)
+        if on_result is not None and (
+            result.converted or result.failures or result.removed
+        ):
+            on_result(result)
+        time.sleep(interval)
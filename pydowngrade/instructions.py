@@ -0,0 +1,327 @@
+import array
+import bisect
+import itertools
+import typing
+
+from .opcodes import opcode_38, opcode_39
+
+EXTENDED_ARG_OPCODE = 144
+
+
+class Instruction:
+    """
+    A single decoded bytecode instruction.
+
+    Any EXTENDED_ARG prefixes are folded into `arg`, so an instruction with a
+    large argument is still a single node. Jump instructions don't store their
+    argument as an offset, instead `target` points directly to the
+    `Instruction` being jumped to. The real argument is only computed when the
+    instructions are laid out again by `assemble_instructions`, which means
+    instructions can be freely inserted or replaced without having to fix up
+    any offsets.
+
+    Similarly `line` is set on the instructions that start a new source line,
+    so the line number table can be rebuilt with `encode_lnotab` afterwards.
+    """
+
+    __slots__ = ("opcode", "arg", "target", "offset", "line")
+
+    def __init__(
+        self,
+        opcode: int,
+        arg: int = 0,
+        target: typing.Optional["Instruction"] = None,
+    ) -> None:
+        self.opcode = opcode
+        self.arg = arg
+        self.target = target
+        # Byte offset of the instruction (including EXTENDED_ARG prefixes),
+        # only meaningful during decoding and assembly.
+        self.offset = 0
+        self.line: typing.Optional[int] = None
+
+    def __repr__(self) -> str:
+        if self.target is not None:
+            return "Instruction(%d, target=@%d)" % (self.opcode, self.target.offset)
+        return "Instruction(%d, %d)" % (self.opcode, self.arg)
+
+
+def decode_instructions(
+    co_code: bytes,
+    jabs_ops: typing.AbstractSet[int] = opcode_39.JABS_OPS,
+    jrel_ops: typing.AbstractSet[int] = opcode_39.JREL_OPS,
+    jump_unit: int = 1,
+) -> typing.List[Instruction]:
+    """
+    Decodes wordcode into a list of `Instruction`s, resolving the arguments of
+    any jump instructions into symbolic `target`s. By default this uses the
+    Python 3.9 jump opcodes. `jump_unit` is the number of bytes each unit of a
+    jump argument stands for, 2 for 3.10 where they count instructions.
+    """
+    instructions = []
+    # The instruction starting at each code unit, None for EXTENDED_ARGs. A
+    # list rather than a dict since big functions have a lot of these.
+    unit_instructions: typing.List[typing.Optional[Instruction]] = [None] * (
+        len(co_code) // 2
+    )
+
+    extended_arg = 0
+    start = 0
+    for i in range(0, len(co_code), 2):
+        opcode, oparg = co_code[i], co_code[i + 1]
+        if opcode == EXTENDED_ARG_OPCODE:
+            extended_arg = (extended_arg | oparg) << 8
+            continue
+
+        instruction = Instruction(opcode, extended_arg | oparg)
+        instruction.offset = start
+        instructions.append(instruction)
+        unit_instructions[start // 2] = instruction
+
+        extended_arg = 0
+        start = i + 2
+
+    for i, instruction in enumerate(instructions):
+        if instruction.opcode in jabs_ops:
+            target_offset = instruction.arg * jump_unit
+        elif instruction.opcode in jrel_ops:
+            # Relative to where the next instruction starts.
+            end = (
+                instructions[i + 1].offset
+                if i + 1 < len(instructions)
+                else len(co_code)
+            )
+            target_offset = end + instruction.arg * jump_unit
+        else:
+            continue
+
+        target = None
+        if target_offset % 2 == 0 and target_offset // 2 < len(unit_instructions):
+            target = unit_instructions[target_offset // 2]
+        if target is None:
+            raise ValueError(
+                "Jump at offset %d targets %d which is not the start of an "
+                "instruction" % (instruction.offset, target_offset)
+            )
+        instruction.target = target
+
+    return instructions
+
+
+def _instruction_size(arg: int) -> int:
+    """Number of code units (opcode, oparg pairs) needed to encode `arg`."""
+    if arg <= 0xFF:
+        return 1
+    elif arg <= 0xFFFF:
+        return 2
+    elif arg <= 0xFFFFFF:
+        return 3
+    return 4
+
+
+def assemble_instructions(
+    instructions: typing.List[Instruction],
+    jrel_ops: typing.AbstractSet[int] = opcode_38.JREL_OPS,
+    stats=None,
+) -> bytes:
+    """
+    Lays out `instructions` and encodes them back into wordcode, emitting
+    EXTENDED_ARG prefixes where arguments don't fit into a byte. Jumps in
+    `jrel_ops` are encoded relative to the end of the jump and all other jumps
+    are encoded as absolute offsets. By default this uses the Python 3.8 jump
+    opcodes.
+
+    If a `DowngradeStats` is passed as `stats`, the number of jumps that had
+    to be widened is added to it.
+    """
+    # Sizes are in code units. Like the other tables here they're kept in
+    # arrays so that assembling a huge function doesn't need a boxed int (or
+    # worse, a dict entry) per instruction on top of the `Instruction`s.
+    sizes = array.array("B")
+    # Every jump's index, the index of its target and whether it's relative.
+    jump_indices = array.array("l")
+    target_indices = array.array("l")
+    relative_jumps = bytearray()
+    # Until the layout is known, `offset` holds each instruction's index.
+    for i, instruction in enumerate(instructions):
+        instruction.offset = i
+    for i, instruction in enumerate(instructions):
+        target = instruction.target
+        if target is None:
+            sizes.append(_instruction_size(instruction.arg))
+            continue
+        if instructions[target.offset] is not target:
+            raise ValueError(
+                "Jump at index %d targets an instruction that isn't being "
+                "assembled" % i
+            )
+        # Jumps start out as small as possible and only ever grow.
+        sizes.append(1)
+        jump_indices.append(i)
+        target_indices.append(target.offset)
+        relative_jumps.append(instruction.opcode in jrel_ops)
+
+    # Widening a jump can push other jump targets further away, so keep
+    # widening until every jump argument fits in its size. Sizes never
+    # shrink, so this reaches a fixed point after a few passes over just the
+    # jumps, and the code is only emitted once that's done.
+    jumps = (jump_indices, target_indices, relative_jumps)
+    while True:
+        # Where each instruction ends, in code units.
+        ends = array.array("l", itertools.accumulate(sizes))
+        widened = False
+        for i, target, relative in zip(*jumps):
+            arg = _jump_arg(ends, sizes, i, target, relative)
+            size = _instruction_size(arg)
+            if size > sizes[i]:
+                sizes[i] = size
+                widened = True
+                if stats is not None:
+                    stats.extended_arg_widenings += 1
+        if not widened:
+            break
+
+    for i, target, relative in zip(*jumps):
+        arg = _jump_arg(ends, sizes, i, target, relative)
+        if arg < 0:
+            raise ValueError("Relative jump at index %d goes backwards" % i)
+        instructions[i].arg = arg
+
+    co_code = bytearray(2 * ends[-1] if ends else 0)
+    offset = 0
+    for instruction, size in zip(instructions, sizes):
+        instruction.offset = offset
+        arg = instruction.arg
+        for shift in range(8 * (size - 1), 0, -8):
+            co_code[offset] = EXTENDED_ARG_OPCODE
+            co_code[offset + 1] = (arg >> shift) & 0xFF
+            offset += 2
+        co_code[offset] = instruction.opcode
+        co_code[offset + 1] = arg & 0xFF
+        offset += 2
+    return bytes(co_code)
+
+
+def _jump_arg(
+    ends: typing.Sequence[int],
+    sizes: typing.Sequence[int],
+    i: int,
+    target: int,
+    relative: bool,
+) -> int:
+    target_offset = ends[target] - sizes[target]
+    if relative:
+        return 2 * (target_offset - ends[i])
+    return 2 * target_offset
+
+
+def attach_lines(
+    instructions: typing.List[Instruction], co_lnotab: bytes, firstlineno: int
+) -> None:
+    """
+    Decodes a 3.8/3.9 line number table, setting `line` on each instruction
+    that starts a new line. `instructions` must still have the offsets they
+    were decoded with.
+    """
+    _attach_line_starts(instructions, _find_line_starts(co_lnotab, firstlineno))
+
+
+def attach_linetable_lines(
+    instructions: typing.List[Instruction], co_linetable: bytes, firstlineno: int
+) -> None:
+    """Like `attach_lines`, for the `co_linetable` that replaces `co_lnotab`
+    in 3.10."""
+    _attach_line_starts(
+        instructions, _find_linetable_starts(co_linetable, firstlineno)
+    )
+
+
+def _attach_line_starts(
+    instructions: typing.List[Instruction],
+    line_starts: typing.Iterable[typing.Tuple[int, int]],
+) -> None:
+    starts = array.array(
+        "l", (instruction.offset for instruction in instructions)
+    )
+    for offset, line in line_starts:
+        i = bisect.bisect_right(starts, offset) - 1
+        if 0 <= i < len(instructions):
+            instructions[i].line = line
+
+
+def _find_line_starts(
+    co_lnotab: bytes, firstlineno: int
+) -> typing.Iterator[typing.Tuple[int, int]]:
+    """Like `dis.findlinestarts`, yields (offset, line) pairs."""
+    last_line = None
+    line = firstlineno
+    offset = 0
+    for offset_increment, line_increment in zip(co_lnotab[0::2], co_lnotab[1::2]):
+        if offset_increment:
+            if line != last_line:
+                yield offset, line
+                last_line = line
+            offset += offset_increment
+        # Line increments are signed bytes.
+        if line_increment >= 0x80:
+            line_increment -= 0x100
+        line += line_increment
+    if line != last_line:
+        yield offset, line
+
+
+def _find_linetable_starts(
+    co_linetable: bytes, firstlineno: int
+) -> typing.Iterator[typing.Tuple[int, int]]:
+    """
+    Like `dis.findlinestarts` on 3.10, yields (offset, line) pairs. Each entry
+    of the table is a byte range size and a signed line delta, with -128
+    marking ranges without a line. Empty ranges still move the line.
+    """
+    last_line = None
+    line = firstlineno
+    end = 0
+    for offset_increment, line_increment in zip(
+        co_linetable[0::2], co_linetable[1::2]
+    ):
+        start = end
+        end += offset_increment
+        if line_increment == 0x80:
+            continue
+        if line_increment > 0x80:
+            line_increment -= 0x100
+        line += line_increment
+        if start != end and line != last_line:
+            yield start, line
+            last_line = line
+
+
+def encode_lnotab(instructions: typing.List[Instruction], firstlineno: int) -> bytes:
+    """
+    Builds the line number table for `instructions` from their `line`s, once
+    `assemble_instructions` has laid them out.
+    """
+    lnotab = bytearray()
+    last_offset = 0
+    last_line = firstlineno
+    for instruction in instructions:
+        line = instruction.line
+        if line is None or line == last_line:
+            continue
+        offset_delta = instruction.offset - last_offset
+        line_delta = line - last_line
+        while offset_delta > 0xFF:
+            lnotab += bytes((0xFF, 0))
+            offset_delta -= 0xFF
+        while line_delta > 127:
+            lnotab += bytes((offset_delta, 127))
+            offset_delta = 0
+            line_delta -= 127
+        while line_delta < -128:
+            lnotab += bytes((offset_delta, 0x80))
+            offset_delta = 0
+            line_delta += 128
+        lnotab += bytes((offset_delta, line_delta & 0xFF))
+        last_offset = instruction.offset
+        last_line = line
+    return bytes(lnotab)
@@ -0,0 +1,446 @@
+"""
+A marshaller that writes code objects in the format Python 3.8's `marshal`
+module reads (marshal version 4).
+
+Unlike xdis's version independent marshaller this supports references
+(FLAG_REF) the way CPython does: objects that appear more than once in the
+tree are only written out the first time and referred to by index after
+that, which keeps repeated names and constants from bloating the output.
+
+`dump` writes the marshalled code to a file in chunks as it goes rather than
+building all of it in memory first, for modules with huge constants.
+"""
+import queue
+import struct
+import sys
+import threading
+import types
+import typing
+
+if typing.TYPE_CHECKING:
+    from xdis.codetype.base import CodeBase
+
+TYPE_NONE = ord("N")
+TYPE_FALSE = ord("F")
+TYPE_TRUE = ord("T")
+TYPE_STOPITER = ord("S")
+TYPE_ELLIPSIS = ord(".")
+TYPE_INT = ord("i")
+TYPE_LONG = ord("l")
+TYPE_BINARY_FLOAT = ord("g")
+TYPE_BINARY_COMPLEX = ord("y")
+TYPE_STRING = ord("s")
+TYPE_INTERNED = ord("t")
+TYPE_REF = ord("r")
+TYPE_TUPLE = ord("(")
+TYPE_CODE = ord("c")
+TYPE_UNICODE = ord("u")
+TYPE_SET = ord("<")
+TYPE_FROZENSET = ord(">")
+TYPE_ASCII = ord("a")
+TYPE_ASCII_INTERNED = ord("A")
+TYPE_SMALL_TUPLE = ord(")")
+TYPE_SHORT_ASCII = ord("z")
+TYPE_SHORT_ASCII_INTERNED = ord("Z")
+
+FLAG_REF = 0x80
+
+_SINGLETONS = {
+    id(None): TYPE_NONE,
+    id(False): TYPE_FALSE,
+    id(True): TYPE_TRUE,
+    id(StopIteration): TYPE_STOPITER,
+    id(Ellipsis): TYPE_ELLIPSIS,
+}
+
+_LONG = struct.Struct("<i")
+_DOUBLE = struct.Struct("<d")
+
+# Characters CPython considers identifier-like, string constants made of only
+# these get interned when a code object is created.
+_NAME_CHARS = frozenset(
+    "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz"
+)
+
+CodeType = typing.Union["CodeBase", types.CodeType]
+
+# How much of the output `dump` holds before writing it out.
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+# How many chunks can wait to be written before marshalling waits for them.
+_PENDING_CHUNKS = 2
+
+
+def is_code(obj) -> bool:
+    if isinstance(obj, types.CodeType):
+        return True
+    # There can't be any xdis code objects before xdis is imported.
+    xdis_code = sys.modules.get("xdis.codetype.base")
+    return xdis_code is not None and isinstance(obj, xdis_code.CodeBase)
+
+
+def dumps(code: CodeType) -> bytes:
+    """Marshals `code` into the bytes Python 3.8's `marshal.loads` expects."""
+    return Py38Marshaller().dumps(code)
+
+
+def dump(
+    code: CodeType, file: typing.BinaryIO, chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> int:
+    """
+    Marshals `code` like `dumps`, writing it to `file` as it goes, and returns
+    the number of bytes written. Only a few chunks of about `chunk_size`
+    bytes of output are held at a time, strings and bytes longer than that
+    are written straight from the objects they're in. Once there's more than
+    one chunk, the chunks are written on another thread while the rest is
+    marshalled.
+    """
+    return Py38Marshaller().dump(code, file, chunk_size)
+
+
+class _ChunkWriter:
+    """
+    Writes chunks to `file` on a thread of its own. The first error it runs
+    into is raised by the following `write`, or by `close`, which waits for
+    the chunks that are left, unless it's told not to.
+    """
+
+    def __init__(self, file: typing.BinaryIO) -> None:
+        self._file = file
+        self._queue: queue.Queue = queue.Queue(_PENDING_CHUNKS)
+        self._error: typing.Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, chunk) -> None:
+        if self._error is not None:
+            raise self._error
+        self._queue.put(chunk)
+
+    def close(self, raise_error: bool = True) -> None:
+        self._queue.put(None)
+        self._thread.join()
+        if raise_error and self._error is not None:
+            raise self._error
+
+    def _run(self) -> None:
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                return
+            if self._error is None:
+                try:
+                    self._file.write(chunk)
+                except BaseException as e:
+                    self._error = e
+
+
+class Py38Marshaller:
+    def __init__(self) -> None:
+        self._buffer = bytearray()
+        # Only used by `dump`, which writes out the buffer once it holds
+        # `_chunk_size` bytes.
+        self._chunk_size = sys.maxsize
+        self._file: typing.Optional[typing.BinaryIO] = None
+        self._writer: typing.Optional[_ChunkWriter] = None
+        self._written = 0
+        # Reference keys for every object visited, by id. Objects are kept
+        # alive by the tree being dumped so ids can't be reused.
+        self._keys: typing.Dict[int, typing.Hashable] = {}
+        # How often each reference key appears in the tree, only keys that
+        # appear more than once are written with FLAG_REF.
+        self._counts: typing.Dict[typing.Hashable, int] = {}
+        # Reference index of every object written with FLAG_REF.
+        self._refs: typing.Dict[typing.Hashable, int] = {}
+
+    def dumps(self, obj) -> bytes:
+        self._count_refs(obj)
+        self._write_object(obj)
+        return bytes(self._buffer)
+
+    def dump(
+        self, obj, file: typing.BinaryIO, chunk_size: int = DEFAULT_CHUNK_SIZE
+    ) -> int:
+        """Writes `obj` to `file` in chunks, see the module level `dump`."""
+        self._count_refs(obj)
+        self._file = file
+        self._chunk_size = chunk_size
+        try:
+            self._write_object(obj)
+            self._flush()
+        except BaseException:
+            # The writer's own error mustn't replace the one being raised.
+            self._close_writer(raise_error=False)
+            raise
+        self._close_writer()
+        return self._written
+
+    def _close_writer(self, raise_error: bool = True) -> None:
+        if self._writer is not None:
+            writer, self._writer = self._writer, None
+            writer.close(raise_error)
+
+    def _flush_full_chunk(self) -> None:
+        # Called wherever the buffer can have grown by more than a few hundred
+        # bytes since the last call, so it never gets far past a chunk.
+        if len(self._buffer) >= self._chunk_size:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self._buffer:
+            self._write_chunk(bytes(self._buffer))
+            self._buffer.clear()
+
+    def _write_chunk(self, chunk) -> None:
+        self._written += len(chunk)
+        if self._writer is None and self._written > self._chunk_size:
+            # Output that fits in a chunk is written in one go, a thread is
+            # only worth starting for more than that.
+            self._writer = _ChunkWriter(self._file)
+        if self._writer is None:
+            self._file.write(chunk)
+        else:
+            self._writer.write(chunk)
+
+    def _write_payload(self, data: bytes) -> None:
+        """Appends `data`, or writes it straight to the file without copying
+        it if it'd take up more than a chunk."""
+        if len(data) < self._chunk_size:
+            self._buffer += data
+            self._flush_full_chunk()
+            return
+        self._flush()
+        view = memoryview(data)
+        for start in range(0, len(data), self._chunk_size):
+            self._write_chunk(view[start : start + self._chunk_size])
+
+    def _encoded_pieces(self, text: str, encoding: str) -> typing.Iterator[bytes]:
+        """`text` encoded a chunk's worth of characters at a time, UTF-8
+        encodes each character on its own so the pieces join up."""
+        for start in range(0, len(text), self._chunk_size):
+            yield text[start : start + self._chunk_size].encode(
+                encoding, "surrogatepass"
+            )
+
+    def _ref_key(self, obj) -> typing.Optional[typing.Hashable]:
+        """
+        Key under which `obj` can be shared with equal objects, or None if it
+        is never worth referencing. Keys include types so that `1`, `True`
+        and `1.0` are never merged.
+        """
+        obj_id = id(obj)
+        try:
+            return self._keys[obj_id]
+        except KeyError:
+            pass
+
+        obj_type = type(obj)
+        if obj_type is str or obj_type is bytes:
+            key = (obj_type, obj)
+        elif obj_type is int:
+            # Small ints take as much space as a reference does.
+            key = None if -(2 ** 31) <= obj < 2 ** 31 else (int, obj)
+        elif obj_type is float:
+            key = (float, _DOUBLE.pack(obj))
+        elif obj_type is complex:
+            key = (complex, _DOUBLE.pack(obj.real), _DOUBLE.pack(obj.imag))
+        elif obj_type is tuple:
+            item_keys = tuple(self._ref_key(item) for item in obj)
+            if all(key is not None for key in item_keys):
+                key = (tuple, item_keys)
+            else:
+                key = ("id", obj_id)
+        elif obj_type is frozenset:
+            key = ("id", obj_id)
+        else:
+            key = None
+        self._keys[obj_id] = key
+        return key
+
+    def _count_refs(self, obj) -> None:
+        if id(obj) in _SINGLETONS:
+            return
+        key = self._ref_key(obj)
+        if key is not None:
+            count = self._counts.get(key, 0)
+            self._counts[key] = count + 1
+            if count:
+                # Only written out in full the first time, so its children
+                # don't get counted again.
+                return
+
+        if type(obj) in (tuple, frozenset, set):
+            for item in obj:
+                self._count_refs(item)
+        elif is_code(obj):
+            if not isinstance(obj, types.CodeType):
+                obj.freeze()
+            for field in _code_object_fields(obj):
+                self._count_refs(field)
+
+    def _write_object(self, obj, interned: bool = False) -> None:
+        buffer = self._buffer
+        singleton = _SINGLETONS.get(id(obj))
+        if singleton is not None:
+            buffer.append(singleton)
+            return
+
+        flag = 0
+        key = self._ref_key(obj)
+        if key is not None:
+            index = self._refs.get(key)
+            if index is not None:
+                buffer.append(TYPE_REF)
+                buffer += _LONG.pack(index)
+                return
+            if self._counts.get(key, 0) > 1:
+                # The loader numbers references in the order their FLAG_REF
+                # objects start, before reading any children.
+                self._refs[key] = len(self._refs)
+                flag = FLAG_REF
+
+        obj_type = type(obj)
+        if obj_type is str:
+            self._write_str(obj, flag, interned)
+        elif obj_type is bytes:
+            buffer.append(TYPE_STRING | flag)
+            buffer += _LONG.pack(len(obj))
+            self._write_payload(obj)
+        elif obj_type is int:
+            self._write_int(obj, flag)
+        elif obj_type is float:
+            buffer.append(TYPE_BINARY_FLOAT | flag)
+            buffer += _DOUBLE.pack(obj)
+        elif obj_type is complex:
+            buffer.append(TYPE_BINARY_COMPLEX | flag)
+            buffer += _DOUBLE.pack(obj.real)
+            buffer += _DOUBLE.pack(obj.imag)
+        elif obj_type is tuple:
+            self._write_tuple(obj, flag, interned)
+        elif obj_type is frozenset or obj_type is set:
+            set_type = TYPE_FROZENSET if obj_type is frozenset else TYPE_SET
+            buffer.append(set_type | flag)
+            buffer += _LONG.pack(len(obj))
+            for item in obj:
+                self._write_object(item, interned)
+                self._flush_full_chunk()
+        elif is_code(obj):
+            self._write_code(obj, flag)
+        else:
+            raise ValueError("unmarshallable object of type %s" % obj_type.__name__)
+
+    def _write_str(self, obj: str, flag: int, interned: bool) -> None:
+        buffer = self._buffer
+        if obj.isascii():
+            if interned:
+                interned = _NAME_CHARS.issuperset(obj)
+            if len(obj) < 256:
+                code = TYPE_SHORT_ASCII_INTERNED if interned else TYPE_SHORT_ASCII
+                buffer.append(code | flag)
+                buffer.append(len(obj))
+            else:
+                buffer.append((TYPE_ASCII_INTERNED if interned else TYPE_ASCII) | flag)
+                buffer += _LONG.pack(len(obj))
+            if len(obj) < 256:
+                buffer += obj.encode("ascii")
+                return
+            if len(obj) < self._chunk_size:
+                buffer += obj.encode("ascii")
+                self._flush_full_chunk()
+                return
+            self._flush()
+            for piece in self._encoded_pieces(obj, "ascii"):
+                self._write_chunk(piece)
+        elif len(obj) < self._chunk_size // 4:
+            # Up to 4 bytes per character.
+            encoded = obj.encode("utf8", "surrogatepass")
+            buffer.append(TYPE_UNICODE | flag)
+            buffer += _LONG.pack(len(encoded))
+            buffer += encoded
+            self._flush_full_chunk()
+        else:
+            # Encoded twice, once for the length that comes first, rather
+            # than holding all of it.
+            buffer.append(TYPE_UNICODE | flag)
+            buffer += _LONG.pack(
+                sum(len(piece) for piece in self._encoded_pieces(obj, "utf8"))
+            )
+            self._flush()
+            for piece in self._encoded_pieces(obj, "utf8"):
+                self._write_chunk(piece)
+
+    def _write_int(self, obj: int, flag: int) -> None:
+        buffer = self._buffer
+        if -(2 ** 31) <= obj < 2 ** 31:
+            buffer.append(TYPE_INT | flag)
+            buffer += _LONG.pack(obj)
+            return
+
+        # Arbitrary precision ints are written as base 2**15 digits.
+        digits = []
+        value = abs(obj)
+        while value:
+            digits.append(value & 0x7FFF)
+            value >>= 15
+        buffer.append(TYPE_LONG | flag)
+        buffer += _LONG.pack(len(digits) if obj > 0 else -len(digits))
+        for digit in digits:
+            buffer += digit.to_bytes(2, "little")
+        self._flush_full_chunk()
+
+    def _write_tuple(self, obj: tuple, flag: int, interned: bool) -> None:
+        buffer = self._buffer
+        self._flush_full_chunk()
+        if len(obj) < 256:
+            buffer.append(TYPE_SMALL_TUPLE | flag)
+            buffer.append(len(obj))
+            for item in obj:
+                self._write_object(item, interned)
+            return
+
+        buffer.append(TYPE_TUPLE | flag)
+        buffer += _LONG.pack(len(obj))
+        for item in obj:
+            self._write_object(item, interned)
+            self._flush_full_chunk()
+
+    def _write_code(self, code: CodeType, flag: int) -> None:
+        buffer = self._buffer
+        self._flush_full_chunk()
+        buffer.append(TYPE_CODE | flag)
+        for field in (
+            code.co_argcount,
+            code.co_posonlyargcount,
+            code.co_kwonlyargcount,
+            code.co_nlocals,
+            code.co_stacksize,
+            code.co_flags,
+        ):
+            buffer += _LONG.pack(field)
+
+        self._write_object(code.co_code)
+        # Like CPython, names and identifier-like string constants are marked
+        # as interned.
+        self._write_object(code.co_consts, interned=True)
+        self._write_object(code.co_names, interned=True)
+        self._write_object(code.co_varnames, interned=True)
+        self._write_object(code.co_freevars, interned=True)
+        self._write_object(code.co_cellvars, interned=True)
+        self._write_object(code.co_filename)
+        self._write_object(code.co_name, interned=True)
+        buffer += _LONG.pack(code.co_firstlineno)
+        self._write_object(code.co_lnotab)
+
+
+def _code_object_fields(code: CodeType) -> tuple:
+    """The fields of `code` that are written out as objects, in order."""
+    return (
+        code.co_code,
+        code.co_consts,
+        code.co_names,
+        code.co_varnames,
+        code.co_freevars,
+        code.co_cellvars,
+        code.co_filename,
+        code.co_name,
+        code.co_lnotab,
+    )
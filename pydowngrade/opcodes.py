@@ -0,0 +1,258 @@
+"""
+The opcode tables of the Python versions pydowngrade reads and writes,
+written out here so that they're available without importing xdis, which
+takes longer than everything else pydowngrade does to start up.
+
+`opcode_38`, `opcode_39` and `opcode_310` stand in for xdis's modules of the
+same names, with the parts of them pydowngrade uses: an attribute for every
+opcode, `opname`, `opmap`, `HAVE_ARGUMENT`, `EXTENDED_ARG`, `cmp_op`, and
+frozensets of the opcodes with jumps or arguments of each kind. Every table is
+built once at import and `test_opcodes` checks them against xdis.
+"""
+import typing
+
+
+class OpcodeTable:
+    """The opcodes of one Python version, see the module docstring."""
+
+    HAVE_ARGUMENT = 90
+    EXTENDED_ARG = 144
+    cmp_op = (
+        "<",
+        "<=",
+        "==",
+        "!=",
+        ">",
+        ">=",
+        "in",
+        "not-in",
+        "is",
+        "is-not",
+        "exception-match",
+        "BAD",
+    )
+    hasconst = frozenset((100,))
+    hasname = frozenset((90, 91, 95, 96, 97, 98, 101, 106, 108, 109, 116, 160))
+    haslocal = frozenset((124, 125, 126))
+    hasfree = frozenset((135, 136, 137, 138, 148))
+    hascompare = frozenset((107,))
+
+    def __init__(
+        self,
+        version: typing.Tuple[int, int],
+        opmap: typing.Dict[str, int],
+        jabs_ops: typing.Iterable[int],
+        jrel_ops: typing.Iterable[int],
+    ) -> None:
+        self.version = version
+        self.opmap = opmap
+        opname = ["<%d>" % opcode for opcode in range(256)]
+        for name, opcode in opmap.items():
+            opname[opcode] = name
+            setattr(self, name, opcode)
+        self.opname = tuple(opname)
+        self.JABS_OPS = self.hasjabs = frozenset(jabs_ops)
+        self.JREL_OPS = self.hasjrel = frozenset(jrel_ops)
+
+    def __repr__(self) -> str:
+        return "<OpcodeTable for Python %s>" % ".".join(map(str, self.version))
+
+
+def _changed_opmap(
+    opmap: typing.Dict[str, int],
+    removed: typing.Iterable[str],
+    added: typing.Dict[str, int],
+) -> typing.Dict[str, int]:
+    changed = {name: opcode for name, opcode in opmap.items() if name not in removed}
+    changed.update(added)
+    return changed
+
+
+_PY38_OPMAP = {
+    "POP_TOP": 1,
+    "ROT_TWO": 2,
+    "ROT_THREE": 3,
+    "DUP_TOP": 4,
+    "DUP_TOP_TWO": 5,
+    "ROT_FOUR": 6,
+    "NOP": 9,
+    "UNARY_POSITIVE": 10,
+    "UNARY_NEGATIVE": 11,
+    "UNARY_NOT": 12,
+    "UNARY_INVERT": 15,
+    "BINARY_MATRIX_MULTIPLY": 16,
+    "INPLACE_MATRIX_MULTIPLY": 17,
+    "BINARY_POWER": 19,
+    "BINARY_MULTIPLY": 20,
+    "BINARY_MODULO": 22,
+    "BINARY_ADD": 23,
+    "BINARY_SUBTRACT": 24,
+    "BINARY_SUBSCR": 25,
+    "BINARY_FLOOR_DIVIDE": 26,
+    "BINARY_TRUE_DIVIDE": 27,
+    "INPLACE_FLOOR_DIVIDE": 28,
+    "INPLACE_TRUE_DIVIDE": 29,
+    "GET_AITER": 50,
+    "GET_ANEXT": 51,
+    "BEFORE_ASYNC_WITH": 52,
+    "BEGIN_FINALLY": 53,
+    "END_ASYNC_FOR": 54,
+    "INPLACE_ADD": 55,
+    "INPLACE_SUBTRACT": 56,
+    "INPLACE_MULTIPLY": 57,
+    "INPLACE_MODULO": 59,
+    "STORE_SUBSCR": 60,
+    "DELETE_SUBSCR": 61,
+    "BINARY_LSHIFT": 62,
+    "BINARY_RSHIFT": 63,
+    "BINARY_AND": 64,
+    "BINARY_XOR": 65,
+    "BINARY_OR": 66,
+    "INPLACE_POWER": 67,
+    "GET_ITER": 68,
+    "GET_YIELD_FROM_ITER": 69,
+    "PRINT_EXPR": 70,
+    "LOAD_BUILD_CLASS": 71,
+    "YIELD_FROM": 72,
+    "GET_AWAITABLE": 73,
+    "INPLACE_LSHIFT": 75,
+    "INPLACE_RSHIFT": 76,
+    "INPLACE_AND": 77,
+    "INPLACE_XOR": 78,
+    "INPLACE_OR": 79,
+    "WITH_CLEANUP_START": 81,
+    "WITH_CLEANUP_FINISH": 82,
+    "RETURN_VALUE": 83,
+    "IMPORT_STAR": 84,
+    "SETUP_ANNOTATIONS": 85,
+    "YIELD_VALUE": 86,
+    "POP_BLOCK": 87,
+    "END_FINALLY": 88,
+    "POP_EXCEPT": 89,
+    "STORE_NAME": 90,
+    "DELETE_NAME": 91,
+    "UNPACK_SEQUENCE": 92,
+    "FOR_ITER": 93,
+    "UNPACK_EX": 94,
+    "STORE_ATTR": 95,
+    "DELETE_ATTR": 96,
+    "STORE_GLOBAL": 97,
+    "DELETE_GLOBAL": 98,
+    "LOAD_CONST": 100,
+    "LOAD_NAME": 101,
+    "BUILD_TUPLE": 102,
+    "BUILD_LIST": 103,
+    "BUILD_SET": 104,
+    "BUILD_MAP": 105,
+    "LOAD_ATTR": 106,
+    "COMPARE_OP": 107,
+    "IMPORT_NAME": 108,
+    "IMPORT_FROM": 109,
+    "JUMP_FORWARD": 110,
+    "JUMP_IF_FALSE_OR_POP": 111,
+    "JUMP_IF_TRUE_OR_POP": 112,
+    "JUMP_ABSOLUTE": 113,
+    "POP_JUMP_IF_FALSE": 114,
+    "POP_JUMP_IF_TRUE": 115,
+    "LOAD_GLOBAL": 116,
+    "SETUP_FINALLY": 122,
+    "LOAD_FAST": 124,
+    "STORE_FAST": 125,
+    "DELETE_FAST": 126,
+    "RAISE_VARARGS": 130,
+    "CALL_FUNCTION": 131,
+    "MAKE_FUNCTION": 132,
+    "BUILD_SLICE": 133,
+    "LOAD_CLOSURE": 135,
+    "LOAD_DEREF": 136,
+    "STORE_DEREF": 137,
+    "DELETE_DEREF": 138,
+    "CALL_FUNCTION_KW": 141,
+    "CALL_FUNCTION_EX": 142,
+    "SETUP_WITH": 143,
+    "EXTENDED_ARG": 144,
+    "LIST_APPEND": 145,
+    "SET_ADD": 146,
+    "MAP_ADD": 147,
+    "LOAD_CLASSDEREF": 148,
+    "BUILD_LIST_UNPACK": 149,
+    "BUILD_MAP_UNPACK": 150,
+    "BUILD_MAP_UNPACK_WITH_CALL": 151,
+    "BUILD_TUPLE_UNPACK": 152,
+    "BUILD_SET_UNPACK": 153,
+    "SETUP_ASYNC_WITH": 154,
+    "FORMAT_VALUE": 155,
+    "BUILD_CONST_KEY_MAP": 156,
+    "BUILD_STRING": 157,
+    "BUILD_TUPLE_UNPACK_WITH_CALL": 158,
+    "LOAD_METHOD": 160,
+    "CALL_METHOD": 161,
+    "CALL_FINALLY": 162,
+    "POP_FINALLY": 163,
+}
+
+_PY39_OPMAP = _changed_opmap(
+    _PY38_OPMAP,
+    removed=(
+        "BEGIN_FINALLY",
+        "WITH_CLEANUP_START",
+        "WITH_CLEANUP_FINISH",
+        "END_FINALLY",
+        "BUILD_LIST_UNPACK",
+        "BUILD_MAP_UNPACK",
+        "BUILD_MAP_UNPACK_WITH_CALL",
+        "BUILD_TUPLE_UNPACK",
+        "BUILD_SET_UNPACK",
+        "BUILD_TUPLE_UNPACK_WITH_CALL",
+        "CALL_FINALLY",
+        "POP_FINALLY",
+    ),
+    added={
+        "RERAISE": 48,
+        "WITH_EXCEPT_START": 49,
+        "LOAD_ASSERTION_ERROR": 74,
+        "LIST_TO_TUPLE": 82,
+        "IS_OP": 117,
+        "CONTAINS_OP": 118,
+        "JUMP_IF_NOT_EXC_MATCH": 121,
+        "LIST_EXTEND": 162,
+        "SET_UPDATE": 163,
+        "DICT_MERGE": 164,
+        "DICT_UPDATE": 165,
+    },
+)
+
+_PY310_OPMAP = _changed_opmap(
+    _PY39_OPMAP,
+    removed=("RERAISE",),
+    added={
+        "GET_LEN": 30,
+        "MATCH_MAPPING": 31,
+        "MATCH_SEQUENCE": 32,
+        "MATCH_KEYS": 33,
+        "COPY_DICT_WITHOUT_KEYS": 34,
+        "ROT_N": 99,
+        "RERAISE": 119,
+        "GEN_START": 129,
+        "MATCH_CLASS": 152,
+    },
+)
+
+opcode_38 = OpcodeTable(
+    (3, 8),
+    _PY38_OPMAP,
+    jabs_ops=(111, 112, 113, 114, 115),
+    jrel_ops=(93, 110, 122, 143, 154, 162),
+)
+opcode_39 = OpcodeTable(
+    (3, 9),
+    _PY39_OPMAP,
+    jabs_ops=(111, 112, 113, 114, 115, 121),
+    jrel_ops=(93, 110, 122, 143, 154),
+)
+opcode_310 = OpcodeTable(
+    (3, 10),
+    _PY310_OPMAP,
+    jabs_ops=(111, 112, 113, 114, 115, 121),
+    jrel_ops=(93, 110, 122, 143, 154),
+)
@@ -0,0 +1,324 @@
+"""
+Downgrades code objects across several Python versions in a single pass.
+
+Each version step, say 3.10 -> 3.9, is a `VersionStep` that registers a
+lowering for each opcode of its source version that doesn't exist, or means
+something else, in its target version. A `PassManager` chains the steps from
+a source version down to 3.8 and fuses them. Every code object is decoded
+once, each instruction is handed through the lowerings of every step in turn,
+and the result is laid out and frozen once. Adding a source version adds one
+table lookup for the instructions it lowers, not another pass over the code.
+"""
+import functools
+import typing
+from copy import copy
+
+from .instructions import (
+    Instruction,
+    assemble_instructions,
+    attach_lines,
+    decode_instructions,
+    encode_lnotab,
+)
+from .peephole import optimize_instructions
+from .stats import DowngradeStats, timed
+
+if typing.TYPE_CHECKING:
+    import xdis
+
+TARGET_VERSION = (3, 8)
+
+# Takes the instruction to lower and returns the instruction to hand on to
+# the next step, or None if there is nothing to hand on, either because it was
+# dropped or because the lowering put its output in `context.output` itself.
+Lowering = typing.Callable[
+    [Instruction, "LoweringContext"], typing.Optional[Instruction]
+]
+# Sets `line` on the instructions starting a line, from the line number
+# table stored in `co_lnotab` and the first line number.
+LineTableDecoder = typing.Callable[[typing.List[Instruction], bytes, int], None]
+
+
+class VersionStep:
+    """
+    Lowers code from the `source` Python version to the `target` one. `opcodes`
+    is the `opcodes` table of the source version.
+
+    `jump_unit` is how many bytes a unit of a jump argument stands for in the
+    source version and `decode_lines` decodes its line number table. Both only
+    matter for the step code is read from, and when they differ from 3.8's
+    every code object has to be rewritten even if it doesn't use any of the
+    opcodes being lowered.
+    """
+
+    def __init__(
+        self,
+        source: typing.Tuple[int, int],
+        target: typing.Tuple[int, int],
+        opcodes,
+        jump_unit: int = 1,
+        decode_lines: LineTableDecoder = attach_lines,
+    ) -> None:
+        self.source = source
+        self.target = target
+        self.opcodes = opcodes
+        self.jump_unit = jump_unit
+        self.decode_lines = decode_lines
+        self.lowerings: typing.Dict[int, Lowering] = {}
+
+    def lowering(self, *opnames: str) -> typing.Callable[[Lowering], Lowering]:
+        """A decorator registering the function as the lowering of the
+        `opnames` opcodes."""
+
+        def register(function: Lowering) -> Lowering:
+            for opname in opnames:
+                self.lowerings[self.opcodes.opmap[opname]] = function
+            return function
+
+        return register
+
+    def unsupported(self, *opnames: str) -> None:
+        """Registers lowerings that reject the `opnames` opcodes, for those
+        that have no equivalent in the target version."""
+        self.lowering(*opnames)(self._reject)
+
+    def _reject(self, instruction: Instruction, context: "LoweringContext"):
+        raise ValueError(
+            "%s in %s isn't supported, it has no Python %s equivalent"
+            % (
+                self.opcodes.opname[instruction.opcode],
+                context.code.co_name,
+                ".".join(map(str, self.target)),
+            )
+        )
+
+    @property
+    def reformats_code(self) -> bool:
+        """Whether code read with this step needs to be laid out again even
+        when there's nothing to lower."""
+        return self.jump_unit != 1 or self.decode_lines is not attach_lines
+
+
+class LoweringContext:
+    """The state shared by the lowerings while one code object is rewritten."""
+
+    __slots__ = (
+        "code",
+        "instructions",
+        "index",
+        "output",
+        "jump_targets",
+        "names",
+        "consts",
+        "extra_stack",
+    )
+
+    def __init__(
+        self, code: "xdis.Code38", instructions: typing.List[Instruction]
+    ) -> None:
+        self.code = code
+        # The decoded instructions, and the index of the one being lowered.
+        # Instructions appended by a lowering are lowered in turn.
+        self.instructions = instructions
+        self.index = 0
+        # The fully lowered instructions so far, lowerings looking back at
+        # them see what every later step made of them.
+        self.output: typing.List[Instruction] = []
+        self.jump_targets = {
+            instruction.target
+            for instruction in instructions
+            if instruction.target is not None
+        }
+        self.names = IndexedTable(code.co_names)
+        # Only indexed once a lowering needs a new constant.
+        self.consts: typing.Optional[IndexedTable] = None
+        # How much deeper than `co_stacksize` the lowered code can go.
+        self.extra_stack = 0
+
+    def const_index(self, obj) -> int:
+        """The index of `obj` in `co_consts`, which is added if it's missing."""
+        if self.consts is None:
+            self.consts = IndexedTable(self.code.co_consts)
+        return self.consts.get_or_add(obj)
+
+    def grow_stack(self, depth: int) -> None:
+        """Records that a lowering pushes up to `depth` more items than the
+        instructions it replaced."""
+        self.extra_stack = max(self.extra_stack, depth)
+
+    def next_instruction(self) -> typing.Optional[Instruction]:
+        index = self.index + 1
+        return self.instructions[index] if index < len(self.instructions) else None
+
+
+_STEPS: typing.Dict[typing.Tuple[int, int], VersionStep] = {}
+
+
+def register_step(step: VersionStep) -> VersionStep:
+    """Makes `step` the one used to lower code from its source version."""
+    _STEPS[step.source] = step
+    pass_manager_for.cache_clear()
+    return step
+
+
+@functools.lru_cache(maxsize=None)
+def pass_manager_for(source: typing.Tuple[int, int]) -> "PassManager":
+    """The `PassManager` downgrading code from the `source` version to 3.8,
+    built from the registered steps."""
+    steps = []
+    version = source
+    while version != TARGET_VERSION:
+        step = _STEPS.get(version)
+        if step is None:
+            raise ValueError(
+                "Python %s code isn't supported" % ".".join(map(str, version))
+            )
+        steps.append(step)
+        version = step.target
+    return PassManager(steps)
+
+
+class PassManager:
+    """Downgrades code by running a chain of `VersionStep`s fused together."""
+
+    def __init__(self, steps: typing.Sequence[VersionStep]) -> None:
+        if not steps:
+            raise ValueError("A pass manager needs at least one step")
+        self.steps = tuple(steps)
+        self.source = steps[0]
+        # For every opcode of the source version, the index of the first step
+        # lowering it, or None if it goes through every step unchanged. An
+        # opcode no step lowers keeps its number, so the steps before the
+        # first one lowering it can be skipped.
+        first_steps: typing.List[typing.Optional[int]] = [None] * 256
+        for index in reversed(range(len(self.steps))):
+            for opcode in self.steps[index].lowerings:
+                first_steps[opcode] = index
+        self._first_steps = tuple(first_steps)
+        self._lowered_opcodes = frozenset(
+            opcode for opcode, index in enumerate(first_steps) if index is not None
+        )
+
+    def downgrade(
+        self,
+        code: "xdis.Code38",
+        stats: typing.Optional[DowngradeStats] = None,
+        optimize: bool = False,
+    ) -> "xdis.Code38":
+        """
+        Downgrades `code` and the code objects nested in it to 3.8, see
+        `downgrade_transformer.downgrade_py39_code_to_py38`.
+        """
+        # xdis was already imported to load `code`, importing it here keeps it
+        # out of pydowngrade's own imports.
+        from xdis import Code38
+
+        # Transform any nested stored code objects first.
+        new_consts = None
+        for i, const in enumerate(code.co_consts):
+            if not isinstance(const, Code38):
+                continue
+            new_const = self.downgrade(const, stats, optimize)
+            if new_const is not const:
+                if new_consts is None:
+                    new_consts = list(code.co_consts)
+                new_consts[i] = new_const
+
+        # Opcodes are at the even offsets, arguments at the odd ones.
+        needs_rewrite = self.source.reformats_code or not (
+            self._lowered_opcodes.isdisjoint(code.co_code[::2])
+        )
+        if new_consts is None and not needs_rewrite:
+            return code
+
+        # Only a shallow copy is needed, the fields that change are replaced
+        # rather than mutated.
+        code = copy(code)
+        code.co_consts = new_consts if new_consts is not None else list(code.co_consts)
+        if not needs_rewrite:
+            return code.freeze()
+
+        opcodes = self.source.opcodes
+        instructions = decode_instructions(
+            code.co_code, opcodes.JABS_OPS, opcodes.JREL_OPS, self.source.jump_unit
+        )
+        self.source.decode_lines(instructions, code.co_lnotab, code.co_firstlineno)
+        context = LoweringContext(code, instructions)
+        output = context.output
+        steps = self.steps
+        first_steps = self._first_steps
+        for i, instruction in enumerate(instructions):
+            step_index = first_steps[instruction.opcode]
+            if step_index is None:
+                output.append(instruction)
+                continue
+
+            context.index = i
+            for step in steps[step_index:]:
+                lowering = step.lowerings.get(instruction.opcode)
+                if lowering is None:
+                    continue
+                if stats is not None:
+                    stats.rewritten_opcodes[step.opcodes.opname[instruction.opcode]] += 1
+                instruction = lowering(instruction, context)
+                if instruction is None:
+                    break
+            else:
+                output.append(instruction)
+
+        if optimize:
+            output = optimize_instructions(output)
+        with timed(stats, "relocate"):
+            code.co_code = assemble_instructions(output, stats=stats)
+        code.co_lnotab = encode_lnotab(output, code.co_firstlineno)
+        code.co_names = context.names.to_tuple()
+        if context.consts is not None:
+            code.co_consts = context.consts.items
+        code.co_stacksize += context.extra_stack
+        return code.freeze()
+
+
+class IndexedTable:
+    """
+    A mutable stand-in for `co_consts` or `co_names` while a code object is
+    being rewritten, with a dict index so lookups and appends are O(1).
+
+    Entries are looked up by type as well as value so that `1`, `True` and
+    `1.0`, which compare equal, are never merged.
+    """
+
+    def __init__(self, items: typing.Iterable) -> None:
+        self.items = list(items)
+        self._index: typing.Dict[typing.Hashable, int] = {}
+        for i, item in enumerate(self.items):
+            # Like `list.index`, the first of several equal entries wins.
+            self._index.setdefault(_table_key(item), i)
+
+    def get_or_add(self, obj) -> int:
+        """Retrieves the index of `obj` in the table. Or if it doesn't exist,
+        appends it to the end of the table and returns that index.
+        """
+        key = _table_key(obj)
+        index = self._index.get(key)
+        if index is None:
+            index = len(self.items)
+            self.items.append(obj)
+            self._index[key] = index
+        return index
+
+    def to_tuple(self) -> tuple:
+        return tuple(self.items)
+
+
+def _table_key(obj) -> typing.Hashable:
+    obj_type = type(obj)
+    if obj_type is float or obj_type is complex:
+        # Keeps 0.0 and -0.0 apart, and lets NaN find itself.
+        return obj_type, repr(obj)
+    if obj_type is tuple:
+        return obj_type, tuple(_table_key(item) for item in obj)
+    if obj_type in (str, bytes, int, bool) or obj is None or obj is Ellipsis:
+        return obj_type, obj
+    # Code objects, frozensets and anything else are only ever the same entry
+    # as themselves.
+    return "id", id(obj)
@@ -0,0 +1,121 @@
+"""
+A peephole pass over downgraded 3.8 instructions, cleaning up after the
+rewrites in `downgrade_transformer` so the bytecode is close to what CPython
+3.8 would have compiled.
+"""
+import typing
+
+from .instructions import Instruction
+from .opcodes import opcode_38
+
+UNCONDITIONAL_JUMPS = frozenset((opcode_38.JUMP_ABSOLUTE, opcode_38.JUMP_FORWARD))
+
+# Jumps whose target can be replaced by the target of the jump they land on.
+THREADABLE_JUMPS = UNCONDITIONAL_JUMPS | frozenset(
+    (
+        opcode_38.POP_JUMP_IF_FALSE,
+        opcode_38.POP_JUMP_IF_TRUE,
+        opcode_38.JUMP_IF_FALSE_OR_POP,
+        opcode_38.JUMP_IF_TRUE_OR_POP,
+    )
+)
+
+# Instructions that never continue on to the next instruction.
+NO_FALL_THROUGH = UNCONDITIONAL_JUMPS | frozenset(
+    (opcode_38.RETURN_VALUE, opcode_38.RAISE_VARARGS)
+)
+
+
+def optimize_instructions(
+    instructions: typing.List[Instruction],
+) -> typing.List[Instruction]:
+    """
+    Threads jumps to unconditional jumps straight through to their final
+    target, then removes unreachable instructions and jumps to the very next
+    instruction, repeating until nothing changes.
+
+    Removed instructions pass their `line` on to the next instruction kept, so
+    line numbers stay correct. EXTENDED_ARGs aren't handled here, once the
+    result is assembled again every jump gets the smallest size that fits.
+    """
+    _thread_jumps(instructions)
+    while True:
+        optimized = _remove_jumps_to_next(_remove_unreachable(instructions))
+        if len(optimized) == len(instructions):
+            return optimized
+        instructions = optimized
+
+
+def _thread_jumps(instructions: typing.List[Instruction]) -> None:
+    positions = {instruction: i for i, instruction in enumerate(instructions)}
+    for i, instruction in enumerate(instructions):
+        if instruction.opcode not in THREADABLE_JUMPS:
+            continue
+        target = instruction.target
+        seen = {instruction}
+        while target.opcode in UNCONDITIONAL_JUMPS and target not in seen:
+            seen.add(target)
+            target = target.target
+        if target is instruction.target:
+            continue
+        instruction.target = target
+        if instruction.opcode == opcode_38.JUMP_FORWARD and positions[target] <= i:
+            # Relative jumps can only go forwards.
+            instruction.opcode = opcode_38.JUMP_ABSOLUTE
+
+
+def _remove_unreachable(
+    instructions: typing.List[Instruction],
+) -> typing.List[Instruction]:
+    targets = {
+        instruction.target
+        for instruction in instructions
+        if instruction.target is not None
+    }
+    kept = []
+    reachable = True
+    carried_line = None
+    for instruction in instructions:
+        if instruction in targets:
+            reachable = True
+        if not reachable:
+            if instruction.line is not None:
+                carried_line = instruction.line
+            continue
+
+        if carried_line is not None:
+            if instruction.line is None:
+                instruction.line = carried_line
+            carried_line = None
+        kept.append(instruction)
+        if instruction.opcode in NO_FALL_THROUGH:
+            reachable = False
+    return kept
+
+
+def _remove_jumps_to_next(
+    instructions: typing.List[Instruction],
+) -> typing.List[Instruction]:
+    # Maps removed jumps to the instruction that replaces them as a target.
+    replacements = {}
+    kept = []
+    for i, instruction in enumerate(instructions[:-1]):
+        next_instruction = instructions[i + 1]
+        if (
+            instruction.opcode in UNCONDITIONAL_JUMPS
+            and instruction.target is next_instruction
+        ):
+            replacements[instruction] = next_instruction
+            if next_instruction.line is None:
+                next_instruction.line = instruction.line
+            continue
+        kept.append(instruction)
+    kept.extend(instructions[-1:])
+
+    if replacements:
+        for instruction in kept:
+            target = instruction.target
+            while target in replacements:
+                target = replacements[target]
+            instruction.target = target
+    return kept
@@ -0,0 +1,214 @@
+"""
+A pipelined batch engine for trees too big to hold in memory at once, where
+reading inputs, downgrading them and writing the outputs all overlap:
+
+    reader threads -> bounded queue -> worker processes -> bounded queue
+        -> writer threads
+
+Every stage blocks once the one after it falls `queue_depth` files behind, so
+memory use depends on the queue depth rather than the size of the tree.
+"""
+import collections
+import concurrent.futures
+import hashlib
+import queue
+import threading
+import traceback
+import typing
+
+from .batch import (
+    BatchResult,
+    ConversionTask,
+    FileResult,
+    downgrade_pyc_data,
+    output_header_for,
+)
+from .pyc_io import write_py38_pyc_atomically
+from .stats import DowngradeStats
+from .unmarshal39 import PYC_HEADER_SIZE
+
+DEFAULT_QUEUE_DEPTH = 64
+DEFAULT_IO_THREADS = 2
+
+# Put on a queue by each producer when it's done.
+_DONE = object()
+
+
+def run_pipeline(
+    tasks: typing.Iterable[ConversionTask],
+    jobs: typing.Optional[int],
+    result: BatchResult,
+    queue_depth: int = DEFAULT_QUEUE_DEPTH,
+    io_threads: int = DEFAULT_IO_THREADS,
+) -> None:
+    """
+    Like `run_tasks`, but pipelined. `io_threads` threads read the inputs of
+    the tasks, which are only consumed as they're needed, the downgrades run
+    over `jobs` processes (in this one if `jobs` is 1) and another
+    `io_threads` threads write the outputs atomically. At most `queue_depth`
+    files wait to be downgraded, are being downgraded and wait to be written.
+    """
+    if queue_depth < 1:
+        raise ValueError("queue_depth must be at least 1")
+
+    tasks = iter(tasks)
+    tasks_lock = threading.Lock()
+    read_queue: queue.Queue = queue.Queue(queue_depth)
+    write_queue: queue.Queue = queue.Queue(queue_depth)
+    result_lock = threading.Lock()
+
+    def add_result(file_result: FileResult) -> None:
+        with result_lock:
+            result.add(file_result)
+
+    def read() -> None:
+        try:
+            while True:
+                with tasks_lock:
+                    task = next(tasks, None)
+                if task is None:
+                    return
+                try:
+                    input_data = task.input_path.read_bytes()
+                except OSError:
+                    add_result(
+                        FileResult(
+                            task.input_path,
+                            task.output_path,
+                            error=traceback.format_exc(),
+                        )
+                    )
+                    continue
+                read_queue.put((task, input_data))
+        finally:
+            read_queue.put(_DONE)
+
+    def write() -> None:
+        while True:
+            item = write_queue.get()
+            if item is _DONE:
+                return
+            try:
+                file_result = _write_output(*item)
+            except Exception:
+                # Anything escaping would leave the pipeline stuck on a full
+                # queue, so it's reported like any other failure.
+                task = item[0]
+                file_result = FileResult(
+                    task.input_path, task.output_path, error=traceback.format_exc()
+                )
+            add_result(file_result)
+
+    # Daemon threads so a failure in this thread can't leave the interpreter
+    # waiting on a reader blocked on a full queue.
+    readers = [threading.Thread(target=read, daemon=True) for _ in range(io_threads)]
+    writers = [threading.Thread(target=write, daemon=True) for _ in range(io_threads)]
+    for thread in readers + writers:
+        thread.start()
+
+    executor = (
+        None if jobs == 1 else concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+    )
+    # Downgrades in submission order, so the oldest one is waited on first.
+    in_flight: typing.Deque[tuple] = collections.deque()
+    try:
+        running_readers = len(readers)
+        while running_readers:
+            item = read_queue.get()
+            if item is _DONE:
+                running_readers -= 1
+                continue
+            task, input_data = item
+            arguments = (
+                input_data,
+                str(task.input_path),
+                task.cache,
+                task.optimize,
+                task.collect_stats,
+                task.verify,
+            )
+            if executor is None:
+                future = concurrent.futures.Future()
+                future.set_result(_downgrade_task(*arguments))
+            else:
+                future = executor.submit(_downgrade_task, *arguments)
+            # Only the header is needed to write the output.
+            header = bytes(input_data[:PYC_HEADER_SIZE])
+            in_flight.append((task, header, len(input_data), future))
+            del item, input_data, arguments
+
+            while in_flight and (
+                len(in_flight) >= queue_depth or in_flight[0][3].done()
+            ):
+                _pass_on(in_flight.popleft(), write_queue)
+        while in_flight:
+            _pass_on(in_flight.popleft(), write_queue)
+    finally:
+        for _ in writers:
+            write_queue.put(_DONE)
+        for thread in writers:
+            thread.join()
+        if executor is not None:
+            executor.shutdown()
+
+
+def _downgrade_task(
+    input_data: bytes,
+    filename: str,
+    cache,
+    optimize: bool,
+    collect_stats: bool,
+    verify: bool,
+) -> tuple:
+    """Runs in the worker processes, returns `(serialized_code, cache_hit,
+    error, stats, input_sha256)`."""
+    stats = DowngradeStats() if collect_stats else None
+    input_sha256 = hashlib.sha256(input_data).hexdigest()
+    try:
+        serialized_code, cache_hit = downgrade_pyc_data(
+            input_data, filename, cache, stats, optimize, verify
+        )
+    except Exception:
+        return None, None, traceback.format_exc(), stats, input_sha256
+    return serialized_code, cache_hit, None, stats, input_sha256
+
+
+def _pass_on(entry: tuple, write_queue: queue.Queue) -> None:
+    task, input_header, input_size, future = entry
+    write_queue.put((task, input_header, input_size, future.result()))
+
+
+def _write_output(
+    task: ConversionTask, input_header: bytes, input_size: int, outcome: tuple
+) -> FileResult:
+    input_path, output_path = task.input_path, task.output_path
+    serialized_code, cache_hit, error, stats, input_sha256 = outcome
+    if error is None:
+        output_digest = hashlib.sha256()
+        try:
+            header = output_header_for(
+                input_path, input_header, task.timestamp, task.invalidation_mode
+            )
+            output_size = write_py38_pyc_atomically(
+                output_path, header, serialized_code, output_digest
+            )
+        except Exception:
+            error = traceback.format_exc()
+    if error is not None:
+        return FileResult(
+            input_path,
+            output_path,
+            error=error,
+            stats=stats,
+            input_sha256=input_sha256,
+        )
+    return FileResult(
+        input_path,
+        output_path,
+        input_size,
+        output_size,
+        cache_hit,
+        stats=stats,
+        input_sha256=input_sha256,
+        output_sha256=output_digest.hexdigest(),
+    )
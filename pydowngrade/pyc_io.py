@@ -1,46 +1,34 @@
+import _imp
+import hashlib
+import mmap
+import os
 import pathlib
+import py_compile
 import struct
+import sys
 import time
 import types
 import typing
 
-import xdis
-from xdis import marsh as xdis_marsh
-from xdis.codetype.base import CodeBase
-from xdis.magics import magics as xdis_magics
-
-
-# ===== HACK =====
-# Okay this horrible hack is a monkey patch for xdis's version independent
-# marshaller until I can upstream a fix. Currently it keeps around a
-# a dictionary of (type: dump_function). It adds in a mapping for
-# `Code3: dump_code3`. However, since we mostly deal with Code38 objects here,
-# this lookup fails. In this case they have a:
-#
-#     if isinstance(x, Code2):
-#         self.dispatch[Code2](self, x)
-#         return
-#     elif isinstance(x, Code3):
-#         self.dispatch[Code3](self, x)
-#         return
-#
-# except Code3 inherits from Code2, so the Code2 dispatcher always gets
-# triggered.
-def dump_unicode(self, x):
-    self._write("u")
-    s = x.encode()
-    self.w_long(len(s))
-    self._write(s)
-
-
-xdis_marsh._Marshaller.dispatch[str] = dump_unicode
-xdis_marsh._Marshaller.dispatch[xdis.Code38] = xdis_marsh._Marshaller.dump_code3
-# ================
+from . import marshal38, unmarshal39
+
+if typing.TYPE_CHECKING:
+    import xdis
+    from xdis.codetype.base import CodeBase
+
+# The magic number of the final Python 3.8 releases, 3413.
+PY38_MAGIC = b"U\r\r\n"
+# What `importlib.util.source_hash` keys the hash of the source with on 3.8.
+_PY38_RAW_MAGIC = int.from_bytes(PY38_MAGIC, "little")
+
+# PEP 552 pyc flags.
+FLAG_HASH_BASED = 0b01
+FLAG_CHECK_SOURCE = 0b10
 
 
 def transform_code_to_portable(
-    code: typing.Union[CodeBase, types.CodeType]
-) -> xdis.Code38:
+    code: typing.Union["CodeBase", types.CodeType]
+) -> "xdis.Code38":
     """
     xdis has a feature whereby code objects from the same interpreter as the one
     running will be loaded as native Python code objects instead of xdis's own
@@ -50,6 +38,8 @@ def transform_code_to_portable(
     passed in code is already an xdis code instance, it just returns it
     directly.
     """
+    import xdis
+
     code = xdis.codeType2Portable(code)
     code.co_consts = list(code.co_consts)
     for i, const in enumerate(code.co_consts):
@@ -57,42 +47,276 @@ def transform_code_to_portable(
             code.co_consts[i] = xdis.codeType2Portable(const, (3, 8, 3))
         except TypeError:
             pass
-    return code
+    return code.freeze()
 
 
-class Py39CompiledFile:
-    code: xdis.Code38
+class CompiledFile:
+    """A Python 3.9 or 3.10 pyc file, its header and its code loaded as
+    `xdis.Code38`."""
+
+    code: "xdis.Code38"
+    header: unmarshal39.Py39PycHeader
 
     def __init__(self, filename: pathlib.Path) -> None:
-        loaded_module = xdis.load_module(str(filename))
+        with open(filename, "rb") as file:
+            try:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files can't be mapped.
+                data = file.read()
+            try:
+                with memoryview(data) as view:
+                    self._load(view, str(filename))
+            finally:
+                if isinstance(data, mmap.mmap):
+                    data.close()
+
+    @classmethod
+    def from_bytes(
+        cls, data: bytes, filename: str = "<unknown>"
+    ) -> "CompiledFile":
+        """Loads a pyc file that is already in memory."""
+        compiled_file = cls.__new__(cls)
+        with memoryview(data) as view:
+            compiled_file._load(view, filename)
+        return compiled_file
+
+    def _load(self, data: memoryview, filename: str) -> None:
+        self.header = unmarshal39.read_pyc_header(data)
+        self.code = unmarshal39.loads(data, unmarshal39.PYC_HEADER_SIZE, filename)
 
-        version = loaded_module[0]
-        if version[:2] != (3, 9):
-            raise ValueError("Only Python 3.9 files are supported")
 
-        self.code = transform_code_to_portable(loaded_module[3])
+# The name from before 3.10 files were supported.
+Py39CompiledFile = CompiledFile
 
 
 def output_py38_pyc_file(
-    code: xdis.Code38, file: typing.BinaryIO, timestamp: typing.Optional[int] = None
+    code: "xdis.Code38", file: typing.BinaryIO, timestamp: typing.Optional[int] = None
 ):
     """
     Takes the `code` argument representing the module code and writes it in a
-    pyc file format in `file`.
+    pyc file format in `file`, see `stream_py38_code`.
     """
+    write_py38_pyc_header(file, timestamp)
+    stream_py38_code(code, file)
+
+
+def write_py38_pyc_header(
+    file: typing.BinaryIO,
+    timestamp: typing.Optional[int] = None,
+    source_size: int = 0,
+):
+    """Writes the 16 byte header of a timestamp based Python 3.8 pyc file to
+    `file`."""
     if timestamp is None:
         timestamp = int(time.time())
+    file.write(_timestamp_header(timestamp, source_size))
+
+
+def _timestamp_header(source_mtime: int, source_size: int) -> bytes:
+    # CPython only keeps the low 32 bits of both.
+    return PY38_MAGIC + struct.pack(
+        "<III", 0, source_mtime & 0xFFFFFFFF, source_size & 0xFFFFFFFF
+    )
+
+
+_MASK_64 = 0xFFFFFFFFFFFFFFFF
+
+
+def _rotate_left_64(x: int, b: int) -> int:
+    return ((x << b) | (x >> (64 - b))) & _MASK_64
+
+
+def _siphash24(k0: int, k1: int, data: bytes) -> int:
+    # SipHash-2-4, what `_Py_KeyedHash` used before Python 3.11 switched it
+    # to SipHash-1-3.
+    v0 = k0 ^ 0x736F6D6570736575
+    v1 = k1 ^ 0x646F72616E646F6D
+    v2 = k0 ^ 0x6C7967656E657261
+    v3 = k1 ^ 0x7465646279746573
+
+    def rounds(n: int) -> None:
+        nonlocal v0, v1, v2, v3
+        for _ in range(n):
+            v0 = (v0 + v1) & _MASK_64
+            v1 = _rotate_left_64(v1, 13) ^ v0
+            v0 = _rotate_left_64(v0, 32)
+            v2 = (v2 + v3) & _MASK_64
+            v3 = _rotate_left_64(v3, 16) ^ v2
+            v0 = (v0 + v3) & _MASK_64
+            v3 = _rotate_left_64(v3, 21) ^ v0
+            v2 = (v2 + v1) & _MASK_64
+            v1 = _rotate_left_64(v1, 17) ^ v2
+            v2 = _rotate_left_64(v2, 32)
+
+    end = len(data) - len(data) % 8
+    for (m,) in struct.iter_unpack("<Q", data[:end]):
+        v3 ^= m
+        rounds(2)
+        v0 ^= m
+    m = (len(data) & 0xFF) << 56 | int.from_bytes(data[end:], "little")
+    v3 ^= m
+    rounds(2)
+    v0 ^= m
+    v2 ^= 0xFF
+    rounds(4)
+    return v0 ^ v1 ^ v2 ^ v3
+
+
+def py38_source_hash(source: bytes) -> bytes:
+    """`importlib.util.source_hash` as Python 3.8 computes it, which 3.11 and
+    later don't, so it's computed here there."""
+    if sys.version_info < (3, 11):
+        return _imp.source_hash(_PY38_RAW_MAGIC, source)
+    return _siphash24(_PY38_RAW_MAGIC, 0, source).to_bytes(8, "little")
+
+
+def py38_pyc_header(
+    input_header: unmarshal39.Py39PycHeader,
+    invalidation_mode: typing.Optional[py_compile.PycInvalidationMode] = None,
+    source: typing.Optional[bytes] = None,
+    timestamp: typing.Optional[int] = None,
+) -> bytes:
+    """
+    Builds the 16 byte header of the 3.8 pyc file downgraded from a 3.9 one
+    with `input_header`, so 3.8 treats it as up to date with the same source
+    the 3.9 one was.
+
+    By default the output is validated the same way as the input. Timestamp
+    based pycs keep the source mtime and size, hash based ones their flags,
+    but the hash needs `source` to be recomputed since it is keyed by the
+    magic number. Without `source` the 3.9 hash is kept. `invalidation_mode`
+    switches to another kind of pyc, a hash based one needs `source` unless
+    the input already was hash based, and a timestamp based one made from a
+    hash based input gets `timestamp` (the current time by default) as the
+    mtime.
+    """
+    if invalidation_mode is None:
+        hash_based = bool(input_header.flags & FLAG_HASH_BASED)
+        check_source = bool(input_header.flags & FLAG_CHECK_SOURCE)
+    else:
+        hash_based = invalidation_mode != py_compile.PycInvalidationMode.TIMESTAMP
+        check_source = (
+            invalidation_mode == py_compile.PycInvalidationMode.CHECKED_HASH
+        )
+
+    if not hash_based:
+        if input_header.source_mtime is not None:
+            return _timestamp_header(
+                input_header.source_mtime, input_header.source_size
+            )
+        if timestamp is None:
+            timestamp = int(time.time())
+        return _timestamp_header(timestamp, 0 if source is None else len(source))
+
+    if source is not None:
+        source_hash = py38_source_hash(source)
+    elif input_header.source_hash is not None:
+        source_hash = input_header.source_hash
+    else:
+        raise ValueError("The source is needed to write a hash based pyc")
+    flags = FLAG_HASH_BASED | (FLAG_CHECK_SOURCE if check_source else 0)
+    return PY38_MAGIC + struct.pack("<I", flags) + source_hash
+
+
+def write_py38_pyc_atomically(
+    path: pathlib.Path,
+    header: bytes,
+    serialized_code: bytes,
+    digest: typing.Optional["hashlib._Hash"] = None,
+) -> int:
+    """
+    Writes a 3.8 pyc file, from its `header` and already marshalled code,
+    through a temporary file next to `path`, so anything reading `path` only
+    ever sees the old file or the complete new one. Returns the size of the
+    file written. `digest` is updated with everything written, if given.
+    """
+
+    def write(f: typing.BinaryIO) -> None:
+        f.write(header)
+        f.write(serialized_code)
+
+    return _write_atomically(path, write, digest)
+
+
+def stream_py38_pyc_atomically(
+    path: pathlib.Path,
+    header: bytes,
+    code: "xdis.Code38",
+    digest: typing.Optional["hashlib._Hash"] = None,
+) -> int:
+    """
+    Like `write_py38_pyc_atomically`, but marshals `code` straight into the
+    file as it goes, see `stream_py38_code`.
+    """
 
-    magic_bytes = xdis_magics["3.8.3"]
-    file.write(magic_bytes)
+    def write(f: typing.BinaryIO) -> None:
+        f.write(header)
+        stream_py38_code(code, f)
 
-    # 0 means a timestamp based validated pyc (instead of hash based)
-    file.write(struct.pack("<I", 0))
-    file.write(struct.pack("<I", timestamp))
+    return _write_atomically(path, write, digest)
 
-    # Size of the source file, we just put 0 here.
-    file.write(struct.pack("<I", 0))
 
-    code = code.freeze()
-    serialized_code = xdis_marsh.dumps(code, python_version=(3, 8, 3))
-    file.write(serialized_code)
+def _create_temp_file(directory: pathlib.Path) -> typing.Tuple[int, str]:
+    # Unlike `tempfile.mkstemp`, which only lets the owner read the file, this
+    # leaves the kernel to apply the current umask, so outputs get the mode
+    # `open` would have given them.
+    while True:
+        temp_path = os.path.join(directory, ".tmp-" + os.urandom(8).hex())
+        try:
+            fd = os.open(
+                temp_path,
+                os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, "O_BINARY", 0),
+                0o666,
+            )
+        except FileExistsError:
+            continue
+        return fd, temp_path
+
+
+class _DigestingWriter:
+    """Passes writes on to `file`, updating `digest` with them."""
+
+    def __init__(self, file: typing.BinaryIO, digest: "hashlib._Hash") -> None:
+        self._file = file
+        self._digest = digest
+
+    def write(self, data: bytes) -> int:
+        self._digest.update(data)
+        return self._file.write(data)
+
+
+def _write_atomically(
+    path: pathlib.Path,
+    write: typing.Callable[[typing.BinaryIO], None],
+    digest: typing.Optional["hashlib._Hash"] = None,
+) -> int:
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_path = _create_temp_file(path.parent)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            if digest is None:
+                write(f)
+            else:
+                write(typing.cast(typing.BinaryIO, _DigestingWriter(f, digest)))
+            size = f.tell()
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return size
+
+
+def dump_py38_code(code: "xdis.Code38") -> bytes:
+    """Marshals `code` the way Python 3.8 does, without any pyc header."""
+    return marshal38.dumps(code.freeze())
+
+
+def stream_py38_code(code: "xdis.Code38", file: typing.BinaryIO) -> int:
+    """
+    Like `dump_py38_code`, but writes to `file` a chunk at a time instead of
+    holding all of the marshalled code, and returns its size. See
+    `marshal38.dump`.
+    """
+    return marshal38.dump(code.freeze(), file)
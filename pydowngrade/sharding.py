@@ -0,0 +1,421 @@
+"""
+Splits the conversion of a directory too large for one machine over several,
+each converting one shard of its files:
+
+    python -m pydowngrade.sharding manifest store/ inputs.json
+    python -m pydowngrade store/ out/ --manifest inputs.json --shard 2/8
+    python -m pydowngrade.sharding merge out/.pydowngrade-shard-*.json \\
+        --input-manifest inputs.json -o converted.json
+
+The input manifest lists the files to convert, relative to the input
+directory, with their sizes. Every shard partitions it the same way, by
+size rather than by count so the shards take about as long as each other,
+and converts its part. Without a manifest the input directory is walked,
+which only partitions the same way on every machine if they see the same
+files.
+
+Each shard writes a result manifest recording, for every one of its files,
+the hashes of the input and output, whether it converted and how long it
+took. Merging them checks that no file was converted by more than one shard
+and, given the input manifest, that none was left out.
+"""
+import argparse
+import hashlib
+import heapq
+import json
+import os
+import pathlib
+import py_compile
+import sys
+import tempfile
+import time
+import typing
+
+from .batch import (
+    BatchResult,
+    ConversionTask,
+    FileResult,
+    find_pyc_files,
+    output_path_for,
+    run_tasks,
+)
+from .cache import DowngradeCache
+from .downgrade_transformer import TRANSFORM_VERSION
+from .stats import DowngradeStats
+
+# Converting a file takes about as long as converting another 2.5 KB of
+# input would, on top of its own size.
+PER_FILE_WEIGHT = 2500
+
+
+class Shard(typing.NamedTuple):
+    """Shard `index` of `count`, counting from 1."""
+
+    index: int
+    count: int
+
+    @classmethod
+    def parse(cls, spec: str) -> "Shard":
+        """Parses `I/N`, raising `ValueError` if it isn't one of N shards."""
+        index, slash, count = spec.partition("/")
+        if not slash or not index.isdigit() or not count.isdigit():
+            raise ValueError("A shard is given as I/N, not %r" % spec)
+        shard = cls(int(index), int(count))
+        if not 1 <= shard.index <= shard.count:
+            raise ValueError("There is no shard %s" % spec)
+        return shard
+
+    def __str__(self) -> str:
+        return "%d/%d" % self
+
+    def manifest_filename(self) -> str:
+        """The default name of the shard's result manifest."""
+        return ".pydowngrade-shard-%d-of-%d.json" % self
+
+
+def scan_input_sizes(input_root: pathlib.Path) -> typing.Dict[str, int]:
+    """The size of every pyc file `find_pyc_files` finds under `input_root`,
+    by its path relative to it."""
+    input_root = pathlib.Path(input_root)
+    return {
+        path.relative_to(input_root).as_posix(): path.stat().st_size
+        for path in find_pyc_files(input_root)
+    }
+
+
+def write_input_manifest(
+    path: pathlib.Path, sizes: typing.Dict[str, int]
+) -> None:
+    _write_json_atomically(path, {"files": dict(sorted(sizes.items()))})
+
+
+def read_input_manifest(path: pathlib.Path) -> typing.Dict[str, int]:
+    """
+    Reads a manifest written by `write_input_manifest`. A `ValueError` is
+    raised if it's malformed or names files outside the input directory.
+    """
+    data = json.loads(pathlib.Path(path).read_text("utf-8"))
+    files = data.get("files") if isinstance(data, dict) else None
+    if not isinstance(files, dict):
+        raise ValueError("%s isn't an input manifest" % path)
+    for name, size in files.items():
+        parts = pathlib.PurePosixPath(name).parts
+        if not parts or parts[0] == "/" or ".." in parts:
+            raise ValueError("%s lists a file outside the input: %r" % (path, name))
+        if not isinstance(size, int) or size < 0:
+            raise ValueError("%s has an invalid size for %r" % (path, name))
+    return files
+
+
+def inputs_digest(sizes: typing.Dict[str, int]) -> str:
+    """A hash of the files to partition, shards that agree on it agree on the
+    partition."""
+    return hashlib.sha256(
+        json.dumps(sorted(sizes.items()), separators=(",", ":")).encode("utf-8")
+    ).hexdigest()
+
+
+def partition(
+    sizes: typing.Dict[str, int], count: int
+) -> typing.List[typing.List[str]]:
+    """
+    Splits the files of `sizes` into `count` lists of about the same total
+    weight, `PER_FILE_WEIGHT` plus the size of each file. The files go from
+    the heaviest to the lightest to whichever list is lightest so far, with
+    ties broken by name and list index so the result only depends on `sizes`.
+    Each list is sorted by name.
+    """
+    shards: typing.List[typing.List[str]] = [[] for _ in range(count)]
+    heap = [(0, index) for index in range(count)]
+    for name in sorted(sizes, key=lambda name: (-sizes[name], name)):
+        weight, index = heapq.heappop(heap)
+        shards[index].append(name)
+        heapq.heappush(heap, (weight + PER_FILE_WEIGHT + sizes[name], index))
+    for names in shards:
+        names.sort()
+    return shards
+
+
+def convert_shard(
+    input_root: pathlib.Path,
+    output_root: pathlib.Path,
+    shard: Shard,
+    sizes: typing.Optional[typing.Dict[str, int]] = None,
+    manifest_path: typing.Optional[pathlib.Path] = None,
+    jobs: typing.Optional[int] = None,
+    cache: typing.Optional[DowngradeCache] = None,
+    optimize: bool = False,
+    queue_depth: typing.Optional[int] = None,
+    invalidation_mode: typing.Optional[py_compile.PycInvalidationMode] = None,
+    verify: bool = False,
+) -> BatchResult:
+    """
+    Like `convert_tree`, but only converts the files of `shard`, out of the
+    files of the input manifest `sizes` (default: every file under
+    `input_root`). The result manifest goes to `manifest_path`, by default
+    next to the outputs as `Shard.manifest_filename`.
+
+    Stats are always collected, for the timings in the manifest.
+    """
+    start = time.perf_counter()
+    input_root = pathlib.Path(input_root)
+    output_root = pathlib.Path(output_root)
+    if sizes is None:
+        sizes = scan_input_sizes(input_root)
+    timestamp = int(time.time())
+    tasks = [
+        ConversionTask(
+            input_root / name,
+            output_path_for(input_root, output_root, input_root / name),
+            timestamp,
+            cache,
+            optimize,
+            True,
+            invalidation_mode,
+            verify,
+        )
+        for name in partition(sizes, shard.count)[shard.index - 1]
+    ]
+
+    result = BatchResult(DowngradeStats())
+    run_tasks(tasks, jobs, result, queue_depth)
+    result.elapsed = time.perf_counter() - start
+
+    files = {}
+    for file_result in result.converted + result.failures:
+        name = file_result.input_path.relative_to(input_root).as_posix()
+        files[name] = _file_entry(file_result, output_root)
+    _write_json_atomically(
+        manifest_path or output_root / shard.manifest_filename(),
+        {
+            "transform_version": TRANSFORM_VERSION,
+            "optimize": optimize,
+            "invalidation_mode": (
+                None if invalidation_mode is None else invalidation_mode.name
+            ),
+            "shard": str(shard),
+            "inputs_sha256": inputs_digest(sizes),
+            "elapsed": result.elapsed,
+            "stats": result.stats.to_dict(),
+            "files": dict(sorted(files.items())),
+        },
+    )
+    return result
+
+
+def _file_entry(file_result: FileResult, output_root: pathlib.Path) -> dict:
+    seconds = 0.0
+    if file_result.stats is not None:
+        # Relocating is timed as part of transforming too.
+        seconds = sum(
+            elapsed
+            for stage, elapsed in file_result.stats.stage_seconds.items()
+            if stage != "relocate"
+        )
+    entry = {
+        "status": "converted" if file_result.error is None else "failed",
+        "input_sha256": file_result.input_sha256,
+        "input_size": file_result.input_size,
+        "output": None,
+        "output_sha256": file_result.output_sha256,
+        "output_size": file_result.output_size,
+        "cache_hit": file_result.cache_hit,
+        "seconds": seconds,
+        "error": None,
+    }
+    if file_result.error is None:
+        entry["output"] = file_result.output_path.relative_to(output_root).as_posix()
+    else:
+        entry["error"] = file_result.error.strip().splitlines()[-1]
+    return entry
+
+
+class MergeResult:
+    """The result manifests of the shards of one conversion, combined."""
+
+    def __init__(self) -> None:
+        # The entries of every file converted or attempted by some shard, as
+        # in the result manifests, with the shard it came from.
+        self.files: typing.Dict[str, dict] = {}
+        # Files in the input manifest no shard reported on, and the shards
+        # that are missing altogether.
+        self.missing: typing.List[str] = []
+        self.missing_shards: typing.List[str] = []
+        # Files reported by more than one shard, with the shards.
+        self.duplicates: typing.Dict[str, typing.List[str]] = {}
+        # What every shard was converted from and with.
+        self.options: dict = {}
+
+    @property
+    def failed(self) -> typing.List[str]:
+        return sorted(
+            name for name, entry in self.files.items() if entry["status"] != "converted"
+        )
+
+    @property
+    def ok(self) -> bool:
+        return not (
+            self.missing or self.missing_shards or self.duplicates or self.failed
+        )
+
+    def to_dict(self) -> dict:
+        return dict(
+            self.options,
+            files=dict(sorted(self.files.items())),
+            missing=self.missing,
+            missing_shards=self.missing_shards,
+            duplicates=dict(sorted(self.duplicates.items())),
+            failed=self.failed,
+        )
+
+    def summary(self) -> str:
+        failed = self.failed
+        lines = [
+            "Merged %d files, %d converted"
+            % (len(self.files), len(self.files) - len(failed))
+        ]
+        if self.missing_shards:
+            lines.append("Missing shards: %s" % ", ".join(self.missing_shards))
+        if self.missing:
+            lines.append("Missing %d files:" % len(self.missing))
+            lines.extend("  %s" % name for name in self.missing)
+        if self.duplicates:
+            lines.append("Converted %d files more than once:" % len(self.duplicates))
+            for name, shards in sorted(self.duplicates.items()):
+                lines.append("  %s: shards %s" % (name, ", ".join(shards)))
+        if failed:
+            lines.append("Failed to convert %d files:" % len(failed))
+            for name in failed:
+                lines.append("  %s: %s" % (name, self.files[name]["error"]))
+        return "\n".join(lines)
+
+
+def merge_shard_manifests(
+    manifest_paths: typing.Iterable[pathlib.Path],
+    sizes: typing.Optional[typing.Dict[str, int]] = None,
+) -> MergeResult:
+    """
+    Combines the result manifests written by `convert_shard`. Shards missing
+    from `manifest_paths` and files reported by several of them are
+    recorded in the result, and so are files of the input manifest `sizes`
+    that no shard reported on. For a file reported more than once, a shard
+    that converted it wins over one that failed to, and otherwise the first.
+
+    A `ValueError` is raised if the manifests aren't all from one conversion:
+    the same inputs, shard count, options and `TRANSFORM_VERSION`.
+    """
+    result = MergeResult()
+    seen_shards = set()
+    count = None
+    for path in manifest_paths:
+        data = json.loads(pathlib.Path(path).read_text("utf-8"))
+        options = {
+            key: data.get(key)
+            for key in (
+                "transform_version",
+                "optimize",
+                "invalidation_mode",
+                "inputs_sha256",
+            )
+        }
+        shard = Shard.parse(data.get("shard", ""))
+        if count is None:
+            count = shard.count
+            result.options = options
+        if shard.count != count or options != result.options:
+            raise ValueError(
+                "%s is from a different conversion than the other shards" % path
+            )
+        if sizes is not None and options["inputs_sha256"] != inputs_digest(sizes):
+            raise ValueError("%s wasn't converted from the input manifest" % path)
+        seen_shards.add(shard)
+
+        for name, entry in data["files"].items():
+            entry = dict(entry, shard=str(shard))
+            previous = result.files.get(name)
+            if previous is None:
+                result.files[name] = entry
+                continue
+            result.duplicates.setdefault(name, [previous["shard"]]).append(str(shard))
+            if previous["status"] != "converted" and entry["status"] == "converted":
+                result.files[name] = entry
+
+    if count is not None:
+        result.missing_shards = [
+            str(shard)
+            for shard in (Shard(index, count) for index in range(1, count + 1))
+            if shard not in seen_shards
+        ]
+    if sizes is not None:
+        result.missing = sorted(set(sizes) - set(result.files))
+    return result
+
+
+def _write_json_atomically(path: pathlib.Path, data: dict) -> None:
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+            f.write("\n")
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="pydowngrade.sharding",
+        description="Plans sharded conversions and merges their results.",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    manifest = commands.add_parser(
+        "manifest", help="list the pyc files of a directory in an input manifest"
+    )
+    manifest.add_argument("input", type=pathlib.Path, help="input directory")
+    manifest.add_argument("manifest", type=pathlib.Path, help="manifest to write")
+    merge = commands.add_parser(
+        "merge", help="combine the result manifests of every shard"
+    )
+    merge.add_argument(
+        "shard_manifests", type=pathlib.Path, nargs="+", help="result manifests"
+    )
+    merge.add_argument(
+        "--input-manifest",
+        type=pathlib.Path,
+        default=None,
+        help="input manifest the shards converted, to find missing files",
+    )
+    merge.add_argument(
+        "-o",
+        "--output",
+        type=pathlib.Path,
+        default=None,
+        help="write the merged manifest to this file",
+    )
+    args = parser.parse_args(argv)
+
+    if args.command == "manifest":
+        sizes = scan_input_sizes(args.input)
+        write_input_manifest(args.manifest, sizes)
+        print("Listed %d files (%d bytes)" % (len(sizes), sum(sizes.values())))
+        return 0
+
+    try:
+        sizes = None
+        if args.input_manifest is not None:
+            sizes = read_input_manifest(args.input_manifest)
+        result = merge_shard_manifests(args.shard_manifests, sizes)
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        return 1
+    if args.output is not None:
+        _write_json_atomically(args.output, result.to_dict())
+    print(result.summary())
+    return 0 if result.ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
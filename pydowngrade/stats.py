@@ -0,0 +1,73 @@
+import collections
+import contextlib
+import json
+import time
+import typing
+
+# Stages timed by `DowngradeStats`. "relocate" is the jump layout done while
+# transforming, so its time is also part of "transform". "verify" is only
+# timed when outputs are verified.
+STAGES = ("load", "transform", "relocate", "verify", "marshal")
+
+_NOT_TIMED = contextlib.nullcontext()
+
+
+class DowngradeStats:
+    """
+    Opt-in instrumentation of a conversion. Pass an instance to the functions
+    that accept a `stats` argument and they record into it, passing None (the
+    default) skips all bookkeeping.
+
+    Instances from several workers can be combined with `merge` and exported
+    with `to_json`.
+    """
+
+    def __init__(self) -> None:
+        self.files = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.stage_seconds: typing.Counter[str] = collections.Counter()
+        # Number of times each 3.9 only opcode was rewritten, by name.
+        self.rewritten_opcodes: typing.Counter[str] = collections.Counter()
+        # Number of times a jump had to grow another EXTENDED_ARG prefix
+        # while laying out the 3.8 bytecode.
+        self.extended_arg_widenings = 0
+
+    @contextlib.contextmanager
+    def timed(self, stage: str) -> typing.Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_seconds[stage] += time.perf_counter() - start
+
+    def merge(self, other: "DowngradeStats") -> None:
+        self.files += other.files
+        self.bytes_in += other.bytes_in
+        self.bytes_out += other.bytes_out
+        self.stage_seconds.update(other.stage_seconds)
+        self.rewritten_opcodes.update(other.rewritten_opcodes)
+        self.extended_arg_widenings += other.extended_arg_widenings
+
+    def to_dict(self) -> dict:
+        return {
+            "files": self.files,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "stage_seconds": {
+                stage: self.stage_seconds.get(stage, 0.0) for stage in STAGES
+            },
+            "rewritten_opcodes": dict(sorted(self.rewritten_opcodes.items())),
+            "extended_arg_widenings": self.extended_arg_widenings,
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2)
+
+
+def timed(stats: typing.Optional[DowngradeStats], stage: str):
+    """`stats.timed(stage)`, or a context manager that does nothing if
+    `stats` is None."""
+    if stats is None:
+        return _NOT_TIMED
+    return stats.timed(stage)
@@ -0,0 +1,337 @@
+"""
+A reader for Python 3.9 pyc files that skips xdis's version independent
+loader.
+
+The marshal data is read straight out of a memoryview of the file (usually
+memory-mapped) into `xdis.Code38` objects, which xdis uses for both 3.8 and
+3.9 code. Only the bytecode and strings are copied out of the buffer.
+
+3.10 pyc files are read too, their marshal format is the same. Their
+`co_linetable` ends up in `co_lnotab`.
+"""
+import struct
+import sys
+import typing
+
+if typing.TYPE_CHECKING:
+    import xdis
+
+# Magic numbers of Python 3.9, from 3.9a0 through to the final release.
+PY39_MAGIC_INTS = frozenset(range(3420, 3426))
+# And of Python 3.10.
+PY310_MAGIC_INTS = frozenset(range(3430, 3440))
+
+PYC_HEADER_SIZE = 16
+
+FLAG_REF = 0x80
+
+_HEADER = struct.Struct("<HHIII")
+_LONG = struct.Struct("<i")
+_SHORT = struct.Struct("<H")
+_DOUBLE = struct.Struct("<d")
+_CODE_HEADER = struct.Struct("<6i")
+
+# Marks the end of a dict.
+_NULL = object()
+
+
+class Py39PycHeader(typing.NamedTuple):
+    magic_int: int
+    # PEP 552 flags, bit 0 set means a hash based pyc.
+    flags: int
+    # Only set for timestamp based pycs.
+    source_mtime: typing.Optional[int]
+    source_size: typing.Optional[int]
+    # Only set for hash based pycs.
+    source_hash: typing.Optional[bytes]
+
+    @property
+    def version(self) -> typing.Tuple[int, int]:
+        """The Python version the pyc file is for."""
+        return (3, 10) if self.magic_int in PY310_MAGIC_INTS else (3, 9)
+
+
+def read_pyc_header(data) -> Py39PycHeader:
+    """
+    Parses the 16 byte header at the start of a pyc file, raising a
+    `ValueError` if it isn't for Python 3.9 or 3.10.
+    """
+    if len(data) < PYC_HEADER_SIZE:
+        raise ValueError("File is too short to be a pyc file")
+
+    magic_int, magic_end, flags, field_1, field_2 = _HEADER.unpack_from(data)
+    if (
+        magic_int not in PY39_MAGIC_INTS and magic_int not in PY310_MAGIC_INTS
+    ) or magic_end != 0x0A0D:
+        raise ValueError("Only Python 3.9 and 3.10 files are supported")
+
+    if flags & 0b1:
+        return Py39PycHeader(magic_int, flags, None, None, bytes(data[8:16]))
+    return Py39PycHeader(magic_int, flags, field_1, field_2, None)
+
+
+def loads(data, offset: int = 0, filename: str = "<unknown>") -> "xdis.Code38":
+    """Unmarshals the 3.9 code object starting at `offset` of `data`."""
+    with memoryview(data) as view:
+        reader = _Reader(view, offset)
+        try:
+            return reader.read_object()
+        except (struct.error, IndexError):
+            raise ValueError("Truncated marshal data in %s" % filename) from None
+
+
+class _Reader:
+    def __init__(self, view: memoryview, offset: int) -> None:
+        self.view = view
+        self.position = offset
+        self.refs: typing.List[typing.Any] = []
+
+    def read_object(self):
+        code = self.view[self.position]
+        self.position += 1
+        return _DISPATCH[code](self, code & FLAG_REF)
+
+    def _read_unknown(self, flag):
+        code = self.view[self.position - 1]
+        raise ValueError("Bad marshal data (unknown type code %d)" % code)
+
+    def _add_ref(self, flag: int, obj):
+        if flag:
+            self.refs.append(obj)
+        return obj
+
+    def _reserve_ref(self, flag: int) -> typing.Optional[int]:
+        """Containers get their reference index before their items are read."""
+        if not flag:
+            return None
+        self.refs.append(None)
+        return len(self.refs) - 1
+
+    def _fill_ref(self, index: typing.Optional[int], obj):
+        if index is not None:
+            self.refs[index] = obj
+        return obj
+
+    def _read_long_field(self) -> int:
+        value = _LONG.unpack_from(self.view, self.position)[0]
+        self.position += 4
+        return value
+
+    def _read_slice(self, size: int) -> memoryview:
+        start = self.position
+        self.position += size
+        if self.position > len(self.view):
+            raise IndexError("marshal data too short")
+        return self.view[start:self.position]
+
+    def _read_null(self, flag):
+        return _NULL
+
+    def _read_none(self, flag):
+        return None
+
+    def _read_false(self, flag):
+        return False
+
+    def _read_true(self, flag):
+        return True
+
+    def _read_stop_iteration(self, flag):
+        return StopIteration
+
+    def _read_ellipsis(self, flag):
+        return Ellipsis
+
+    def _read_int(self, flag):
+        return self._add_ref(flag, self._read_long_field())
+
+    def _read_long(self, flag):
+        count = self._read_long_field()
+        value = 0
+        for i in range(abs(count)):
+            digit = _SHORT.unpack_from(self.view, self.position)[0]
+            self.position += 2
+            value |= digit << (15 * i)
+        return self._add_ref(flag, -value if count < 0 else value)
+
+    def _read_binary_float(self, flag):
+        value = _DOUBLE.unpack_from(self.view, self.position)[0]
+        self.position += 8
+        return self._add_ref(flag, value)
+
+    def _read_binary_complex(self, flag):
+        real = _DOUBLE.unpack_from(self.view, self.position)[0]
+        imag = _DOUBLE.unpack_from(self.view, self.position + 8)[0]
+        self.position += 16
+        return self._add_ref(flag, complex(real, imag))
+
+    def _read_bytes(self, flag):
+        size = self._read_long_field()
+        return self._add_ref(flag, bytes(self._read_slice(size)))
+
+    def _read_unicode(self, flag):
+        size = self._read_long_field()
+        return self._add_ref(
+            flag, str(self._read_slice(size), "utf8", "surrogatepass")
+        )
+
+    def _read_interned(self, flag):
+        size = self._read_long_field()
+        value = str(self._read_slice(size), "utf8", "surrogatepass")
+        return self._add_ref(flag, sys.intern(value))
+
+    def _read_ascii(self, flag):
+        size = self._read_long_field()
+        return self._add_ref(flag, str(self._read_slice(size), "latin1"))
+
+    def _read_ascii_interned(self, flag):
+        size = self._read_long_field()
+        return self._add_ref(
+            flag, sys.intern(str(self._read_slice(size), "latin1"))
+        )
+
+    def _read_short_ascii(self, flag):
+        size = self.view[self.position]
+        self.position += 1
+        return self._add_ref(flag, str(self._read_slice(size), "latin1"))
+
+    def _read_short_ascii_interned(self, flag):
+        size = self.view[self.position]
+        self.position += 1
+        return self._add_ref(
+            flag, sys.intern(str(self._read_slice(size), "latin1"))
+        )
+
+    def _read_ref(self, flag):
+        index = self._read_long_field()
+        if not 0 <= index < len(self.refs):
+            raise ValueError("Bad marshal data (invalid reference)")
+        obj = self.refs[index]
+        if obj is None:
+            # Only containers that are still being read have a None
+            # placeholder, and containers can't contain themselves.
+            raise ValueError("Bad marshal data (invalid reference)")
+        return obj
+
+    def _read_items(self, count: int) -> list:
+        read_object = self.read_object
+        return [read_object() for _ in range(count)]
+
+    def _read_tuple(self, flag):
+        index = self._reserve_ref(flag)
+        count = self._read_long_field()
+        return self._fill_ref(index, tuple(self._read_items(count)))
+
+    def _read_small_tuple(self, flag):
+        index = self._reserve_ref(flag)
+        count = self.view[self.position]
+        self.position += 1
+        return self._fill_ref(index, tuple(self._read_items(count)))
+
+    def _read_list(self, flag):
+        count = self._read_long_field()
+        value = self._add_ref(flag, [])
+        value.extend(self._read_items(count))
+        return value
+
+    def _read_dict(self, flag):
+        value = self._add_ref(flag, {})
+        while True:
+            key = self.read_object()
+            if key is _NULL:
+                return value
+            value[key] = self.read_object()
+
+    def _read_set(self, flag):
+        count = self._read_long_field()
+        value = self._add_ref(flag, set())
+        value.update(self._read_items(count))
+        return value
+
+    def _read_frozenset(self, flag):
+        index = self._reserve_ref(flag)
+        count = self._read_long_field()
+        return self._fill_ref(index, frozenset(self._read_items(count)))
+
+    def _read_code(self, flag):
+        # xdis takes a while to import, so it's only imported once there's
+        # code to load.
+        from xdis import Code38
+
+        index = self._reserve_ref(flag)
+        (
+            argcount,
+            posonlyargcount,
+            kwonlyargcount,
+            nlocals,
+            stacksize,
+            flags,
+        ) = _CODE_HEADER.unpack_from(self.view, self.position)
+        self.position += _CODE_HEADER.size
+
+        read_object = self.read_object
+        co_code = read_object()
+        co_consts = read_object()
+        co_names = read_object()
+        co_varnames = read_object()
+        co_freevars = read_object()
+        co_cellvars = read_object()
+        co_filename = read_object()
+        co_name = read_object()
+        firstlineno = self._read_long_field()
+        co_lnotab = read_object()
+
+        code = Code38(
+            argcount,
+            posonlyargcount,
+            kwonlyargcount,
+            nlocals,
+            stacksize,
+            flags,
+            co_code,
+            co_consts,
+            co_names,
+            co_varnames,
+            co_filename,
+            co_name,
+            firstlineno,
+            co_lnotab,
+            co_freevars,
+            co_cellvars,
+        )
+        return self._fill_ref(index, code)
+
+
+_READERS = {
+    ord("0"): _Reader._read_null,
+    ord("N"): _Reader._read_none,
+    ord("F"): _Reader._read_false,
+    ord("T"): _Reader._read_true,
+    ord("S"): _Reader._read_stop_iteration,
+    ord("."): _Reader._read_ellipsis,
+    ord("i"): _Reader._read_int,
+    ord("l"): _Reader._read_long,
+    ord("g"): _Reader._read_binary_float,
+    ord("y"): _Reader._read_binary_complex,
+    ord("s"): _Reader._read_bytes,
+    ord("t"): _Reader._read_interned,
+    ord("r"): _Reader._read_ref,
+    ord("("): _Reader._read_tuple,
+    ord(")"): _Reader._read_small_tuple,
+    ord("["): _Reader._read_list,
+    ord("{"): _Reader._read_dict,
+    ord("c"): _Reader._read_code,
+    ord("u"): _Reader._read_unicode,
+    ord("<"): _Reader._read_set,
+    ord(">"): _Reader._read_frozenset,
+    ord("a"): _Reader._read_ascii,
+    ord("A"): _Reader._read_ascii_interned,
+    ord("z"): _Reader._read_short_ascii,
+    ord("Z"): _Reader._read_short_ascii_interned,
+}
+# Indexed by the raw type byte, FLAG_REF included, so reading an object is a
+# single lookup. Built once rather than for every reader, since most pyc files
+# are small enough for that to be a good part of the time spent reading them.
+_DISPATCH = tuple(
+    _READERS.get(code & ~FLAG_REF, _Reader._read_unknown) for code in range(256)
+)
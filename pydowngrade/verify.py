@@ -0,0 +1,319 @@
+"""
+A static verifier for Python 3.8 code objects, a much cheaper check of
+downgraded code than importing it in a 3.8 interpreter.
+
+It checks what CPython itself trusts the compiler to get right: that only 3.8
+opcodes are used, that jumps land on instructions, that arguments index into
+the tables they refer to and that the stack never underflows nor grows past
+`co_stacksize`.
+"""
+import typing
+
+from .instructions import EXTENDED_ARG_OPCODE, Instruction, decode_instructions
+from .opcodes import opcode_38
+
+if typing.TYPE_CHECKING:
+    import xdis
+
+_OPS = opcode_38
+
+VALID_OPCODES = frozenset(
+    opcode for opcode, name in enumerate(_OPS.opname) if not name.startswith("<")
+)
+
+# Instructions that never continue on to the next one.
+_NO_FALL_THROUGH = frozenset(
+    (
+        _OPS.JUMP_ABSOLUTE,
+        _OPS.JUMP_FORWARD,
+        _OPS.RETURN_VALUE,
+        _OPS.RAISE_VARARGS,
+    )
+)
+
+_HASCONST = frozenset(_OPS.hasconst)
+_HASNAME = frozenset(_OPS.hasname)
+_HASLOCAL = frozenset(_OPS.haslocal)
+_HASFREE = frozenset(_OPS.hasfree)
+
+# Stack effects that don't depend on the argument or on whether a jump is
+# taken, from CPython 3.8's `stack_effect` in compile.c.
+_FIXED_STACK_EFFECTS = {
+    "NOP": 0,
+    "POP_TOP": -1,
+    "ROT_TWO": 0,
+    "ROT_THREE": 0,
+    "ROT_FOUR": 0,
+    "DUP_TOP": 1,
+    "DUP_TOP_TWO": 2,
+    "UNARY_POSITIVE": 0,
+    "UNARY_NEGATIVE": 0,
+    "UNARY_NOT": 0,
+    "UNARY_INVERT": 0,
+    "SET_ADD": -1,
+    "LIST_APPEND": -1,
+    "MAP_ADD": -2,
+    "BINARY_POWER": -1,
+    "BINARY_MULTIPLY": -1,
+    "BINARY_MATRIX_MULTIPLY": -1,
+    "BINARY_MODULO": -1,
+    "BINARY_ADD": -1,
+    "BINARY_SUBTRACT": -1,
+    "BINARY_SUBSCR": -1,
+    "BINARY_FLOOR_DIVIDE": -1,
+    "BINARY_TRUE_DIVIDE": -1,
+    "INPLACE_FLOOR_DIVIDE": -1,
+    "INPLACE_TRUE_DIVIDE": -1,
+    "INPLACE_ADD": -1,
+    "INPLACE_SUBTRACT": -1,
+    "INPLACE_MULTIPLY": -1,
+    "INPLACE_MATRIX_MULTIPLY": -1,
+    "INPLACE_MODULO": -1,
+    "STORE_SUBSCR": -3,
+    "DELETE_SUBSCR": -2,
+    "BINARY_LSHIFT": -1,
+    "BINARY_RSHIFT": -1,
+    "BINARY_AND": -1,
+    "BINARY_XOR": -1,
+    "BINARY_OR": -1,
+    "INPLACE_POWER": -1,
+    "GET_ITER": 0,
+    "PRINT_EXPR": -1,
+    "LOAD_BUILD_CLASS": 1,
+    "INPLACE_LSHIFT": -1,
+    "INPLACE_RSHIFT": -1,
+    "INPLACE_AND": -1,
+    "INPLACE_XOR": -1,
+    "INPLACE_OR": -1,
+    "RETURN_VALUE": -1,
+    "IMPORT_STAR": -1,
+    "SETUP_ANNOTATIONS": 0,
+    "YIELD_VALUE": 0,
+    "YIELD_FROM": -1,
+    "POP_BLOCK": 0,
+    "POP_EXCEPT": -3,
+    # Pops 6 values when an exception was raised.
+    "END_FINALLY": -6,
+    # Actually pushes 1 value, but is counted as 6 to balance END_FINALLY.
+    "BEGIN_FINALLY": 6,
+    "POP_FINALLY": -6,
+    "STORE_NAME": -1,
+    "DELETE_NAME": 0,
+    "STORE_ATTR": -2,
+    "DELETE_ATTR": -1,
+    "STORE_GLOBAL": -1,
+    "DELETE_GLOBAL": 0,
+    "LOAD_CONST": 1,
+    "LOAD_NAME": 1,
+    "LOAD_ATTR": 0,
+    "COMPARE_OP": -1,
+    "IMPORT_NAME": -1,
+    "IMPORT_FROM": 1,
+    "JUMP_FORWARD": 0,
+    "JUMP_ABSOLUTE": 0,
+    "POP_JUMP_IF_FALSE": -1,
+    "POP_JUMP_IF_TRUE": -1,
+    "LOAD_GLOBAL": 1,
+    "LOAD_FAST": 1,
+    "STORE_FAST": -1,
+    "DELETE_FAST": 0,
+    "LOAD_CLOSURE": 1,
+    "LOAD_DEREF": 1,
+    "LOAD_CLASSDEREF": 1,
+    "STORE_DEREF": -1,
+    "DELETE_DEREF": 0,
+    "GET_AWAITABLE": 0,
+    "BEFORE_ASYNC_WITH": 1,
+    "GET_AITER": 0,
+    "GET_ANEXT": 1,
+    "GET_YIELD_FROM_ITER": 0,
+    "END_ASYNC_FOR": -7,
+    "LOAD_METHOD": 1,
+    # Or 1, depending on TOS.
+    "WITH_CLEANUP_START": 2,
+    "WITH_CLEANUP_FINISH": -3,
+    "EXTENDED_ARG": 0,
+}
+_FIXED_STACK_EFFECTS = {
+    _OPS.opmap[name]: effect for name, effect in _FIXED_STACK_EFFECTS.items()
+}
+
+_BUILD_OPS = frozenset(
+    _OPS.opmap[name]
+    for name in (
+        "BUILD_TUPLE",
+        "BUILD_LIST",
+        "BUILD_SET",
+        "BUILD_STRING",
+        "BUILD_LIST_UNPACK",
+        "BUILD_TUPLE_UNPACK",
+        "BUILD_TUPLE_UNPACK_WITH_CALL",
+        "BUILD_SET_UNPACK",
+        "BUILD_MAP_UNPACK",
+        "BUILD_MAP_UNPACK_WITH_CALL",
+    )
+)
+
+# FORMAT_VALUE has a format spec on the stack.
+_FVS_HAVE_SPEC = 0x4
+
+
+def stack_effect(opcode: int, arg: int, jump: bool) -> int:
+    """
+    The stack effect of a 3.8 instruction, like `dis.stack_effect` on 3.8,
+    but it works whichever version of Python this runs on. `jump` picks the
+    effect of taking the jump for jump instructions.
+    """
+    effect = _FIXED_STACK_EFFECTS.get(opcode)
+    if effect is not None:
+        return effect
+    if opcode in _BUILD_OPS:
+        return 1 - arg
+    if opcode == _OPS.UNPACK_SEQUENCE:
+        return arg - 1
+    if opcode == _OPS.UNPACK_EX:
+        return (arg & 0xFF) + (arg >> 8)
+    if opcode == _OPS.FOR_ITER:
+        # -1 at the end of the iterator, 1 if it continues iterating.
+        return -1 if jump else 1
+    if opcode in (_OPS.JUMP_IF_TRUE_OR_POP, _OPS.JUMP_IF_FALSE_OR_POP):
+        return 0 if jump else -1
+    if opcode == _OPS.SETUP_FINALLY:
+        # 6 values are pushed before jumping to the handler.
+        return 6 if jump else 0
+    if opcode == _OPS.CALL_FINALLY:
+        return 1 if jump else 0
+    if opcode == _OPS.SETUP_WITH:
+        return 6 if jump else 1
+    if opcode == _OPS.SETUP_ASYNC_WITH:
+        return 5 if jump else 0
+    if opcode == _OPS.BUILD_MAP:
+        return 1 - 2 * arg
+    if opcode == _OPS.BUILD_CONST_KEY_MAP:
+        return -arg
+    if opcode == _OPS.RAISE_VARARGS or opcode == _OPS.CALL_FUNCTION:
+        return -arg
+    if opcode == _OPS.CALL_METHOD or opcode == _OPS.CALL_FUNCTION_KW:
+        return -arg - 1
+    if opcode == _OPS.CALL_FUNCTION_EX:
+        return -1 - (arg & 0x01)
+    if opcode == _OPS.MAKE_FUNCTION:
+        return -1 - bin(arg & 0x0F).count("1")
+    if opcode == _OPS.BUILD_SLICE:
+        return -2 if arg == 3 else -1
+    if opcode == _OPS.FORMAT_VALUE:
+        return -1 if arg & _FVS_HAVE_SPEC == _FVS_HAVE_SPEC else 0
+    raise ValueError("Unknown Python 3.8 opcode %d" % opcode)
+
+
+def verify_py38_code(code: "xdis.Code38") -> None:
+    """
+    Statically checks `code` and every code object nested in it, raising a
+    `ValueError` describing the first problem found. The checks are linear
+    in the size of the bytecode, bar the few instructions that are reached
+    with more than one stack depth.
+    """
+    from xdis import Code38
+
+    _verify_code(code)
+    for const in code.co_consts:
+        if isinstance(const, Code38):
+            verify_py38_code(const)
+
+
+def _verify_code(code: "xdis.Code38") -> None:
+    co_code = code.co_code
+    if not co_code or len(co_code) % 2:
+        _fail(code, "has %d bytes of bytecode, it must be a positive even number" % (
+            len(co_code)
+        ))
+    if co_code[-2] == EXTENDED_ARG_OPCODE:
+        _fail(code, "ends with an EXTENDED_ARG")
+    for offset in range(0, len(co_code), 2):
+        if co_code[offset] not in VALID_OPCODES:
+            _fail(code, "has unknown opcode %d at %d" % (co_code[offset], offset))
+
+    try:
+        instructions = decode_instructions(co_code, _OPS.JABS_OPS, _OPS.JREL_OPS)
+    except ValueError as e:
+        _fail(code, str(e))
+
+    table_sizes = (
+        (_HASCONST, len(code.co_consts), "co_consts"),
+        (_HASNAME, len(code.co_names), "co_names"),
+        (_HASLOCAL, len(code.co_varnames), "co_varnames"),
+        (_HASFREE, len(code.co_cellvars) + len(code.co_freevars), "cell variables"),
+    )
+    for instruction in instructions:
+        opcode = instruction.opcode
+        for opcodes, size, table in table_sizes:
+            if opcode in opcodes and instruction.arg >= size:
+                _fail(code, "%s at %d indexes past the end of %s" % (
+                    _OPS.opname[opcode], instruction.offset, table
+                ))
+        if opcode == _OPS.COMPARE_OP and instruction.arg >= len(_OPS.cmp_op):
+            _fail(code, "has an unknown comparison at %d" % instruction.offset)
+
+    max_depth = _max_stack_depth(code, instructions)
+    if max_depth > code.co_stacksize:
+        _fail(code, "needs a stack of %d but co_stacksize is %d" % (
+            max_depth, code.co_stacksize
+        ))
+
+
+def _max_stack_depth(
+    code: "xdis.Code38", instructions: typing.List[Instruction]
+) -> int:
+    """
+    Follows every path through `instructions` like CPython's `stackdepth`,
+    returning the largest stack depth reached.
+
+    Like there, an instruction's depth is the deepest one it's reached with
+    and paths reaching it with a shallower stack aren't followed: a finally
+    block is entered with 6 values by an exception but with only 1 by
+    `CALL_FINALLY`, and `END_FINALLY` is counted as popping 6.
+    """
+    index_of = {instruction: i for i, instruction in enumerate(instructions)}
+    depths = [-1] * len(instructions)
+    depths[0] = 0
+    max_depth = 0
+    # Indexes of instructions to walk from, and the depth they're reached at.
+    pending = [(0, 0)]
+    while pending:
+        i, depth = pending.pop()
+        if depth < depths[i]:
+            # Walked from with a deeper stack since.
+            continue
+        while True:
+            instruction = instructions[i]
+            opcode, arg = instruction.opcode, instruction.arg
+            if instruction.target is not None:
+                target_depth = depth + stack_effect(opcode, arg, True)
+                if target_depth < 0:
+                    _fail(code, "underflows the stack jumping from %d" % (
+                        instruction.offset
+                    ))
+                max_depth = max(max_depth, target_depth)
+                target = index_of[instruction.target]
+                if target_depth > depths[target]:
+                    depths[target] = target_depth
+                    pending.append((target, target_depth))
+            depth += stack_effect(opcode, arg, False)
+            if depth < 0:
+                _fail(code, "underflows the stack at %d" % instruction.offset)
+            max_depth = max(max_depth, depth)
+            if opcode in _NO_FALL_THROUGH:
+                break
+            i += 1
+            if i == len(instructions):
+                _fail(code, "runs past the end of its bytecode")
+            if depth <= depths[i]:
+                break
+            depths[i] = depth
+    return max_depth
+
+
+def _fail(code: "xdis.Code38", problem: str) -> typing.NoReturn:
+    raise ValueError("Code object %s (%s:%d) %s" % (
+        code.co_name, code.co_filename, code.co_firstlineno, problem
+    ))
@@ -0,0 +1,271 @@
+"""
+A long-lived worker running `python -m pydowngrade` invocations, so build
+systems that convert one file per action don't pay for starting the
+interpreter and importing pydowngrade every time:
+
+    python -m pydowngrade.worker --socket /tmp/pydowngrade.sock
+    python -m pydowngrade.client --socket /tmp/pydowngrade.sock in.pyc out.pyc
+
+Requests can also come in over the Bazel persistent worker JSON protocol on
+stdin and stdout, which is what `python -m pydowngrade --persistent_worker`
+speaks.
+
+Every request is a JSON object whose `arguments` are the command line
+arguments of `python -m pydowngrade`, flagfiles included. The response has
+the `exitCode` and the `output` it printed. Requests run concurrently on a
+pool of processes that are started once and keep everything loaded.
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import io
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import traceback
+import typing
+
+# Bazel passes it when it starts the worker.
+PERSISTENT_WORKER_FLAG = "--persistent_worker"
+
+
+class DowngradeWorker:
+    """
+    Runs requests on `jobs` processes (default: CPU count), each working
+    through one request at a time.
+    """
+
+    def __init__(self, jobs: typing.Optional[int] = None) -> None:
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs, initializer=_warm_up
+        )
+        # Starts the processes now rather than on the first request.
+        self._executor.submit(int).result()
+
+    def submit(self, request: dict) -> "concurrent.futures.Future[dict]":
+        """Starts running `request`, the future is for its response."""
+        arguments = request.get("arguments")
+        if not isinstance(arguments, list) or not all(
+            isinstance(argument, str) for argument in arguments
+        ):
+            response: concurrent.futures.Future = concurrent.futures.Future()
+            response.set_result(
+                _response(request, 2, "The request's arguments aren't a list of strings\n")
+            )
+            return response
+
+        # Relative paths are relative to where the request was made from.
+        directory = request.get("cwd") or request.get("sandboxDir") or None
+        future = self._executor.submit(_run_arguments, arguments, directory)
+        response = concurrent.futures.Future()
+
+        def respond(future: concurrent.futures.Future) -> None:
+            try:
+                exit_code, output = future.result()
+            except Exception:
+                exit_code, output = 1, traceback.format_exc()
+            response.set_result(_response(request, exit_code, output))
+
+        future.add_done_callback(respond)
+        return response
+
+    def handle(self, request: dict) -> dict:
+        """Runs `request` and returns its response."""
+        return self.submit(request).result()
+
+    def close(self) -> None:
+        self._executor.shutdown()
+
+    def __enter__(self) -> "DowngradeWorker":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def serve_persistent_worker(
+    worker: DowngradeWorker, requests: typing.TextIO, responses: typing.TextIO
+) -> None:
+    """
+    Answers Bazel's JSON work requests read from `requests` until it's
+    closed, writing a response for each to `responses` as soon as it's done.
+    Multiplexed requests, with a `requestId`, run concurrently.
+    """
+    lock = threading.Lock()
+    pending = []
+
+    def write(response: concurrent.futures.Future) -> None:
+        with lock:
+            responses.write(json.dumps(response.result()) + "\n")
+            responses.flush()
+
+    for request in _read_json_objects(requests):
+        if request.get("cancel"):
+            # Requests can't be interrupted, Bazel is fine with them
+            # finishing anyway.
+            continue
+        response = worker.submit(request)
+        response.add_done_callback(write)
+        pending.append(response)
+    concurrent.futures.wait(pending)
+
+
+class UnixSocketServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves `worker` on the Unix socket at `path`, one request and response
+    per line. A socket left behind by a worker that's gone is replaced, a
+    live one is a `RuntimeError`.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path: str, worker: DowngradeWorker) -> None:
+        if os.path.exists(path):
+            if _is_listening(path):
+                raise RuntimeError("A worker is already listening on %s" % path)
+            os.unlink(path)
+        self.worker = worker
+        super().__init__(path, _RequestHandler)
+
+    def server_close(self) -> None:
+        super().server_close()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.server_address)
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                request = {}
+            if not isinstance(request, dict):
+                request = {}
+            response = self.server.worker.handle(request)
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="pydowngrade.worker",
+        description="Keeps pydowngrade loaded to run conversions on request.",
+    )
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument(
+        "--socket", default=None, help="path of the Unix socket to listen on"
+    )
+    mode.add_argument(
+        PERSISTENT_WORKER_FLAG,
+        dest="persistent_worker",
+        action="store_true",
+        help="speak the Bazel persistent worker JSON protocol on stdin and stdout",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="number of requests to run at once (default: CPU count)",
+    )
+    args = parser.parse_args(argv)
+
+    # Shuts down the same way as on Ctrl+C, removing the socket.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    with DowngradeWorker(args.jobs) as worker:
+        if args.persistent_worker:
+            serve_persistent_worker(worker, sys.stdin, sys.stdout)
+            return 0
+        try:
+            server = UnixSocketServer(args.socket, worker)
+        except RuntimeError as e:
+            print(e, file=sys.stderr)
+            return 1
+        with server:
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+    return 0
+
+
+def _warm_up() -> None:
+    # Runs in each worker process as it starts. The main process decides
+    # when to stop, and then shuts the pool down.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    from .__main__ import main  # noqa: F401
+    from .downgrade_transformer import pass_manager_for
+
+    pass_manager_for((3, 9))
+    pass_manager_for((3, 10))
+
+
+def _run_arguments(
+    arguments: typing.List[str], directory: typing.Optional[str]
+) -> typing.Tuple[int, str]:
+    # Runs in a worker process, which only ever runs one request at a time so
+    # it has the working directory and the standard streams to itself.
+    from .__main__ import main
+
+    output = io.StringIO()
+    previous_directory = os.getcwd()
+    try:
+        if directory is not None:
+            os.chdir(directory)
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            try:
+                exit_code = main(arguments)
+            except SystemExit as e:
+                # From argparse, with the usage already printed.
+                exit_code = e.code if isinstance(e.code, int) else 1
+            except Exception:
+                traceback.print_exc()
+                exit_code = 1
+    finally:
+        os.chdir(previous_directory)
+    return exit_code, output.getvalue()
+
+
+def _response(request: dict, exit_code: int, output: str) -> dict:
+    response = {"exitCode": exit_code, "output": output}
+    if request.get("requestId"):
+        response["requestId"] = request["requestId"]
+    return response
+
+
+def _read_json_objects(stream: typing.TextIO) -> typing.Iterator[dict]:
+    """Yields the JSON objects in `stream`, which may each span several
+    lines."""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    for line in stream:
+        buffer += line
+        while True:
+            buffer = buffer.lstrip()
+            if not buffer:
+                break
+            try:
+                obj, end = decoder.raw_decode(buffer)
+            except ValueError:
+                # Not complete yet.
+                break
+            buffer = buffer[end:]
+            yield obj if isinstance(obj, dict) else {}
+
+
+def _is_listening(path: str) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(path)
+        except OSError:
+            return False
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,78 @@
+import mmap
+import py_compile
+import pytest
+import pydowngrade
+from pydowngrade import batch, pyc_io
+from utils import TEST_FILES_FOLDER
+
+PY39_HELLO_WORLD = TEST_FILES_FOLDER / 'hello_world.cpython-39.pyc'
+
+
+def test_downgrade_pyc_bytes_matches_convert_file(tmp_path):
+    output_path = tmp_path / 'hello_world.pyc'
+    # No source next to it, so the header is carried over as is.
+    batch.convert_file(PY39_HELLO_WORLD, output_path)
+    expected = output_path.read_bytes()
+    data = PY39_HELLO_WORLD.read_bytes()
+
+    assert pydowngrade.downgrade_pyc_bytes(data) == expected
+    assert pydowngrade.downgrade_pyc_bytes(memoryview(data)) == expected
+    assert pydowngrade.downgrade_pyc_bytes(bytearray(data)) == expected
+    with open(PY39_HELLO_WORLD, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            assert pydowngrade.downgrade_pyc_bytes(mapped) == expected
+
+
+def test_downgrade_pyc_bytes_builds_hash_based_header():
+    source = b'print("Hello World")'
+
+    output = pydowngrade.downgrade_pyc_bytes(
+        PY39_HELLO_WORLD.read_bytes(),
+        invalidation_mode=py_compile.PycInvalidationMode.CHECKED_HASH,
+        source=source,
+    )
+
+    assert output[:4] == pyc_io.PY38_MAGIC
+    assert output[8:16] == pyc_io.py38_source_hash(source)
+
+
+def test_downgrade_pyc_bytes_rejects_invalid_input():
+    with pytest.raises(ValueError):
+        pydowngrade.downgrade_pyc_bytes(b'not a pyc file')
+
+
+def test_downgrade_pyc_bytes_into_writes_into_buffer():
+    data = PY39_HELLO_WORLD.read_bytes()
+    expected = pydowngrade.downgrade_pyc_bytes(data)
+    buffer = bytearray(len(expected) + 10)
+
+    size = pydowngrade.downgrade_pyc_bytes_into(data, buffer)
+
+    assert size == len(expected)
+    assert buffer[:size] == expected
+    assert buffer[size:] == bytes(10)
+
+
+def test_downgrade_pyc_bytes_into_rejects_unusable_buffers():
+    data = PY39_HELLO_WORLD.read_bytes()
+    size = len(pydowngrade.downgrade_pyc_bytes(data))
+    buffer = bytearray(size - 1)
+
+    with pytest.raises(ValueError, match='only holds %d' % (size - 1)):
+        pydowngrade.downgrade_pyc_bytes_into(data, buffer)
+    assert buffer == bytes(size - 1)
+    with pytest.raises(TypeError):
+        pydowngrade.downgrade_pyc_bytes_into(data, bytes(size))
+
+
+def test_downgrade_many():
+    hello_world = PY39_HELLO_WORLD.read_bytes()
+    transforms = (TEST_FILES_FOLDER / 'transforms.cpython-39.pyc').read_bytes()
+
+    outputs = list(pydowngrade.downgrade_many([hello_world, transforms, hello_world]))
+
+    assert outputs == [
+        pydowngrade.downgrade_pyc_bytes(hello_world),
+        pydowngrade.downgrade_pyc_bytes(transforms),
+        pydowngrade.downgrade_pyc_bytes(hello_world),
+    ]
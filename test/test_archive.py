@@ -0,0 +1,90 @@
+import base64
+import hashlib
+import os
+import subprocess
+import zipapp
+import zipfile
+from pydowngrade.archive import convert_archive
+from utils import (
+    TEST_FILES_FOLDER, PY_38_COMMAND, can_execute_python_3_8, load_python_pyc_file,
+)
+
+
+def record_hash(data):
+    digest = hashlib.sha256(data).digest()
+    return 'sha256=' + base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+
+def make_wheel(path):
+    py39_hello_world = (TEST_FILES_FOLDER / 'hello_world.cpython-39.pyc').read_bytes()
+    init_py = b'from .hello_world import test\n' * 100
+    record = (
+        'pkg/__init__.py,%s,%d\n' % (record_hash(init_py), len(init_py))
+        + 'pkg/__pycache__/hello_world.cpython-39.pyc,%s,%d\n'
+        % (record_hash(py39_hello_world), len(py39_hello_world))
+        + 'pkg/broken.pyc,,\n'
+        + 'pkg-1.0.dist-info/RECORD,,\n'
+    )
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as wheel:
+        wheel.writestr('pkg/__init__.py', init_py)
+        wheel.writestr('pkg/__pycache__/hello_world.cpython-39.pyc', py39_hello_world)
+        wheel.writestr('pkg/broken.pyc', b'not a pyc file')
+        wheel.writestr('pkg-1.0.dist-info/RECORD', record)
+
+
+def test_convert_archive(tmp_path):
+    make_wheel(tmp_path / 'input.whl')
+
+    result = convert_archive(tmp_path / 'input.whl', tmp_path / 'output.whl')
+
+    assert len(result.converted) == 1
+    assert [str(failure.input_path) for failure in result.failures] == ['pkg/broken.pyc']
+
+    with zipfile.ZipFile(tmp_path / 'input.whl') as wheel:
+        init_info = wheel.getinfo('pkg/__init__.py')
+    with zipfile.ZipFile(tmp_path / 'output.whl') as wheel:
+        assert wheel.testzip() is None
+        assert wheel.namelist() == [
+            'pkg/__init__.py',
+            'pkg/__pycache__/hello_world.cpython-38.pyc',
+            'pkg/broken.pyc',
+            'pkg-1.0.dist-info/RECORD',
+        ]
+        # Copied over without being recompressed.
+        assert wheel.getinfo('pkg/__init__.py').compress_size == init_info.compress_size
+        assert wheel.read('pkg/broken.pyc') == b'not a pyc file'
+
+        py38_hello_world = wheel.read('pkg/__pycache__/hello_world.cpython-38.pyc')
+        record = wheel.read('pkg-1.0.dist-info/RECORD').decode().splitlines()
+
+    assert record[1] == 'pkg/__pycache__/hello_world.cpython-38.pyc,%s,%d' % (
+        record_hash(py38_hello_world), len(py38_hello_world)
+    )
+    assert record[2:] == ['pkg/broken.pyc,,', 'pkg-1.0.dist-info/RECORD,,']
+
+    (tmp_path / 'hello_world.pyc').write_bytes(py38_hello_world)
+    assert load_python_pyc_file(tmp_path / 'hello_world.pyc').co_names == ('test',)
+
+
+@can_execute_python_3_8
+def test_convert_zipapp_keeps_shebang_and_mode(tmp_path):
+    app = tmp_path / 'app'
+    app.mkdir()
+    (app / '__main__.py').write_text('import hello_world\nhello_world.test()\n')
+    (app / 'hello_world.pyc').write_bytes(
+        (TEST_FILES_FOLDER / 'hello_world.cpython-39.pyc').read_bytes()
+    )
+    zipapp.create_archive(app, tmp_path / 'input.pyz', '/usr/bin/env python3')
+
+    result = convert_archive(tmp_path / 'input.pyz', tmp_path / 'output.pyz')
+
+    assert len(result.converted) == 1
+    output = tmp_path / 'output.pyz'
+    assert output.read_bytes().startswith(b'#!/usr/bin/env python3\n')
+    assert os.stat(str(output)).st_mode & 0o777 == \
+        os.stat(str(tmp_path / 'input.pyz')).st_mode & 0o777
+    with zipfile.ZipFile(output) as archive:
+        assert archive.testzip() is None
+    assert subprocess.check_output(
+        PY_38_COMMAND + [str(output)], universal_newlines=True
+    ) == 'Hello World\n'
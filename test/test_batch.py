@@ -0,0 +1,89 @@
+import os
+import pathlib
+import stat
+from pydowngrade import batch
+from pydowngrade.__main__ import main
+from utils import TEST_FILES_FOLDER, load_python_pyc_file
+
+
+def make_input_tree(root: pathlib.Path):
+    py39_hello_world = (TEST_FILES_FOLDER / 'hello_world.cpython-39.pyc').read_bytes()
+    py38_hello_world = (TEST_FILES_FOLDER / 'hello_world.cpython-38.pyc').read_bytes()
+
+    pycache = root / 'package' / '__pycache__'
+    pycache.mkdir(parents=True)
+    (pycache / 'hello_world.cpython-39.pyc').write_bytes(py39_hello_world)
+    (pycache / 'hello_world.cpython-39.opt-1.pyc').write_bytes(py39_hello_world)
+    # Not for 3.9, should be ignored.
+    (pycache / 'hello_world.cpython-38.pyc').write_bytes(py38_hello_world)
+    (root / 'package' / 'hello_world.py').write_text('print("Hello World")')
+    # Sourceless pycs are converted in place.
+    (root / 'sourceless.pyc').write_bytes(py39_hello_world)
+    (root / 'broken.pyc').write_bytes(b'not a pyc file')
+
+
+def test_output_path_for_maps_cache_tags(tmp_path):
+    input_root = tmp_path / 'in'
+    output_root = tmp_path / 'out'
+
+    assert batch.output_path_for(
+        input_root, output_root,
+        input_root / 'a' / '__pycache__' / 'b.cpython-39.opt-2.pyc',
+    ) == output_root / 'a' / '__pycache__' / 'b.cpython-38.opt-2.pyc'
+    assert batch.output_path_for(
+        input_root, output_root, input_root / 'a' / 'b.pyc'
+    ) == output_root / 'a' / 'b.pyc'
+
+
+def test_find_pyc_files_skips_other_cache_tags(tmp_path):
+    make_input_tree(tmp_path)
+
+    found = [path.relative_to(tmp_path) for path in batch.find_pyc_files(tmp_path)]
+    assert found == [
+        pathlib.Path('broken.pyc'),
+        pathlib.Path('sourceless.pyc'),
+        pathlib.Path('package/__pycache__/hello_world.cpython-39.opt-1.pyc'),
+        pathlib.Path('package/__pycache__/hello_world.cpython-39.pyc'),
+    ]
+
+
+def test_convert_tree_collects_failures(tmp_path):
+    make_input_tree(tmp_path / 'in')
+
+    result = batch.convert_tree(tmp_path / 'in', tmp_path / 'out', jobs=2)
+
+    assert len(result.converted) == 3
+    assert [failure.input_path.name for failure in result.failures] == ['broken.pyc']
+    assert 'Failed to convert 1 files' in result.summary()
+
+    output = tmp_path / 'out' / 'package' / '__pycache__' / 'hello_world.cpython-38.pyc'
+    assert load_python_pyc_file(output).co_names == ('test',)
+    assert (tmp_path / 'out' / 'sourceless.pyc').exists()
+    assert not (tmp_path / 'out' / 'broken.pyc').exists()
+
+
+def test_main_converts_directories(tmp_path, capsys):
+    make_input_tree(tmp_path / 'in')
+
+    exit_code = main([str(tmp_path / 'in'), str(tmp_path / 'out'), '--jobs', '1'])
+
+    assert exit_code == 1
+    assert 'Converted 3 files' in capsys.readouterr().out
+
+
+def test_outputs_get_the_usual_file_mode(tmp_path):
+    make_input_tree(tmp_path / 'in')
+    # Whatever the umask is when the outputs are written, not when pydowngrade
+    # was imported.
+    umask = os.umask(0o027)
+    try:
+        main([str(tmp_path / 'in'), str(tmp_path / 'out'), '--jobs', '1'])
+        main([str(tmp_path / 'in' / 'sourceless.pyc'), str(tmp_path / 'single.pyc')])
+    finally:
+        os.umask(umask)
+
+    # Not just readable by the owner like the temporary files they're
+    # written to.
+    for output in ('out/sourceless.pyc', 'single.pyc'):
+        mode = stat.S_IMODE((tmp_path / output).stat().st_mode)
+        assert mode == 0o640
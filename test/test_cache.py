@@ -0,0 +1,52 @@
+import hashlib
+import os
+from pydowngrade import batch
+from pydowngrade.cache import DowngradeCache
+from utils import TEST_FILES_FOLDER, load_python_pyc_file
+
+
+def test_cache_roundtrips_entries(tmp_path):
+    cache = DowngradeCache(tmp_path)
+    key = cache.key_for(b'input pyc')
+
+    assert cache.get(key) is None
+    cache.put(key, b'downgraded')
+    assert cache.get(key) == b'downgraded'
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_cache_key_depends_on_input(tmp_path):
+    cache = DowngradeCache(tmp_path)
+    assert cache.key_for(b'a') != cache.key_for(b'b')
+    assert cache.key_for(b'a') == DowngradeCache(tmp_path / 'other').key_for(b'a')
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = DowngradeCache(tmp_path, max_size=25)
+    cache.put('aa1', b'x' * 10)
+    cache.put('bb2', b'x' * 10)
+    # Make the first entry the most recently used one.
+    os.utime(cache._path_for('bb2'), (0, 0))
+    cache.get('aa1')
+
+    cache.put('cc3', b'x' * 10)
+
+    assert cache.get('aa1') is not None
+    assert cache.get('bb2') is None
+    assert cache.get('cc3') is not None
+
+
+def test_convert_file_uses_cache(tmp_path):
+    cache = DowngradeCache(tmp_path / 'cache')
+    py39_hello_world = TEST_FILES_FOLDER / 'hello_world.cpython-39.pyc'
+
+    first = batch.convert_file(py39_hello_world, tmp_path / 'first.pyc', 0, cache)
+    second = batch.convert_file(py39_hello_world, tmp_path / 'second.pyc', 0, cache)
+
+    assert first.error is None and second.error is None
+    assert (first.cache_hit, second.cache_hit) == (False, True)
+    assert (tmp_path / 'first.pyc').read_bytes() == (tmp_path / 'second.pyc').read_bytes()
+    assert first.output_sha256 == second.output_sha256 == hashlib.sha256(
+        (tmp_path / 'second.pyc').read_bytes()
+    ).hexdigest()
+    assert load_python_pyc_file(tmp_path / 'second.pyc').co_names == ('test',)
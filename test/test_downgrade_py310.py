@@ -0,0 +1,144 @@
+import subprocess
+import pytest
+from xdis.opcodes import opcode_38, opcode_310
+from pydowngrade import batch, pyc_io
+from pydowngrade.downgrade_transformer import downgrade_code_to_py38
+from pydowngrade.instructions import attach_linetable_lines, decode_instructions
+from pydowngrade.stats import DowngradeStats
+from pydowngrade.verify import verify_py38_code
+from utils import (
+    TEST_FILES_FOLDER, PY_38_COMMAND, can_execute_python_3_8, get_function_from_module,
+)
+
+def load_py310_file(name: str) -> pyc_io.CompiledFile:
+    return pyc_io.CompiledFile(TEST_FILES_FOLDER / ('%s.cpython-310.pyc' % name))
+
+
+def test_reads_python_3_10_header():
+    assert load_py310_file('py310_features').header.version == (3, 10)
+    py39_file = pyc_io.CompiledFile(TEST_FILES_FOLDER / 'hello_world.cpython-39.pyc')
+    assert py39_file.header.version == (3, 9)
+
+
+def test_decode_counts_jumps_in_instructions():
+    instructions = decode_instructions(bytes([
+        # JUMP_FORWARD   1 (to 4)
+        110, 1,
+        # NOP, LOAD_CONST 0, RETURN_VALUE
+        9, 0, 100, 0, 83, 0,
+    ]), opcode_310.JABS_OPS, opcode_310.JREL_OPS, jump_unit=2)
+
+    assert instructions[0].target is instructions[2]
+
+
+def test_attach_linetable_lines_matches_python_3_10():
+    # Line starts from Python 3.10's `dis.findlinestarts`.
+    expected = {
+        'generator': [(2, 8), (8, 9)],
+        'fails': [(0, 50), (4, 51)],
+        'finally_block': [(0, 42), (4, 43), (6, 44), (18, 46), (28, 47), (32, 46)],
+    }
+    module = load_py310_file('py310_features').code
+
+    for name, line_starts in expected.items():
+        code = get_function_from_module(module, name)
+        instructions = decode_instructions(
+            code.co_code, opcode_310.JABS_OPS, opcode_310.JREL_OPS, jump_unit=2
+        )
+        attach_linetable_lines(instructions, code.co_lnotab, code.co_firstlineno)
+        assert [
+            (instruction.offset, instruction.line)
+            for instruction in instructions
+            if instruction.line is not None
+        ] == line_starts, name
+
+
+def test_downgrade_lowers_python_3_10_opcodes():
+    stats = DowngradeStats()
+    module = downgrade_code_to_py38(load_py310_file('py310_features').code, (3, 10), stats)
+
+    verify_py38_code(module)
+    assert stats.rewritten_opcodes['GEN_START'] == 1
+    assert stats.rewritten_opcodes['MAKE_FUNCTION'] > 0
+    generator = get_function_from_module(module, 'generator')
+    # GEN_START is dropped, 3.8 generators start with nothing on the stack.
+    assert generator.co_code[0] == opcode_38.LOAD_CONST
+    # And the line tables are 3.8's.
+    assert generator.co_lnotab == bytes([0, 1, 6, 1])
+    finally_block = get_function_from_module(module, 'finally_block')
+    assert finally_block.co_code[-6:] == bytes([
+        # END_FINALLY, then a return that never runs
+        opcode_38.END_FINALLY, 0, opcode_38.LOAD_CONST, 0, opcode_38.RETURN_VALUE, 0,
+    ])
+
+
+def test_downgrade_future_annotations():
+    module = downgrade_code_to_py38(
+        load_py310_file('py310_future_annotations').code, (3, 10)
+    )
+
+    verify_py38_code(module)
+
+
+def test_downgrade_rejects_pattern_matching():
+    # py310_match.cpython-310.pyc is compiled from the following, which isn't
+    # kept as a .py file since Python 3.8 can't even parse it:
+    #
+    #     def classify(value):
+    #         match value:
+    #             case [x, y]:
+    #                 return x + y
+    #             case _:
+    #                 return 0
+    with pytest.raises(ValueError, match="MATCH_SEQUENCE in classify isn't supported"):
+        downgrade_code_to_py38(load_py310_file('py310_match').code, (3, 10))
+
+
+def test_downgrade_rejects_unknown_versions():
+    with pytest.raises(ValueError, match="Python 3.7 code isn't supported"):
+        downgrade_code_to_py38(load_py310_file('py310_features').code, (3, 7))
+
+
+def test_output_path_for_maps_python_3_10_cache_tag(tmp_path):
+    pycache = tmp_path / 'in' / '__pycache__'
+
+    assert batch.is_py39_pyc_path(pycache / 'b.cpython-310.pyc')
+    assert batch.output_path_for(
+        tmp_path / 'in', tmp_path / 'out', pycache / 'b.cpython-310.opt-1.pyc'
+    ) == tmp_path / 'out' / '__pycache__' / 'b.cpython-38.opt-1.pyc'
+
+
+@can_execute_python_3_8
+def test_downgraded_python_3_10_code_runs(tmp_path):
+    for name in ('py310_features', 'py310_future_annotations'):
+        result = batch.convert_file(
+            TEST_FILES_FOLDER / ('%s.cpython-310.pyc' % name),
+            tmp_path / ('%s.pyc' % name),
+            verify=True,
+        )
+        assert result.error is None
+
+    process = subprocess.run(
+        PY_38_COMMAND + ['-c', '\n'.join([
+            'import py310_features as f, py310_future_annotations as fa',
+            'print(f.annotations())',
+            'print(f.send_to_generator(), f.use_counter())',
+            'print(f.loop(7), f.chained(1, 2, 3), f.chained(3, 2, 1))',
+            'print(f.finally_block())',
+            'print(fa.annotations())',
+            'f.fails()',
+        ])],
+        cwd=str(tmp_path), encoding='utf-8',
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    )
+
+    assert process.stdout.splitlines() == [
+        "{'x': <class 'int'>, 'y': 'str', 'return': <class 'list'>}",
+        "(1, 42) (3, {'step': <class 'int'>, 'return': <class 'int'>})",
+        '6 True False',
+        '[1, 2]',
+        "{'x': 'int', 'y': 'str', 'return': 'list'}",
+    ]
+    # Tracebacks point at the right lines.
+    assert 'line 51, in fails' in process.stderr
+    assert process.stderr.endswith('ValueError: 1\n')
@@ -1,8 +1,10 @@
 import xdis
 from xdis.std import make_std_api
 from pydowngrade import pyc_io
-from pydowngrade.downgrade_transformer import downgrade_py39_code_to_py38
-from utils import TEST_FILES_FOLDER, load_python_pyc_file
+from pydowngrade.downgrade_transformer import IndexedTable, downgrade_py39_code_to_py38
+from utils import (
+    TEST_FILES_FOLDER, get_function_from_module, load_python_pyc_file, make_function_code,
+)
 
 
 dis_module_3_8 = make_std_api(python_version=(3, 8, 1))
@@ -19,11 +21,28 @@ def test_transformer_produces_new_code_object():
     assert transformed.co_code == code.co_code
 
 
-def get_function_from_module(module: xdis.Code38, function: str) -> xdis.Code38:
-    for const in module.co_consts:
-        if isinstance(const, xdis.Code38) and const.co_name == function:
-            return const
-    assert False, "function " + function + " not found in module"
+def test_transformer_passes_through_unchanged_code():
+    py_39_hello_world = TEST_FILES_FOLDER / 'hello_world.cpython-39.pyc'
+    code = pyc_io.Py39CompiledFile(py_39_hello_world).code
+
+    assert downgrade_py39_code_to_py38(code) is code
+
+
+def test_transformer_only_copies_changed_code():
+    py_39_file = TEST_FILES_FOLDER / 'transforms.cpython-39.pyc'
+    py_39_code = pyc_io.Py39CompiledFile(py_39_file).code
+    original_co_code = get_function_from_module(py_39_code, 'is_op').co_code
+
+    py_38_code = downgrade_py39_code_to_py38(py_39_code)
+
+    assert py_38_code is not py_39_code
+    # Functions without 3.9 specific opcodes are shared with the input.
+    assert get_function_from_module(py_38_code, 'comparison_op') is \
+        get_function_from_module(py_39_code, 'comparison_op')
+    assert get_function_from_module(py_38_code, 'is_op') is not \
+        get_function_from_module(py_39_code, 'is_op')
+    # And the input is left untouched.
+    assert get_function_from_module(py_39_code, 'is_op').co_code == original_co_code
 
 
 def test_transform_load_assertion_opcode():
@@ -157,3 +176,177 @@ def test_transform_contains_opcode_against_known_good():
 
     assert get_function_from_module(actual_py_38_code, 'in_op').co_code == expected_is_op_function.co_code
     assert get_function_from_module(actual_py_38_code, 'not_in_op').co_code == expected_not_is_op_function.co_code
+
+
+def test_transform_reraise_jump_targets_end_finally():
+    # A handler that returns, with the non-matching exception case jumping to
+    # the RERAISE. Everything jumping to the RERAISE should jump to the
+    # END_FINALLY that replaces it.
+    code = make_function_code(bytes([
+        # POP_JUMP_IF_FALSE  8
+        114, 8,
+        # POP_EXCEPT
+        89, 0,
+        # LOAD_CONST     0 (None)
+        100, 0,
+        # RETURN_VALUE
+        83, 0,
+        # RERAISE
+        48, 0,
+    ]))
+
+    transformed = downgrade_py39_code_to_py38(code)
+    assert transformed.co_code == bytes([
+        # POP_JUMP_IF_FALSE  6
+        114, 6,
+        # POP_EXCEPT
+        89, 0,
+        # JUMP_FORWARD   2 (to 8)
+        110, 2,
+        # END_FINALLY
+        88, 0,
+        # LOAD_CONST     0 (None)
+        100, 0,
+        # RETURN_VALUE
+        83, 0,
+    ])
+
+
+def test_transform_reraise_after_handler_in_finally():
+    # `try: ... except: pass` inside a finally block, the handler's jump
+    # lands on the RERAISE ending the finally block, so it stays in place.
+    co_code = [
+        # SETUP_FINALLY  4 (to 6)
+        122, 4,
+        # POP_BLOCK
+        87, 0,
+        # JUMP_FORWARD   10 (to 16)
+        110, 10,
+        # POP_TOP
+        1, 0, 1, 0, 1, 0,
+        # POP_EXCEPT
+        89, 0,
+        # JUMP_FORWARD   0 (to 16)
+        110, 0,
+        # RERAISE
+        48, 0,
+    ]
+    code = make_function_code(bytes(co_code))
+
+    transformed = downgrade_py39_code_to_py38(code)
+    assert transformed.co_code == bytes(co_code[:-2] + [88, 0])
+
+
+def test_transform_many_bare_excepts():
+    # `try: ... except: pass` repeated enough times for the jumps to need
+    # EXTENDED_ARGs.
+    handler = [
+        # SETUP_FINALLY  4 (to +6)
+        122, 4,
+        # POP_BLOCK
+        87, 0,
+        # JUMP_FORWARD   12 (to +18)
+        110, 12,
+        # POP_TOP
+        1, 0, 1, 0, 1, 0,
+        # POP_EXCEPT
+        89, 0,
+        # JUMP_FORWARD   2 (to +18)
+        110, 2,
+        # RERAISE
+        48, 0,
+    ]
+    code = make_function_code(bytes(
+        # EXTENDED_ARG 7, JUMP_ABSOLUTE 1804 (the LOAD_CONST at the end)
+        [144, 7, 113, 12]
+        + handler * 100
+        # LOAD_CONST 0 (None), RETURN_VALUE
+        + [100, 0, 83, 0]
+    ))
+
+    transformed = downgrade_py39_code_to_py38(code)
+    expected_handler = bytes(handler[:-2] + [88, 0])
+    assert transformed.co_code == (
+        bytes([144, 7, 113, 12]) + expected_handler * 100 + bytes([100, 0, 83, 0])
+    )
+
+
+def test_transform_adds_names_once():
+    code = make_function_code(bytes([
+        # LOAD_ASSERTION_ERROR, POP_TOP, twice
+        74, 0, 1, 0, 74, 0, 1, 0,
+        # LOAD_CONST     0 (None)
+        100, 0,
+        # RETURN_VALUE
+        83, 0,
+    ]))
+
+    transformed = downgrade_py39_code_to_py38(code)
+    assert transformed.co_names == ('AssertionError',)
+    assert transformed.co_code[:8] == bytes([116, 0, 1, 0, 116, 0, 1, 0])
+
+
+def test_indexed_table_keeps_equal_constants_of_different_types_apart():
+    table = IndexedTable((None, 1, 1, (1,), 0.0))
+
+    assert table.get_or_add(1) == 1
+    assert table.get_or_add(True) == 5
+    assert table.get_or_add(1.0) == 6
+    assert table.get_or_add((True,)) == 7
+    assert table.get_or_add((1,)) == 3
+    assert table.get_or_add(-0.0) == 8
+    assert table.get_or_add(True) == 5
+    assert table.to_tuple() == (None, 1, 1, (1,), 0.0, True, 1.0, (True,), -0.0)
+
+
+def test_transform_constant_list_extend():
+    # `return [1, 2, 3]`
+    code = make_function_code(bytes([
+        # BUILD_LIST     0
+        103, 0,
+        # LOAD_CONST     1 ((1, 2, 3))
+        100, 1,
+        # LIST_EXTEND    1
+        162, 1,
+        # RETURN_VALUE
+        83, 0,
+    ]), (None, (1, 2, 3)))
+
+    transformed = downgrade_py39_code_to_py38(code)
+    assert transformed.co_code == bytes([
+        # LOAD_CONST     1 ((1, 2, 3))
+        100, 1,
+        # BUILD_LIST_UNPACK  1
+        149, 1,
+        # RETURN_VALUE
+        83, 0,
+    ])
+    assert transformed.co_names == ()
+    assert transformed.co_consts == (None, (1, 2, 3))
+
+
+def test_transform_star_unpacking_list_extend():
+    # `return (0, *a)`
+    code = make_function_code(bytes([
+        # LOAD_CONST     1 (0)
+        100, 1,
+        # BUILD_LIST     1
+        103, 1,
+        # LOAD_FAST      0 (a)
+        124, 0,
+        # LIST_EXTEND    1
+        162, 1,
+        # LIST_TO_TUPLE
+        82, 0,
+        # RETURN_VALUE
+        83, 0,
+    ]), (None, 0))
+
+    transformed = downgrade_py39_code_to_py38(code)
+    assert transformed.co_code == bytes([
+        100, 1, 103, 1, 124, 0,
+        # BUILD_TUPLE_UNPACK  2
+        152, 2,
+        # RETURN_VALUE
+        83, 0,
+    ])
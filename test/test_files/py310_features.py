@@ -0,0 +1,51 @@
+def annotated(x: int, y: 'str' = 'a') -> list:
+    return [x, y]
+
+def annotations():
+    return annotated.__annotations__
+
+def generator():
+    total = yield 1
+    yield total * 2
+
+def send_to_generator():
+    g = generator()
+    first = next(g)
+    return first, g.send(21)
+
+def make_counter():
+    count = 0
+    def counter(step: int = 1) -> int:
+        nonlocal count
+        count += step
+        return count
+    return counter
+
+def use_counter():
+    counter = make_counter()
+    counter()
+    return counter(2), counter.__annotations__
+
+def loop(n):
+    total = 0
+    for i in range(n):
+        if i % 2:
+            continue
+        while total < i:
+            total += 1
+    return total
+
+def chained(a, b, c):
+    return a < b < c
+
+def finally_block():
+    result = []
+    try:
+        result.append(1)
+    finally:
+        result.append(2)
+    return result
+
+def fails():
+    value = 1
+    raise ValueError(value)
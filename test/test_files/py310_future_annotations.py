@@ -0,0 +1,9 @@
+from __future__ import annotations
+
+
+def annotated(x: int, y: str) -> list:
+    return [x, y]
+
+
+def annotations():
+    return annotated.__annotations__
@@ -0,0 +1,109 @@
+import importlib
+import os
+import sys
+import pytest
+from pydowngrade import import_hook
+from utils import TEST_FILES_FOLDER
+
+pytestmark = pytest.mark.skipif(
+    sys.version_info[:2] != (3, 8), reason="Needs to run on Python 3.8"
+)
+
+
+@pytest.fixture
+def import_path(tmp_path):
+    py39_hello_world = (TEST_FILES_FOLDER / 'hello_world.cpython-39.pyc').read_bytes()
+    # A sourceless module and a package only shipped as __pycache__ entries.
+    (tmp_path / 'hook_module.pyc').write_bytes(py39_hello_world)
+    pycache = tmp_path / 'hook_package' / '__pycache__'
+    pycache.mkdir(parents=True)
+    (pycache / '__init__.cpython-39.pyc').write_bytes(py39_hello_world)
+    (pycache / 'submodule.cpython-39.pyc').write_bytes(py39_hello_world)
+    # Has source, so should be left to the regular import system.
+    (tmp_path / 'hook_source.py').write_text('VALUE = "from source"\n')
+    (tmp_path / '__pycache__').mkdir()
+    (tmp_path / '__pycache__' / 'hook_source.cpython-39.pyc').write_bytes(
+        py39_hello_world
+    )
+
+    sys.path.insert(0, str(tmp_path))
+    yield tmp_path
+    sys.path.remove(str(tmp_path))
+    for name in list(sys.modules):
+        if name.startswith('hook_'):
+            del sys.modules[name]
+
+
+@pytest.fixture
+def install(import_path):
+    finders = []
+
+    def install(**kwargs):
+        finder = import_hook.install(**kwargs)
+        finders.append(finder)
+        return finder
+
+    yield install
+    for finder in finders:
+        import_hook.uninstall(finder)
+
+
+def test_imports_sourceless_modules_and_packages(import_path, install, capsys):
+    finder = install()
+
+    module = importlib.import_module('hook_module')
+    submodule = importlib.import_module('hook_package.submodule')
+    module.test()
+    submodule.test()
+
+    assert capsys.readouterr().out == 'Hello World\nHello World\n'
+    assert importlib.import_module('hook_package').__path__ == [
+        str(import_path / 'hook_package')
+    ]
+    assert importlib.import_module('hook_source').VALUE == 'from source'
+    assert finder.cache.misses == 3
+
+
+def test_caches_downgraded_code(import_path, install):
+    finder = install()
+    importlib.import_module('hook_module')
+    del sys.modules['hook_module']
+
+    importlib.import_module('hook_module')
+
+    assert (finder.cache.hits, finder.cache.misses) == (1, 1)
+
+
+def test_writes_back_py38_pyc(import_path, install):
+    install(write_back=True)
+    importlib.import_module('hook_module')
+    importlib.import_module('hook_package')
+
+    written = import_path / '__pycache__' / 'hook_module.cpython-38.pyc'
+    assert written.read_bytes()[:4] == importlib.util.MAGIC_NUMBER
+    assert (import_path / 'hook_package' / '__pycache__' / '__init__.cpython-38.pyc').exists()
+    # Readable by everyone sharing the install, not just the owner.
+    umask = os.umask(0)
+    os.umask(umask)
+    assert written.stat().st_mode & 0o777 == 0o666 & ~umask
+
+    # A fresh finder picks up the written back file without downgrading.
+    del sys.modules['hook_module']
+    finder = install(write_back=True)
+    stat = os.stat(str(import_path / 'hook_module.pyc'))
+    os.utime(str(written), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    (import_path / 'hook_module.pyc').write_bytes(
+        (import_path / 'hook_module.pyc').read_bytes()[:16]
+    )
+    os.utime(str(import_path / 'hook_module.pyc'), ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert callable(importlib.import_module('hook_module').test)
+
+
+def test_lazy_modules_load_on_first_use(import_path, install):
+    finder = install(lazy=True)
+
+    module = importlib.import_module('hook_module')
+    assert finder.cache.misses == 0
+
+    assert callable(module.test)
+    assert finder.cache.misses == 1
@@ -0,0 +1,72 @@
+import os
+from pydowngrade.__main__ import main
+from pydowngrade.incremental import ConversionIndex, INDEX_FILENAME, convert_tree_incremental
+from test_batch import make_input_tree
+
+
+def test_second_run_skips_unchanged_inputs(tmp_path):
+    make_input_tree(tmp_path / 'in')
+
+    first = convert_tree_incremental(tmp_path / 'in', tmp_path / 'out', jobs=1)
+    second = convert_tree_incremental(tmp_path / 'in', tmp_path / 'out', jobs=1)
+
+    assert (len(first.converted), len(first.failures)) == (3, 1)
+    assert (len(second.converted), len(second.failures)) == (0, 0)
+    assert second.unchanged == 4
+    assert len(ConversionIndex(tmp_path / 'out' / INDEX_FILENAME).entries) == 4
+
+
+def test_converts_changed_and_removes_deleted_inputs(tmp_path):
+    make_input_tree(tmp_path / 'in')
+    convert_tree_incremental(tmp_path / 'in', tmp_path / 'out', jobs=1)
+
+    sourceless = tmp_path / 'in' / 'sourceless.pyc'
+    # Touched but unchanged, only needs its hash checked.
+    stat = sourceless.stat()
+    os.utime(str(sourceless), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    (tmp_path / 'in' / 'package' / '__pycache__' / 'hello_world.cpython-39.opt-1.pyc').unlink()
+    (tmp_path / 'in' / 'broken.pyc').write_bytes(sourceless.read_bytes())
+
+    result = convert_tree_incremental(tmp_path / 'in', tmp_path / 'out', jobs=1)
+
+    assert [r.input_path.name for r in result.converted] == ['broken.pyc']
+    assert result.unchanged == 2
+    assert result.removed == [
+        tmp_path / 'out' / 'package' / '__pycache__' / 'hello_world.cpython-38.opt-1.pyc'
+    ]
+    assert not result.removed[0].exists()
+    assert (tmp_path / 'out' / 'broken.pyc').exists()
+
+
+def test_reconverts_everything_when_verify_is_turned_on(tmp_path):
+    make_input_tree(tmp_path / 'in')
+    convert_tree_incremental(tmp_path / 'in', tmp_path / 'out', jobs=1)
+
+    result = convert_tree_incremental(
+        tmp_path / 'in', tmp_path / 'out', jobs=1, verify=True
+    )
+
+    # Nothing was checked by the first run.
+    assert (len(result.converted), len(result.failures)) == (3, 1)
+    assert result.unchanged == 0
+
+
+def test_converts_inputs_whose_output_is_missing(tmp_path):
+    make_input_tree(tmp_path / 'in')
+    convert_tree_incremental(tmp_path / 'in', tmp_path / 'out', jobs=1)
+    (tmp_path / 'out' / 'sourceless.pyc').unlink()
+
+    result = convert_tree_incremental(tmp_path / 'in', tmp_path / 'out', jobs=1)
+
+    assert [r.input_path.name for r in result.converted] == ['sourceless.pyc']
+
+
+def test_main_incremental(tmp_path, capsys):
+    make_input_tree(tmp_path / 'in')
+    (tmp_path / 'in' / 'broken.pyc').unlink()
+    args = [str(tmp_path / 'in'), str(tmp_path / 'out'), '-j', '1', '--incremental']
+
+    assert main(args) == 0
+    assert main(args) == 0
+
+    assert 'Skipped 3 unchanged files' in capsys.readouterr().out
@@ -0,0 +1,217 @@
+import pytest
+from xdis.opcodes import opcode_38
+from pydowngrade.instructions import (
+    Instruction, assemble_instructions, attach_lines, decode_instructions,
+    encode_lnotab,
+)
+from pydowngrade.stats import DowngradeStats
+
+
+def test_decode_folds_extended_arg():
+    instructions = decode_instructions(bytes([
+        # EXTENDED_ARG   1
+        144, 1,
+        # LOAD_CONST     258
+        100, 2,
+        # RETURN_VALUE
+        83, 0,
+    ]))
+    assert len(instructions) == 2
+    assert instructions[0].opcode == opcode_38.LOAD_CONST
+    assert instructions[0].arg == 258
+    assert instructions[1].opcode == opcode_38.RETURN_VALUE
+
+
+def test_decode_resolves_jump_targets():
+    instructions = decode_instructions(bytes([
+        # JUMP_FORWARD   2 (to 4)
+        110, 2,
+        # NOP
+        9, 0,
+        # JUMP_ABSOLUTE  2
+        113, 2,
+        # RETURN_VALUE
+        83, 0,
+    ]))
+    jump_forward, nop, jump_absolute, return_value = instructions
+    assert jump_forward.target is jump_absolute
+    assert jump_absolute.target is nop
+    assert nop.target is None
+    assert return_value.target is None
+
+
+def test_decode_rejects_jump_into_an_instruction():
+    with pytest.raises(ValueError) as excinfo:
+        decode_instructions(bytes([
+            # JUMP_ABSOLUTE  4, the middle of the LOAD_CONST below
+            113, 4,
+            # EXTENDED_ARG   1
+            144, 1,
+            # LOAD_CONST     258
+            100, 2,
+        ]))
+
+    assert "not the start of an instruction" in str(excinfo.value)
+
+
+def test_decode_rejects_jump_past_the_end():
+    with pytest.raises(ValueError) as excinfo:
+        decode_instructions(bytes([
+            # JUMP_FORWARD   2 (to 4, past the end)
+            110, 2,
+        ]))
+
+    assert "not the start of an instruction" in str(excinfo.value)
+
+
+def test_assemble_roundtrips():
+    co_code = bytes([
+        # SETUP_FINALLY  4 (to 6)
+        122, 4,
+        # EXTENDED_ARG   1
+        144, 1,
+        # LOAD_CONST     258
+        100, 2,
+        # POP_JUMP_IF_FALSE 0
+        114, 0,
+        # RETURN_VALUE
+        83, 0,
+    ])
+    assert assemble_instructions(decode_instructions(co_code)) == co_code
+
+
+def test_assemble_relocates_jumps_around_inserted_instructions():
+    instructions = decode_instructions(bytes([
+        # JUMP_FORWARD   2 (to 4)
+        110, 2,
+        # NOP
+        9, 0,
+        # JUMP_ABSOLUTE  4
+        113, 4,
+    ]))
+    instructions[1:1] = [Instruction(opcode_38.NOP), Instruction(opcode_38.NOP)]
+
+    assert assemble_instructions(instructions) == bytes([
+        # JUMP_FORWARD   6 (to 8)
+        110, 6,
+        # NOP
+        9, 0,
+        # NOP
+        9, 0,
+        # NOP
+        9, 0,
+        # JUMP_ABSOLUTE  8
+        113, 8,
+    ])
+
+
+def test_assemble_widens_jumps_that_no_longer_fit():
+    target = Instruction(opcode_38.RETURN_VALUE)
+    instructions = (
+        [Instruction(opcode_38.JUMP_FORWARD, target=target)]
+        + [Instruction(opcode_38.NOP) for _ in range(200)]
+        + [Instruction(opcode_38.JUMP_ABSOLUTE, target=target)]
+        + [target]
+    )
+    co_code = assemble_instructions(instructions)
+
+    # The JUMP_FORWARD needs an EXTENDED_ARG to skip over 200 NOPs and the
+    # JUMP_ABSOLUTE, and the JUMP_ABSOLUTE gets pushed past 255 as a result.
+    assert co_code[:4] == bytes([144, 1, 110, 404 - 256])
+    assert co_code[404:408] == bytes([144, 1, 113, 408 - 256])
+    assert co_code[408:] == bytes([83, 0])
+
+
+def test_lnotab_roundtrips_through_instructions():
+    code = bytes([
+        # LOAD_CONST 0, POP_TOP, LOAD_CONST 0, RETURN_VALUE
+        100, 0, 1, 0, 100, 0, 83, 0,
+    ])
+    # Line 10 at offset 0, line 12 at offset 4, then back to line 3.
+    lnotab = bytes([4, 2, 2, 0xF7])
+    instructions = decode_instructions(code)
+
+    attach_lines(instructions, lnotab, 10)
+
+    assert [instruction.line for instruction in instructions] == [10, None, 12, 3]
+    assemble_instructions(instructions)
+    assert encode_lnotab(instructions, 10) == lnotab
+
+
+def test_encode_lnotab_splits_large_deltas():
+    instructions = [Instruction(opcode_38.NOP) for _ in range(200)]
+    instructions[-1].line = 500
+    assemble_instructions(instructions)
+
+    assert encode_lnotab(instructions, 1) == bytes([
+        255, 0, 143, 127, 0, 127, 0, 127, 0, 118,
+    ])
+
+
+def _decode_38(co_code):
+    return decode_instructions(co_code, opcode_38.JABS_OPS, opcode_38.JREL_OPS)
+
+
+def _jump_target_indices(instructions):
+    positions = {instruction: i for i, instruction in enumerate(instructions)}
+    return [
+        positions[instruction.target] if instruction.target is not None else None
+        for instruction in instructions
+    ]
+
+
+def test_assemble_widens_cascading_jumps():
+    # Each JUMP_ABSOLUTE targets an offset that only passes 255 once the jump
+    # before it has been widened, so the widening has to cascade.
+    instructions = [Instruction(opcode_38.LOAD_CONST, i) for i in range(200)]
+    instructions.append(Instruction(opcode_38.RETURN_VALUE))
+    instructions[0:4] = [
+        Instruction(opcode_38.JUMP_ABSOLUTE, target=instructions[200]),
+        Instruction(opcode_38.JUMP_ABSOLUTE, target=instructions[127]),
+        Instruction(opcode_38.JUMP_ABSOLUTE, target=instructions[126]),
+        Instruction(opcode_38.JUMP_ABSOLUTE, target=instructions[125]),
+    ]
+    expected_targets = _jump_target_indices(instructions)
+    stats = DowngradeStats()
+
+    co_code = assemble_instructions(instructions, stats=stats)
+
+    assert stats.extended_arg_widenings == 4
+    assert [instruction.offset for instruction in instructions[:5]] == [
+        0, 4, 8, 12, 16,
+    ]
+    decoded = _decode_38(co_code)
+    assert _jump_target_indices(decoded) == expected_targets
+    assert [instruction.arg for instruction in decoded[4:200]] == list(range(4, 200))
+
+
+def test_assemble_lays_out_large_functions():
+    instructions = [Instruction(opcode_38.NOP) for _ in range(20002)]
+    # Jumps go at every multiple of 7 and land on the NOPs in between.
+    for i in range(0, len(instructions), 7):
+        if i % 2:
+            # Short and long forward jumps.
+            distance = 7 * ((i * 37) % 1200) + 3
+            target = instructions[min(i + distance, len(instructions) - 1)]
+            jump = Instruction(opcode_38.JUMP_FORWARD, target=target)
+        else:
+            # Conditional jumps in both directions.
+            index = (i * 53) % len(instructions) // 7 * 7 + 3
+            target = instructions[min(index, len(instructions) - 1)]
+            jump = Instruction(opcode_38.POP_JUMP_IF_TRUE, target=target)
+        instructions[i] = jump
+    expected_targets = _jump_target_indices(instructions)
+
+    co_code = assemble_instructions(instructions)
+
+    assert _jump_target_indices(_decode_38(co_code)) == expected_targets
+
+
+def test_assemble_rejects_bad_jumps():
+    target = Instruction(opcode_38.NOP)
+    with pytest.raises(ValueError, match="goes backwards"):
+        assemble_instructions(
+            [target, Instruction(opcode_38.JUMP_FORWARD, target=target)]
+        )
+    with pytest.raises(ValueError, match="isn't being assembled"):
+        assemble_instructions([Instruction(opcode_38.JUMP_ABSOLUTE, target=target)])
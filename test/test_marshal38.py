@@ -0,0 +1,130 @@
+import io
+import marshal
+import sys
+import pytest
+import xdis
+import xdis.unmarshal
+from xdis.magics import magic2int, magics
+from pydowngrade import marshal38, pyc_io
+from utils import TEST_FILES_FOLDER, make_module_code
+
+
+PY_38_MAGIC_INT = magic2int(magics['3.8.3'])
+
+
+def load_py38_code(data: bytes) -> xdis.Code38:
+    return xdis.unmarshal.load_code(io.BytesIO(data), PY_38_MAGIC_INT)
+
+
+def test_dumps_roundtrips_loaded_file():
+    py39_transforms = TEST_FILES_FOLDER / 'transforms.cpython-39.pyc'
+    code = pyc_io.CompiledFile(py39_transforms).code
+
+    loaded = load_py38_code(marshal38.dumps(code))
+
+    assert loaded.co_names == code.co_names
+    assert loaded.co_code == code.co_code
+    for loaded_const, const in zip(loaded.co_consts, code.co_consts):
+        if isinstance(const, xdis.Code38):
+            assert loaded_const.co_name == const.co_name
+            assert loaded_const.co_code == const.co_code
+            assert loaded_const.co_consts == const.co_consts
+        else:
+            assert loaded_const == const
+
+
+def test_dumps_references_repeated_objects():
+    repeated = 'a long string constant that appears several times'
+    code = make_module_code(
+        (repeated, (repeated, 'x'), (repeated, 'x')), ('name', 'name')
+    )
+
+    data = marshal38.dumps(code)
+
+    assert data.count(repeated.encode()) == 1
+    assert data.count(b'name') == 1
+    loaded = load_py38_code(data)
+    assert loaded.co_consts == code.co_consts
+    assert loaded.co_names == code.co_names
+
+
+def test_dumps_keeps_equal_constants_of_different_types_apart():
+    code = make_module_code(
+        (1, True, 1.0, -0.0, 0.0, (1,), (True,), (1.0,), 2 ** 100, 2 ** 100)
+    )
+
+    loaded = load_py38_code(marshal38.dumps(code))
+
+    assert [type(const) for const in loaded.co_consts] == [
+        int, bool, float, float, float, tuple, tuple, tuple, int, int
+    ]
+    assert [type(const[0]) for const in loaded.co_consts[5:8]] == [int, bool, float]
+    assert str(loaded.co_consts[3]) == '-0.0'
+    assert loaded.co_consts[8] == 2 ** 100
+
+
+@pytest.mark.skipif(
+    sys.version_info[:2] != (3, 8), reason="Needs to run on Python 3.8"
+)
+def test_dumps_matches_native_marshal():
+    code = compile(
+        (TEST_FILES_FOLDER / 'transforms.py').read_text(), 'transforms.py', 'exec'
+    )
+
+    assert marshal.loads(marshal38.dumps(code)) == code
+
+
+class ChunkRecorder(io.BytesIO):
+    def __init__(self):
+        super().__init__()
+        self.chunk_sizes = []
+
+    def write(self, data):
+        self.chunk_sizes.append(len(data))
+        return super().write(data)
+
+
+def test_dump_writes_the_same_bytes_in_chunks():
+    data_table = tuple(i.to_bytes(2, 'little') * 50 for i in range(300))
+    code = make_module_code((
+        'a' * 5000, 'é' * 3000, 'name', data_table, frozenset(range(100)), 2 ** 1000,
+        make_module_code(('nested',) * 2),
+    ))
+    expected = marshal38.dumps(code)
+
+    for chunk_size in (64, 4096, len(expected) + 1):
+        file = ChunkRecorder()
+        assert marshal38.dump(code, file, chunk_size) == len(expected)
+        assert file.getvalue() == expected
+        # Long strings are written a chunk at a time, and the rest is
+        # buffered until it fills a chunk.
+        assert max(file.chunk_sizes) < 2 * chunk_size + 300
+    assert load_py38_code(expected).co_consts[:4] == code.co_consts[:4]
+
+
+def test_dump_raises_write_errors():
+    class FullDisk(io.BytesIO):
+        def write(self, data):
+            if self.tell() > 10000:
+                raise OSError(28, 'No space left on device')
+            return super().write(data)
+
+    code = make_module_code(tuple(bytes([i]) * 1000 for i in range(100)))
+
+    with pytest.raises(OSError, match='No space left'):
+        marshal38.dump(code, FullDisk(), chunk_size=1000)
+
+
+def test_dump_raises_errors_in_the_object_over_write_errors():
+    class FullDisk(io.BytesIO):
+        def write(self, data):
+            if len(data) >= 1000:
+                raise OSError(28, 'No space left on device')
+            return super().write(data)
+
+    # The bytes are the one chunk handed to the writer thread, which fails on
+    # it, and the object that can't be marshalled comes straight after.
+    code = make_module_code((b'x' * 1000, object()))
+
+    with pytest.raises(ValueError, match='unmarshallable object'):
+        marshal38.dump(code, FullDisk(), chunk_size=1000)
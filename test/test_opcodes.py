@@ -0,0 +1,60 @@
+import subprocess
+import sys
+import pytest
+import xdis.magics
+from xdis.opcodes import opcode_38 as xdis_opcode_38
+from xdis.opcodes import opcode_39 as xdis_opcode_39
+from xdis.opcodes import opcode_310 as xdis_opcode_310
+from pydowngrade import opcodes, pyc_io
+from utils import TEST_FOLDER
+
+
+@pytest.mark.parametrize('table, expected', [
+    (opcodes.opcode_38, xdis_opcode_38),
+    (opcodes.opcode_39, xdis_opcode_39),
+    (opcodes.opcode_310, xdis_opcode_310),
+])
+def test_opcode_tables_match_xdis(table, expected):
+    assert table.opmap == expected.opmap
+    assert list(table.opname) == list(expected.opname)
+    for name, opcode in expected.opmap.items():
+        assert getattr(table, name) == opcode
+    for attribute in (
+        'JABS_OPS', 'JREL_OPS', 'hasjabs', 'hasjrel', 'hasconst', 'hasname',
+        'haslocal', 'hasfree', 'hascompare',
+    ):
+        assert getattr(table, attribute) == frozenset(getattr(expected, attribute))
+    assert list(table.cmp_op) == list(expected.cmp_op)
+    assert table.HAVE_ARGUMENT == expected.HAVE_ARGUMENT
+    assert table.EXTENDED_ARG == expected.opmap['EXTENDED_ARG']
+
+
+def test_py38_magic_matches_xdis():
+    assert pyc_io.PY38_MAGIC == xdis.magics.magics['3.8.3']
+
+
+def test_startup_does_not_import_xdis():
+    # `-S` leaves out site-packages, and with it anything a sitecustomize
+    # imports, so only what pydowngrade imports itself is listed.
+    result = subprocess.run(
+        [
+            sys.executable, '-S', '-X', 'importtime', '-c',
+            'import pydowngrade, pydowngrade.__main__, pydowngrade.api, '
+            'pydowngrade.client, pydowngrade.import_hook',
+        ],
+        cwd=str(TEST_FOLDER.parent),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+
+    imported = [
+        line.rpartition('|')[2].strip()
+        for line in result.stderr.splitlines()
+        if line.startswith('import time:') and '|' in line
+    ]
+    assert 'pydowngrade.__main__' in imported
+    assert [name for name in imported if name.split('.')[0] == 'xdis'] == []
+    # Only needed with --persistent_worker.
+    assert 'pydowngrade.worker' not in imported
@@ -0,0 +1,92 @@
+from xdis.opcodes import opcode_38
+from pydowngrade.downgrade_transformer import downgrade_py39_code_to_py38
+from pydowngrade.instructions import Instruction, assemble_instructions
+from pydowngrade.peephole import optimize_instructions
+from utils import make_function_code
+
+
+def test_threads_jumps_to_jumps():
+    end = Instruction(opcode_38.RETURN_VALUE)
+    jump = Instruction(opcode_38.JUMP_FORWARD, target=end)
+    conditional = Instruction(opcode_38.POP_JUMP_IF_FALSE, target=jump)
+    instructions = [
+        Instruction(opcode_38.LOAD_CONST, 0),
+        conditional,
+        Instruction(opcode_38.LOAD_CONST, 0),
+        jump,
+        Instruction(opcode_38.LOAD_CONST, 1),
+        end,
+    ]
+
+    optimized = optimize_instructions(instructions)
+
+    assert conditional.target is end
+    # The LOAD_CONST after the jump can't be reached any more, which makes the
+    # jump one to the next instruction.
+    assert [instruction.opcode for instruction in optimized] == [
+        opcode_38.LOAD_CONST,
+        opcode_38.POP_JUMP_IF_FALSE,
+        opcode_38.LOAD_CONST,
+        opcode_38.RETURN_VALUE,
+    ]
+    assert assemble_instructions(optimized) == bytes([100, 0, 114, 6, 100, 0, 83, 0])
+
+
+def test_removed_instructions_pass_on_their_line():
+    end = Instruction(opcode_38.RETURN_VALUE)
+    jump = Instruction(opcode_38.JUMP_FORWARD, target=end)
+    jump.line = 5
+    instructions = [Instruction(opcode_38.LOAD_CONST, 0), jump, end]
+
+    optimized = optimize_instructions(instructions)
+
+    assert optimized == [instructions[0], end]
+    assert end.line == 5
+
+
+def test_transform_optimizes_reraise_in_loop():
+    code = make_function_code(bytes([
+        # POP_JUMP_IF_FALSE  6
+        114, 6,
+        # POP_EXCEPT
+        89, 0,
+        # JUMP_ABSOLUTE  0
+        113, 0,
+        # RERAISE
+        48, 0,
+    ]))
+
+    assert downgrade_py39_code_to_py38(code).co_code == bytes([
+        # POP_JUMP_IF_FALSE  6, POP_EXCEPT
+        114, 6, 89, 0,
+        # JUMP_FORWARD   2 (to 10)
+        110, 2,
+        # END_FINALLY, JUMP_ABSOLUTE  0
+        88, 0, 113, 0,
+    ])
+    assert downgrade_py39_code_to_py38(code, optimize=True).co_code == bytes([
+        # POP_JUMP_IF_FALSE  6, POP_EXCEPT
+        114, 6, 89, 0,
+        # JUMP_ABSOLUTE  0
+        113, 0,
+        # END_FINALLY, JUMP_ABSOLUTE  0
+        88, 0, 113, 0,
+    ])
+
+
+def test_transform_rebuilds_lnotab():
+    code = make_function_code(bytes([
+        # POP_JUMP_IF_FALSE  8, POP_EXCEPT
+        114, 8, 89, 0,
+        # LOAD_CONST 0 (None), RETURN_VALUE
+        100, 0, 83, 0,
+        # RERAISE
+        48, 0,
+    ]))
+    # LOAD_CONST starts line 2.
+    code.co_lnotab = bytes([4, 1])
+
+    transformed = downgrade_py39_code_to_py38(code)
+
+    # JUMP_FORWARD and END_FINALLY were inserted before it.
+    assert transformed.co_lnotab == bytes([8, 1])
@@ -0,0 +1,81 @@
+import hashlib
+import pytest
+from pydowngrade import batch, pipeline
+from pydowngrade.__main__ import main
+from test_batch import make_input_tree
+from utils import TEST_FILES_FOLDER, load_python_pyc_file
+
+
+def converted_files(root):
+    return sorted(
+        path.relative_to(root) for path in root.rglob('*') if path.is_file()
+    )
+
+
+def sha256_of(path):
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_pipelined_convert_tree_matches_convert_tree(tmp_path, jobs):
+    make_input_tree(tmp_path / 'in')
+
+    expected = batch.convert_tree(tmp_path / 'in', tmp_path / 'expected', jobs=1)
+    result = batch.convert_tree(
+        tmp_path / 'in', tmp_path / 'out', jobs=jobs, queue_depth=1,
+        collect_stats=True,
+    )
+
+    assert len(result.converted) == 3
+    assert [failure.input_path.name for failure in result.failures] == ['broken.pyc']
+    assert result.stats.files == 4
+    # Written atomically, so no temporary files are left behind.
+    assert converted_files(tmp_path / 'out') == converted_files(tmp_path / 'expected')
+    output = tmp_path / 'out' / 'package' / '__pycache__' / 'hello_world.cpython-38.pyc'
+    assert load_python_pyc_file(output).co_names == ('test',)
+    assert result.input_bytes == expected.input_bytes
+    assert result.output_bytes == expected.output_bytes
+    # Both hash the files as they read and write them.
+    for file_result in result.converted + expected.converted:
+        assert file_result.input_sha256 == sha256_of(file_result.input_path)
+        assert file_result.output_sha256 == sha256_of(file_result.output_path)
+
+
+def test_pipeline_only_reads_ahead_by_the_queue_depth(tmp_path):
+    py39_hello_world = (TEST_FILES_FOLDER / 'hello_world.cpython-39.pyc').read_bytes()
+    input_root = tmp_path / 'in'
+    input_root.mkdir()
+    for i in range(30):
+        (input_root / ('module%d.pyc' % i)).write_bytes(py39_hello_world)
+    output_root = tmp_path / 'out'
+    output_root.mkdir()
+
+    read_ahead = []
+
+    def tasks():
+        for i in range(30):
+            written = len(list(output_root.glob('module*.pyc')))
+            read_ahead.append(i - written)
+            name = 'module%d.pyc' % i
+            yield batch.ConversionTask(input_root / name, output_root / name, 0)
+
+    result = batch.BatchResult()
+    pipeline.run_pipeline(tasks(), 1, result, queue_depth=2, io_threads=1)
+
+    assert len(result.converted) == 30
+    # Queued to be downgraded, in flight, queued to be written and one held
+    # by each thread in between.
+    assert max(read_ahead) <= 3 * 2 + 2
+
+
+def test_main_pipeline_option(tmp_path, capsys):
+    make_input_tree(tmp_path / 'in')
+
+    exit_code = main([
+        str(tmp_path / 'in'), str(tmp_path / 'out'), '--jobs', '1', '--pipeline', '4',
+    ])
+
+    assert exit_code == 1
+    assert 'Converted 3 files' in capsys.readouterr().out
+    with pytest.raises(SystemExit):
+        main([str(tmp_path / 'in'), str(tmp_path / 'out'), '--pipeline', '0'])
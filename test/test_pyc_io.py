@@ -1,6 +1,11 @@
+import importlib.util
+import py_compile
+import struct
+import sys
 import pytest
 import xdis
 from pydowngrade import pyc_io
+from pydowngrade.unmarshal39 import Py39PycHeader, read_pyc_header
 
 from utils import TEST_FILES_FOLDER, load_python_pyc_file
 
@@ -8,21 +13,21 @@ from utils import TEST_FILES_FOLDER, load_python_pyc_file
 def test_fails_on_non_python_3_9_code():
     py38_hello_world = TEST_FILES_FOLDER / 'hello_world.cpython-38.pyc'
     with pytest.raises(ValueError) as excinfo:
-        pyc_io.Py39CompiledFile(py38_hello_world)
+        pyc_io.CompiledFile(py38_hello_world)
 
-    assert "Only Python 3.9 files are supported" in str(excinfo.value)
+    assert "Only Python 3.9 and 3.10 files are supported" in str(excinfo.value)
 
 
 def test_loads_python_3_9_code():
     py39_hello_world = TEST_FILES_FOLDER / 'hello_world.cpython-39.pyc'
-    compiled_file = pyc_io.Py39CompiledFile(py39_hello_world)
+    compiled_file = pyc_io.CompiledFile(py39_hello_world)
 
     assert compiled_file.code is not None
 
 
 def test_loaded_code_properties():
     py39_hello_world = TEST_FILES_FOLDER / 'hello_world.cpython-39.pyc'
-    compiled_file = pyc_io.Py39CompiledFile(py39_hello_world)
+    compiled_file = pyc_io.CompiledFile(py39_hello_world)
 
     module_code = compiled_file.code
     assert 'test' in module_code.co_names
@@ -35,7 +40,7 @@ def test_loaded_code_properties():
 
 def test_loaded_code_bytecode():
     py39_hello_world = TEST_FILES_FOLDER / 'hello_world.cpython-39.pyc'
-    compiled_file = pyc_io.Py39CompiledFile(py39_hello_world)
+    compiled_file = pyc_io.CompiledFile(py39_hello_world)
 
     module_code = compiled_file.code
     assert module_code.co_code == bytes([
@@ -113,3 +118,56 @@ def test_py_38_file_roundtrips(tmp_path):
     expected_nested_code = expected_code.co_consts[0]
     assert_code_objects_equal_except_constants(actual_nested_code, expected_nested_code)
 
+
+
+def test_py38_pyc_header_keeps_source_mtime_and_size():
+    header = read_pyc_header(
+        (TEST_FILES_FOLDER / 'hello_world.cpython-39.pyc').read_bytes()
+    )
+
+    assert pyc_io.py38_pyc_header(header) == (
+        pyc_io.PY38_MAGIC + struct.pack('<III', 0, 1647231940, 38)
+    )
+
+
+@pytest.mark.parametrize('source, expected', [
+    # Computed with `importlib.util.source_hash` on Python 3.8.
+    (b'', '81e4881b3643e8e9'),
+    (b'x = 1\n', '1506f08f32bf3ff3'),
+    (bytes(range(256)) * 3, '8fc04a539031bbfe'),
+])
+def test_py38_source_hash(source, expected):
+    assert pyc_io.py38_source_hash(source).hex() == expected
+    # The fallback for the versions whose `_imp.source_hash` differs.
+    assert pyc_io._siphash24(pyc_io._PY38_RAW_MAGIC, 0, source).to_bytes(
+        8, 'little'
+    ).hex() == expected
+
+
+def test_py38_pyc_header_hash_based():
+    timestamp_header = Py39PycHeader(3425, 0, 1647231940, 38, None)
+    hash_header = Py39PycHeader(3425, 0b11, None, None, b'39hash..')
+    source = b'x = 1\n'
+    source_hash = pyc_io.py38_source_hash(source)
+    if sys.version_info[:2] == (3, 8):
+        assert source_hash == importlib.util.source_hash(source)
+
+    checked = pyc_io.py38_pyc_header(
+        timestamp_header, py_compile.PycInvalidationMode.CHECKED_HASH, source
+    )
+    assert checked == pyc_io.PY38_MAGIC + struct.pack('<I', 0b11) + source_hash
+    unchecked = pyc_io.py38_pyc_header(
+        timestamp_header, py_compile.PycInvalidationMode.UNCHECKED_HASH, source
+    )
+    assert unchecked == pyc_io.PY38_MAGIC + struct.pack('<I', 0b01) + source_hash
+    # Hash based inputs stay hash based, with the hash recomputed for 3.8.
+    assert pyc_io.py38_pyc_header(hash_header, source=source) == checked
+    assert pyc_io.py38_pyc_header(hash_header).endswith(b'39hash..')
+    assert pyc_io.py38_pyc_header(
+        hash_header, py_compile.PycInvalidationMode.TIMESTAMP, source, 1234
+    ) == pyc_io.PY38_MAGIC + struct.pack('<III', 0, 1234, len(source))
+
+    with pytest.raises(ValueError):
+        pyc_io.py38_pyc_header(
+            timestamp_header, py_compile.PycInvalidationMode.CHECKED_HASH
+        )
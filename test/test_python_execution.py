@@ -1,6 +1,10 @@
 # These sets of tests rely on being able to execute Python 3.8 code.
+import os
+import py_compile
 import subprocess
-from pydowngrade import pyc_io
+import pytest
+from pydowngrade import batch, pyc_io
+from pydowngrade.unmarshal39 import read_pyc_header
 from utils import (
     TEST_FILES_FOLDER, PY_38_COMMAND, can_execute_python_3_8, load_python_pyc_file
 )
@@ -39,3 +43,36 @@ def test_can_import_roundtripped_python_3_8_pyc_file(tmp_path):
         cwd=str(tmp_path), encoding='utf-8'
     )
     assert output == 'Hello World\n'
+
+
+@can_execute_python_3_8
+@pytest.mark.parametrize('invalidation_mode', [
+    None,
+    py_compile.PycInvalidationMode.CHECKED_HASH,
+    py_compile.PycInvalidationMode.UNCHECKED_HASH,
+])
+def test_downgraded_pyc_is_up_to_date_with_its_source(tmp_path, invalidation_mode):
+    # Deployed next to the source the 3.9 pyc was compiled from, 3.8 should
+    # use the downgraded pyc rather than recompiling it.
+    source = tmp_path / 'hello_world.py'
+    source.write_bytes((TEST_FILES_FOLDER / 'hello_world.py').read_bytes())
+    py39_hello_world = TEST_FILES_FOLDER / 'hello_world.cpython-39.pyc'
+    source_mtime = read_pyc_header(py39_hello_world.read_bytes()).source_mtime
+    os.utime(str(source), (source_mtime, source_mtime))
+
+    pycache = tmp_path / '__pycache__'
+    pycache.mkdir()
+    (pycache / 'hello_world.cpython-39.pyc').write_bytes(py39_hello_world.read_bytes())
+    output_path = pycache / 'hello_world.cpython-38.pyc'
+    result = batch.convert_file(
+        pycache / 'hello_world.cpython-39.pyc', output_path,
+        invalidation_mode=invalidation_mode,
+    )
+    assert result.error is None
+
+    output = subprocess.check_output(
+        PY_38_COMMAND + ['-v', '-c', 'import hello_world; hello_world.test()'],
+        cwd=str(tmp_path), encoding='utf-8', stderr=subprocess.STDOUT,
+    )
+    assert 'Hello World\n' in output
+    assert '%s matches %s' % (output_path, source) in output
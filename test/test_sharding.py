@@ -0,0 +1,133 @@
+import hashlib
+import json
+import subprocess
+import sys
+import pytest
+from pydowngrade import sharding
+from pydowngrade.__main__ import main
+from pydowngrade.sharding import Shard, merge_shard_manifests, partition
+from utils import TEST_FOLDER, TEST_FILES_FOLDER
+from test_batch import make_input_tree
+
+
+def make_store(root):
+    # Files of very different sizes, and one that fails to convert.
+    make_input_tree(root)
+    for i in range(4):
+        (root / ('transforms_%d.pyc' % i)).write_bytes(
+            (TEST_FILES_FOLDER / 'transforms.cpython-39.pyc').read_bytes()
+        )
+    (root / 'features.pyc').write_bytes(
+        (TEST_FILES_FOLDER / 'py310_features.cpython-310.pyc').read_bytes()
+    )
+    return sharding.scan_input_sizes(root)
+
+
+def test_parse_shard():
+    assert Shard.parse('2/3') == Shard(2, 3)
+    assert str(Shard(2, 3)) == '2/3'
+    for spec in ('0/3', '4/3', '2', '-1/3', 'a/b'):
+        with pytest.raises(ValueError):
+            Shard.parse(spec)
+
+
+def test_partition_balances_by_size():
+    sizes = {'huge.pyc': 1000000}
+    sizes.update(('small_%02d.pyc' % i, 10000 + i) for i in range(40))
+
+    shards = partition(sizes, 3)
+
+    assert sorted(name for names in shards for name in names) == sorted(sizes)
+    # The huge file gets a shard to itself and the rest are split evenly.
+    assert ['huge.pyc'] in shards
+    assert sorted(len(names) for names in shards) == [1, 20, 20]
+    # Only the files and their sizes matter, not the order they're listed in.
+    assert partition(dict(reversed(list(sizes.items()))), 3) == shards
+
+
+def test_read_input_manifest_rejects_paths_outside_input(tmp_path):
+    sharding.write_input_manifest(tmp_path / 'ok.json', {'a/b.pyc': 3})
+    (tmp_path / 'bad.json').write_text(json.dumps({'files': {'../b.pyc': 3}}))
+
+    assert sharding.read_input_manifest(tmp_path / 'ok.json') == {'a/b.pyc': 3}
+    with pytest.raises(ValueError, match='outside the input'):
+        sharding.read_input_manifest(tmp_path / 'bad.json')
+
+
+def test_shards_in_separate_processes_merge(tmp_path):
+    sizes = make_store(tmp_path / 'in')
+    manifest = tmp_path / 'inputs.json'
+    assert sharding.main(['manifest', str(tmp_path / 'in'), str(manifest)]) == 0
+
+    # Each process stands in for a machine converting its own shard.
+    processes = [
+        subprocess.Popen(
+            [
+                sys.executable, '-m', 'pydowngrade', '-j', '1',
+                str(tmp_path / 'in'), str(tmp_path / 'out'),
+                '--manifest', str(manifest), '--shard', '%d/3' % index,
+            ],
+            cwd=str(TEST_FOLDER.parent),
+            stdout=subprocess.DEVNULL,
+        )
+        for index in (1, 2, 3)
+    ]
+    # broken.pyc fails in one of them.
+    assert sorted(process.wait() for process in processes) == [0, 0, 1]
+
+    shard_manifests = sorted((tmp_path / 'out').glob('.pydowngrade-shard-*-of-3.json'))
+    result = merge_shard_manifests(shard_manifests, sizes)
+
+    assert len(shard_manifests) == 3
+    assert sorted(result.files) == sorted(sizes)
+    assert (result.missing, result.missing_shards, result.duplicates) == ([], [], {})
+    assert result.failed == ['broken.pyc']
+    assert 'File is too short' in result.files['broken.pyc']['error']
+    entry = result.files['package/__pycache__/hello_world.cpython-39.pyc']
+    assert entry['status'] == 'converted'
+    assert entry['input_sha256'] == hashlib.sha256(
+        (TEST_FILES_FOLDER / 'hello_world.cpython-39.pyc').read_bytes()
+    ).hexdigest()
+    assert entry['output'] == 'package/__pycache__/hello_world.cpython-38.pyc'
+    assert entry['output_sha256'] == hashlib.sha256(
+        (tmp_path / 'out' / entry['output']).read_bytes()
+    ).hexdigest()
+    assert entry['seconds'] > 0
+
+
+def test_merge_reports_missing_and_duplicated_files(tmp_path, capsys):
+    sizes = make_store(tmp_path / 'in')
+    sharding.write_input_manifest(tmp_path / 'inputs.json', sizes)
+    # Shard 1 ran twice, on different machines, and shard 2 never finished.
+    for name in ('first.json', 'retry.json'):
+        main([
+            str(tmp_path / 'in'), str(tmp_path / 'out'), '-j', '1',
+            '--manifest', str(tmp_path / 'inputs.json'), '--shard', '1/2',
+            '--shard-manifest', str(tmp_path / name),
+        ])
+
+    exit_code = sharding.main([
+        'merge', str(tmp_path / 'first.json'), str(tmp_path / 'retry.json'),
+        '--input-manifest', str(tmp_path / 'inputs.json'),
+        '-o', str(tmp_path / 'merged.json'),
+    ])
+
+    first_shard, second_shard = partition(sizes, 2)
+    merged = json.loads((tmp_path / 'merged.json').read_text())
+    assert exit_code == 1
+    assert merged['missing_shards'] == ['2/2']
+    assert merged['missing'] == second_shard
+    assert merged['duplicates'] == {name: ['1/2', '1/2'] for name in first_shard}
+    assert 'Missing shards: 2/2' in capsys.readouterr().out
+
+
+def test_merge_rejects_shards_of_different_conversions(tmp_path):
+    make_store(tmp_path / 'in')
+    for shard, optimize in (('1/2', []), ('2/2', ['-O'])):
+        main([
+            str(tmp_path / 'in'), str(tmp_path / 'out'), '-j', '1',
+            '--shard', shard,
+        ] + optimize)
+
+    with pytest.raises(ValueError, match='different conversion'):
+        merge_shard_manifests(sorted((tmp_path / 'out').glob('.pydowngrade-shard-*')))
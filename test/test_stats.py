@@ -0,0 +1,62 @@
+import json
+import xdis
+from pydowngrade import batch, pyc_io
+from pydowngrade.downgrade_transformer import downgrade_py39_code_to_py38
+from pydowngrade.stats import DowngradeStats
+from test_batch import make_input_tree
+from utils import TEST_FILES_FOLDER
+
+
+def test_transformer_counts_rewritten_opcodes():
+    py39_transforms = TEST_FILES_FOLDER / 'transforms.cpython-39.pyc'
+    code = pyc_io.CompiledFile(py39_transforms).code
+    stats = DowngradeStats()
+
+    downgrade_py39_code_to_py38(code, stats)
+
+    assert stats.rewritten_opcodes['IS_OP'] == 2
+    assert stats.rewritten_opcodes['CONTAINS_OP'] == 2
+    assert stats.rewritten_opcodes['LOAD_ASSERTION_ERROR'] == 1
+    assert stats.stage_seconds['relocate'] > 0
+
+
+def test_transformer_counts_extended_arg_widenings():
+    # A jump over enough instructions that it needs an EXTENDED_ARG.
+    code = xdis.Code38(
+        0, 0, 0, 0, 10, 0,
+        # JUMP_FORWARD (to the end), 200 times IS_OP 0, RETURN_VALUE
+        bytes([144, 1, 110, 144] + [117, 0] * 200 + [83, 0]),
+        (None,), (), (), 'test.py', 'function', 1, b'', (), (),
+    )
+    stats = DowngradeStats()
+
+    downgrade_py39_code_to_py38(code, stats)
+
+    assert stats.extended_arg_widenings == 1
+
+
+def test_convert_tree_merges_worker_stats(tmp_path):
+    make_input_tree(tmp_path / 'in')
+
+    for jobs in (1, 2):
+        result = batch.convert_tree(
+            tmp_path / 'in', tmp_path / 'out', jobs=jobs, collect_stats=True
+        )
+
+        exported = json.loads(result.stats.to_json())
+        # The broken file is counted too, it just never gets past loading.
+        assert exported['files'] == 4
+        assert exported['bytes_in'] == result.input_bytes + len(b'not a pyc file')
+        assert exported['bytes_out'] == result.output_bytes - 16 * 3
+        assert set(exported['stage_seconds']) == {
+            'load', 'transform', 'relocate', 'verify', 'marshal'
+        }
+
+
+def test_convert_tree_skips_stats_by_default(tmp_path):
+    make_input_tree(tmp_path / 'in')
+
+    result = batch.convert_tree(tmp_path / 'in', tmp_path / 'out', jobs=1)
+
+    assert result.stats is None
+    assert all(file_result.stats is None for file_result in result.converted)
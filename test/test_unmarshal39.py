@@ -0,0 +1,69 @@
+import struct
+import pytest
+import xdis
+from pydowngrade import marshal38, pyc_io, unmarshal39
+from utils import TEST_FILES_FOLDER, make_module_code
+
+
+def make_py39_header(flags, field_1=0, field_2=0) -> bytes:
+    return struct.pack('<HHIII', 3425, 0x0A0D, flags, field_1, field_2)
+
+
+def test_loads_matches_xdis_loader():
+    py39_transforms = TEST_FILES_FOLDER / 'transforms.cpython-39.pyc'
+    expected = xdis.load_module(str(py39_transforms))[3]
+
+    code = pyc_io.CompiledFile(py39_transforms).code
+
+    assert isinstance(code, xdis.Code38)
+    assert code.co_code == expected.co_code
+    assert code.co_names == expected.co_names
+    assert code.co_lnotab == expected.co_lnotab
+    for const, expected_const in zip(code.co_consts, expected.co_consts):
+        if isinstance(const, xdis.Code38):
+            assert const.co_name == expected_const.co_name
+            assert const.co_code == expected_const.co_code
+            assert const.co_consts == expected_const.co_consts
+            assert const.co_varnames == expected_const.co_varnames
+        else:
+            assert const == expected_const
+
+
+def test_loads_resolves_references_and_constant_types():
+    repeated = 'a long string constant that appears several times'
+    consts = (
+        repeated, (repeated, 'x'), (repeated, 'x'), 2 ** 100, -(2 ** 70),
+        1.5, 2j, b'bytes', frozenset({'a', 'b'}), None, Ellipsis, True,
+    )
+    data = marshal38.dumps(make_module_code(consts, ('name', 'name')))
+
+    code = unmarshal39.loads(data)
+
+    assert code.co_consts == consts
+    assert [type(const) for const in code.co_consts] == [type(const) for const in consts]
+    assert code.co_names == ('name', 'name')
+    assert code.co_consts[1] is code.co_consts[2]
+
+
+def test_read_pyc_header():
+    timestamp_header = unmarshal39.read_pyc_header(make_py39_header(0, 1234, 56))
+    assert timestamp_header.source_mtime == 1234
+    assert timestamp_header.source_size == 56
+    assert timestamp_header.source_hash is None
+
+    hash_header = unmarshal39.read_pyc_header(make_py39_header(0b11, 1, 2))
+    assert hash_header.flags == 0b11
+    assert hash_header.source_hash == struct.pack('<II', 1, 2)
+    assert hash_header.source_mtime is None
+
+
+def test_rejects_truncated_files(tmp_path):
+    data = (TEST_FILES_FOLDER / 'hello_world.cpython-39.pyc').read_bytes()
+
+    with pytest.raises(ValueError) as excinfo:
+        pyc_io.CompiledFile.from_bytes(data[:len(data) // 2])
+    assert 'Truncated marshal data' in str(excinfo.value)
+
+    (tmp_path / 'empty.pyc').write_bytes(b'')
+    with pytest.raises(ValueError):
+        pyc_io.CompiledFile(tmp_path / 'empty.pyc')
@@ -0,0 +1,113 @@
+import dis
+import sys
+import pytest
+import xdis
+from xdis.opcodes import opcode_38
+from pydowngrade import batch
+from pydowngrade.downgrade_transformer import downgrade_py39_code_to_py38
+from pydowngrade.verify import VALID_OPCODES, stack_effect, verify_py38_code
+from test_batch import make_input_tree
+from utils import TEST_FILES_FOLDER, load_python_pyc_file, make_function_code
+
+
+def test_downgraded_hello_world_verifies():
+    code = load_python_pyc_file(TEST_FILES_FOLDER / 'hello_world.cpython-39.pyc')
+
+    verify_py38_code(downgrade_py39_code_to_py38(code))
+    verify_py38_code(downgrade_py39_code_to_py38(code, optimize=True))
+
+
+def test_rejects_unsupported_exception_match():
+    # JUMP_IF_NOT_EXC_MATCH isn't rewritten yet, and means something else to
+    # 3.8.
+    code = load_python_pyc_file(TEST_FILES_FOLDER / 'transforms.cpython-39.pyc')
+
+    with pytest.raises(ValueError, match='exception_match_op .* unknown opcode 121'):
+        verify_py38_code(downgrade_py39_code_to_py38(code))
+
+
+@pytest.mark.parametrize('name', ['hello_world', 'transforms'])
+def test_python_3_8_test_files_verify(name):
+    verify_py38_code(
+        load_python_pyc_file(TEST_FILES_FOLDER / ('%s.cpython-38.pyc' % name))
+    )
+
+
+def test_finally_block_entered_by_call_finally_verifies():
+    verify_py38_code(make_function_code(bytes([
+        # SETUP_FINALLY  4 (to 6)
+        122, 4,
+        # POP_BLOCK, CALL_FINALLY   0 (to 6)
+        87, 0, 162, 0,
+        # END_FINALLY
+        88, 0,
+        # LOAD_CONST     0 (None), RETURN_VALUE
+        100, 0, 83, 0,
+    ]), stacksize=6))
+
+
+@pytest.mark.parametrize('co_code, problem', [
+    # LOAD_CONST     0 (None), without a RETURN_VALUE
+    (bytes([100, 0]), 'runs past the end'),
+    # RERAISE, only in 3.9
+    (bytes([48, 0]), 'unknown opcode 48 at 0'),
+    # LOAD_CONST 0 (None), EXTENDED_ARG
+    (bytes([100, 0, 144, 0]), 'ends with an EXTENDED_ARG'),
+    (bytes([100, 0, 83]), '3 bytes of bytecode'),
+    # JUMP_ABSOLUTE  3
+    (bytes([113, 3, 100, 0, 83, 0]), 'not the start of an instruction'),
+    # LOAD_CONST     1, RETURN_VALUE
+    (bytes([100, 1, 83, 0]), 'LOAD_CONST at 0 indexes past the end of co_consts'),
+    # LOAD_GLOBAL    0, RETURN_VALUE
+    (bytes([116, 0, 83, 0]), 'LOAD_GLOBAL at 0 indexes past the end of co_names'),
+    # LOAD_FAST      1, RETURN_VALUE
+    (bytes([124, 1, 83, 0]), 'LOAD_FAST at 0 indexes past the end of co_varnames'),
+    # LOAD_DEREF     0, RETURN_VALUE
+    (bytes([136, 0, 83, 0]), 'LOAD_DEREF at 0 indexes past the end of cell'),
+    # POP_TOP
+    (bytes([1, 0]), 'underflows the stack at 0'),
+    # LOAD_CONST 0 (None) three times, BUILD_TUPLE 3, RETURN_VALUE
+    (bytes([100, 0, 100, 0, 100, 0, 102, 3, 83, 0]), 'needs a stack of 3'),
+])
+def test_rejects_invalid_code(co_code, problem):
+    with pytest.raises(ValueError) as e:
+        verify_py38_code(
+            make_function_code(co_code, stacksize=2, co_varnames=('x',))
+        )
+    assert problem in str(e.value)
+    assert 'function (test.py:1)' in str(e.value)
+
+
+def test_rejects_invalid_nested_code():
+    nested = make_function_code(bytes([100, 1, 83, 0]))
+    nested.co_name = 'nested'
+
+    with pytest.raises(ValueError, match='Code object nested'):
+        verify_py38_code(
+            make_function_code(bytes([100, 0, 83, 0]), co_consts=(nested,))
+        )
+
+
+@pytest.mark.skipif(
+    sys.version_info[:2] != (3, 8), reason="Compares with Python 3.8's dis module"
+)
+def test_stack_effect_matches_python_3_8():
+    for opcode in sorted(VALID_OPCODES):
+        args = (0, 1, 3, 4, 0x105) if opcode >= opcode_38.HAVE_ARGUMENT else (None,)
+        for arg in args:
+            for jump in (True, False):
+                expected = dis.stack_effect(opcode, arg, jump=jump)
+                assert stack_effect(opcode, arg or 0, jump) == expected, (
+                    opcode_38.opname[opcode], arg, jump
+                )
+
+
+def test_convert_tree_verifies(tmp_path):
+    make_input_tree(tmp_path / 'in')
+
+    result = batch.convert_tree(
+        tmp_path / 'in', tmp_path / 'out', jobs=1, collect_stats=True, verify=True
+    )
+
+    assert len(result.converted) == 3
+    assert result.stats.stage_seconds['verify'] > 0
@@ -0,0 +1,137 @@
+import io
+import json
+import socket
+import threading
+import pytest
+from pydowngrade import client, worker
+from pydowngrade.__main__ import main
+from utils import TEST_FILES_FOLDER
+
+PY39_HELLO_WORLD = TEST_FILES_FOLDER / 'hello_world.cpython-39.pyc'
+
+needs_unix_sockets = pytest.mark.skipif(
+    not hasattr(socket, 'AF_UNIX'), reason="Needs Unix sockets"
+)
+
+
+@pytest.fixture(scope='module')
+def downgrade_worker():
+    with worker.DowngradeWorker(jobs=2) as downgrade_worker:
+        yield downgrade_worker
+
+
+def test_worker_runs_command_lines(tmp_path, downgrade_worker):
+    (tmp_path / 'in.pyc').write_bytes(PY39_HELLO_WORLD.read_bytes())
+    (tmp_path / 'flags').write_text('-O\nin.pyc\nout.pyc\n')
+
+    # Relative paths are resolved against the request's directory, and
+    # flagfiles are expanded.
+    response = downgrade_worker.handle(
+        {'arguments': ['@flags'], 'cwd': str(tmp_path)}
+    )
+
+    assert response == {'exitCode': 0, 'output': ''}
+    assert main([str(tmp_path / 'in.pyc'), str(tmp_path / 'expected.pyc'), '-O']) == 0
+    assert (tmp_path / 'out.pyc').read_bytes()[16:] == \
+        (tmp_path / 'expected.pyc').read_bytes()[16:]
+
+
+def test_worker_reports_failures(tmp_path, downgrade_worker):
+    (tmp_path / 'broken.pyc').write_bytes(b'not a pyc file')
+
+    failure = downgrade_worker.handle({
+        'arguments': [str(tmp_path / 'broken.pyc'), str(tmp_path / 'out.pyc')],
+    })
+    usage_error = downgrade_worker.handle({'arguments': ['--no-such-flag']})
+    invalid = downgrade_worker.handle({'arguments': 'not a list'})
+
+    assert failure['exitCode'] == 1
+    assert 'ValueError: File is too short' in failure['output']
+    assert usage_error['exitCode'] == 2
+    assert 'pydowngrade: error:' in usage_error['output']
+    assert invalid['exitCode'] == 2
+
+
+def test_persistent_worker_protocol(tmp_path, downgrade_worker):
+    requests = [
+        {'arguments': [str(PY39_HELLO_WORLD), str(tmp_path / 'a.pyc')], 'requestId': 1},
+        {'requestId': 2, 'cancel': True},
+        {'arguments': [str(tmp_path / 'missing.pyc'), str(tmp_path / 'b.pyc')],
+         'requestId': 3},
+    ]
+    # Requests may be spread over several lines.
+    stdin = io.StringIO(
+        json.dumps(requests[0], indent=2) + '\n'
+        + ''.join(json.dumps(request) + '\n' for request in requests[1:])
+    )
+    stdout = io.StringIO()
+
+    worker.serve_persistent_worker(downgrade_worker, stdin, stdout)
+
+    responses = sorted(
+        (json.loads(line) for line in stdout.getvalue().splitlines()),
+        key=lambda response: response['requestId'],
+    )
+    assert [
+        (response['requestId'], response['exitCode']) for response in responses
+    ] == [(1, 0), (3, 1)]
+    assert (tmp_path / 'a.pyc').exists()
+    assert not (tmp_path / 'b.pyc').exists()
+
+
+@needs_unix_sockets
+def test_client_forwards_to_socket_server(tmp_path, downgrade_worker, capsys):
+    socket_path = str(tmp_path / 'worker.sock')
+    server = worker.UnixSocketServer(socket_path, downgrade_worker)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        with pytest.raises(RuntimeError, match='already listening'):
+            worker.UnixSocketServer(socket_path, downgrade_worker)
+
+        assert client.main([
+            '--socket', socket_path, str(PY39_HELLO_WORLD), str(tmp_path / 'out.pyc'),
+        ]) == 0
+        assert (tmp_path / 'out.pyc').exists()
+        assert client.main([
+            '--socket=' + socket_path, str(tmp_path / 'missing.pyc'),
+            str(tmp_path / 'out.pyc'),
+        ]) == 1
+        assert 'missing.pyc' in capsys.readouterr().err
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+    assert not (tmp_path / 'worker.sock').exists()
+
+
+@needs_unix_sockets
+def test_client_runs_locally_without_worker(tmp_path, monkeypatch):
+    monkeypatch.setenv(client.SOCKET_ENVIRONMENT_VARIABLE, str(tmp_path / 'none.sock'))
+
+    assert client.main([str(PY39_HELLO_WORLD), str(tmp_path / 'out.pyc')]) == 0
+    assert (tmp_path / 'out.pyc').exists()
+
+
+@needs_unix_sockets
+def test_client_runs_locally_when_worker_hangs_up(tmp_path):
+    socket_path = str(tmp_path / 'worker.sock')
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen(1)
+
+    def hang_up():
+        connection, _ = listener.accept()
+        with connection:
+            connection.makefile('rb').readline()
+
+    thread = threading.Thread(target=hang_up)
+    thread.start()
+    try:
+        assert client.main([
+            '--socket', socket_path, str(PY39_HELLO_WORLD), str(tmp_path / 'out.pyc'),
+        ]) == 0
+    finally:
+        thread.join()
+        listener.close()
+    assert (tmp_path / 'out.pyc').exists()
@@ -36,3 +36,31 @@ def load_python_pyc_file(file):
     independent xdis.Code* object"""
     loaded_code_module = xdis.load_module(str(file))[3]
     return pyc_io.transform_code_to_portable(loaded_code_module)
+
+
+def get_function_from_module(module: xdis.Code38, function: str) -> xdis.Code38:
+    """The code object of the function called `function` defined at the top
+    level of `module`."""
+    for const in module.co_consts:
+        if isinstance(const, xdis.Code38) and const.co_name == function:
+            return const
+    assert False, "function " + function + " not found in module"
+
+
+def make_module_code(co_consts, co_names=()) -> xdis.Code38:
+    """A module's code object that returns None, with the given constants
+    and names."""
+    return xdis.Code38(
+        0, 0, 0, 0, 1, 64, bytes([100, 0, 83, 0]), co_consts, co_names, (),
+        'test.py', '<module>', 1, b'', (), (),
+    )
+
+
+def make_function_code(
+    co_code: bytes, co_consts=(None,), stacksize=10, co_varnames=()
+) -> xdis.Code38:
+    """A function's code object running `co_code`."""
+    return xdis.Code38(
+        0, 0, 0, len(co_varnames), stacksize, 0, co_code, co_consts, (),
+        co_varnames, 'test.py', 'function', 1, b'', (), (),
+    )